@@ -3,10 +3,7 @@ import logging
 import numpy as np
 import os
 import time
-from threading import Thread
-
-from queue import Queue
-from queue import Empty
+from threading import Condition, Lock, Thread
 
 import carla
 from srunner.scenariomanager.carla_data_provider import CarlaDataProvider
@@ -196,9 +193,18 @@ class CallBack(object):
 
 
 class SensorInterface(object):
+    """
+    Collects the sensor data per frame. Every frame has its own slot {tag: data}, get_data(frame) waits on a
+    condition variable that is notified once, when the last sensor of that frame has delivered its data.
+    """
+
+    # frames this far behind the newest one are dropped if nobody asked for them
+    MAX_PENDING_FRAMES = 20
+
     def __init__(self):
         self._sensors_objects = {}
-        self._data_buffers = Queue()
+        self._frames = {}
+        self._condition = Condition(Lock())
         self._queue_timeout = 300
 
         # Only sensor that doesn't get the data on tick, needs special treatment
@@ -213,28 +219,35 @@ class SensorInterface(object):
         if sensor_type == 'sensor.opendrive_map': 
             self._opendrive_tag = tag
 
+    def _is_complete(self, frame_data):
+        # Don't wait for the opendrive sensor
+        missing = len(self._sensors_objects) - len(frame_data)
+        return missing == 0 or (missing == 1 and self._opendrive_tag is not None and self._opendrive_tag not in frame_data)
+
     def update_sensor(self, tag, data, frame):
         if tag not in self._sensors_objects:
             raise SensorConfigurationInvalid("The sensor with tag [{}] has not been created!".format(tag))
 
-        self._data_buffers.put((tag, frame, data))
+        with self._condition:
+            frame_data = self._frames.setdefault(frame, {})
+            was_complete = self._is_complete(frame_data)
+            frame_data[tag] = (frame, data)
+            if not was_complete and self._is_complete(frame_data):
+                self._condition.notify_all()
+
+            if len(self._frames) > self.MAX_PENDING_FRAMES:
+                for stale_frame in [f for f in self._frames if f < frame - self.MAX_PENDING_FRAMES]:
+                    del self._frames[stale_frame]
 
     def get_data(self, frame):
-        """Read the queue to get the sensors data"""
-        try:
-            data_dict = {}
-            while len(data_dict.keys()) < len(self._sensors_objects.keys()):
-                # Don't wait for the opendrive sensor
-                if self._opendrive_tag and self._opendrive_tag not in data_dict.keys() \
-                        and len(self._sensors_objects.keys()) == len(data_dict.keys()) + 1:
-                    break
-
-                sensor_data = self._data_buffers.get(True, self._queue_timeout)
-                if sensor_data[1] != frame:
-                    continue
-                data_dict[sensor_data[0]] = ((sensor_data[1], sensor_data[2]))
-
-        except Empty:
-            raise SensorReceivedNoData("A sensor took too long to send their data")
+        """Waits until all sensors delivered their data of frame, older frames are dropped"""
+        with self._condition:
+            ready = self._condition.wait_for(lambda: self._is_complete(self._frames.get(frame, {})), self._queue_timeout)
+            if not ready:
+                raise SensorReceivedNoData("A sensor took too long to send their data")
+
+            data_dict = self._frames.pop(frame, {})
+            for stale_frame in [f for f in self._frames if f < frame]:
+                del self._frames[stale_frame]
 
         return data_dict
@@ -36,6 +36,8 @@ from leaderboard.envs.sensor_interface import SensorConfigurationInvalid
 from leaderboard.autoagents.agent_wrapper import AgentError, validate_sensor_configuration, TickRuntimeError
 from leaderboard.utils.statistics_manager import StatisticsManager, FAILURE_MESSAGES
 from leaderboard.utils.route_indexer import RouteIndexer
+from leaderboard.utils.simulator_readiness import (CallableProbe, FreePortProbe, StartupMetrics, TCPPortProbe,
+                                                   wait_until_all_ready, wait_until_ready)
 import atexit
 import subprocess
 import time
@@ -105,6 +107,8 @@ class LeaderboardEvaluator(object):
         self.sensor_icons = []
         self.agent_instance = None
         self.route_scenario = None
+        # town of the currently loaded world, None if the next route has to load its world
+        self._loaded_town = None
 
         self.statistics_manager = statistics_manager
 
@@ -185,6 +189,7 @@ class LeaderboardEvaluator(object):
             print(f"\n{traceback.format_exc()}\033[0m", flush=True)
 
         if self.route_scenario:
+            self.route_scenario.remove_parked_vehicles()
             self.route_scenario.remove_all_actors()
             self.route_scenario = None
             if self.statistics_manager:
@@ -200,57 +205,68 @@ class LeaderboardEvaluator(object):
             sensor.stop()
             sensor.destroy()
 
+    def _kill_server(self):
+        """
+        Kills the process group of the CARLA server started by this evaluator
+        """
+        try:
+            os.killpg(self.server.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
     def _setup_simulation(self, args):
         """
-        Prepares the simulation by getting the client, and setting up the world and traffic manager settings
+        Prepares the simulation by getting the client, and setting up the world and traffic manager settings.
+        The server is started and probed until its ports are ready (see leaderboard/utils/simulator_readiness.py)
         """
         self.carla_path = os.environ["CARLA_ROOT"]
         args.port = find_free_port(args.port)
+        args.traffic_manager_port = find_free_port(args.traffic_manager_port)
+        metrics = StartupMetrics(args.port, args.traffic_manager_port)
+
         cmd1 = f"{os.path.join(self.carla_path, 'CarlaUE4.sh')} -RenderOffScreen -nosound -carla-rpc-port={args.port} -graphicsadapter={args.gpu_rank}"
         self.server = subprocess.Popen(cmd1, shell=True, preexec_fn=os.setsid)
         print(cmd1, self.server.returncode, flush=True)
-        atexit.register(os.killpg, self.server.pid, signal.SIGKILL)
-        time.sleep(60)
-            
-        attempts = 0
-        num_max_restarts = 20
-        while attempts < num_max_restarts:
-            try:
-                client = carla.Client(args.host, args.port)
-                if args.timeout:
-                    client_timeout = args.timeout
-                client.set_timeout(client_timeout)
-
-                settings = carla.WorldSettings(
-                    synchronous_mode = True,
-                    fixed_delta_seconds = 1.0 / self.frame_rate,
-                    deterministic_ragdolls = True,
-                    spectator_as_ego = False
-                )
-                client.get_world().apply_settings(settings)
-                print(f"load_world success , attempts={attempts}", flush=True)
-                break
-            except Exception as e:
-                print(f"load_world failed , attempts={attempts}", flush=True)
-                print(e, flush=True)
-                attempts += 1
-                time.sleep(5)
-        attempts = 0
-        num_max_restarts = 40
-        while attempts < num_max_restarts:
-            try:
-                args.traffic_manager_port = find_free_port(args.traffic_manager_port)
-                traffic_manager = client.get_trafficmanager(args.traffic_manager_port)
-                traffic_manager.set_synchronous_mode(True)
-                traffic_manager.set_hybrid_physics_mode(True)
-                print(f"traffic_manager init success, try_time={attempts}", flush=True)
-                break
-            except Exception as e:
-                print(f"traffic_manager init fail, try_time={attempts}", flush=True)
-                print(e, flush=True)
-                attempts += 1
-                time.sleep(5)
-        return client, client_timeout, traffic_manager
+        atexit.register(self._kill_server)
+
+        deadline = time.monotonic() + args.startup_timeout
+        server_alive = lambda: self.server.poll() is None
+
+        # the RPC and streaming ports of the server and the (still free) traffic manager port, in parallel
+        metrics.add_all(wait_until_all_ready([
+            TCPPortProbe(args.host, args.port, name="rpc_port"),
+            TCPPortProbe(args.host, args.port + 1, name="streaming_port"),
+            FreePortProbe(args.traffic_manager_port, name="traffic_manager_port"),
+        ], deadline, alive_fn=server_alive))
+
+        def connect():
+            client = carla.Client(args.host, args.port)
+            client.set_timeout(args.timeout if args.timeout else self.client_timeout)
+            settings = carla.WorldSettings(
+                synchronous_mode = True,
+                fixed_delta_seconds = 1.0 / self.frame_rate,
+                deterministic_ragdolls = True,
+                spectator_as_ego = False
+            )
+            client.get_world().apply_settings(settings)
+            return client
+
+        client_probe = CallableProbe("client", connect)
+        metrics.add("client", *wait_until_ready(client_probe, deadline, initial_delay=1.0, alive_fn=server_alive))
+        client = client_probe.result
+        client_timeout = args.timeout if args.timeout else self.client_timeout
+
+        def start_traffic_manager():
+            traffic_manager = client.get_trafficmanager(args.traffic_manager_port)
+            traffic_manager.set_synchronous_mode(True)
+            traffic_manager.set_hybrid_physics_mode(True)
+            return traffic_manager
+
+        traffic_manager_probe = CallableProbe("traffic_manager", start_traffic_manager)
+        metrics.add("traffic_manager", *wait_until_ready(traffic_manager_probe, deadline, initial_delay=1.0, alive_fn=server_alive))
+
+        metrics.write(args.startup_metrics)
+        return client, client_timeout, traffic_manager_probe.result
 
     def _reset_world_settings(self):
         """
@@ -271,11 +287,30 @@ class LeaderboardEvaluator(object):
             self.traffic_manager.set_synchronous_mode(False)
             self.traffic_manager.set_hybrid_physics_mode(False)
 
+    def _soft_reset_world(self):
+        """
+        Brings the loaded world back to the state after load_world: destroys the actors left over from the
+        previous route and resets the traffic lights. Used instead of reloading the world for the same town
+        """
+        leftover_actors = []
+        for pattern in ('*sensor*', 'controller.*', 'walker.*', 'vehicle.*', 'static.prop.*'):
+            leftover_actors.extend(self.world.get_actors().filter(pattern))
+        for actor in leftover_actors:
+            if 'sensor' in actor.type_id:
+                actor.stop()
+        self.client.apply_batch_sync([carla.command.DestroyActor(actor) for actor in leftover_actors], False)
+        print(f"Reusing the loaded world, {len(leftover_actors)} leftover actors destroyed", flush=True)
+
     def _load_and_wait_for_world(self, args, town):
         """
-        Load a new CARLA world without changing the settings and provide data to CarlaDataProvider
+        Load a new CARLA world without changing the settings and provide data to CarlaDataProvider.
+        With --reuse-world, the world of the previous route is soft reset instead if it is the same town
         """
-        self.world = self.client.load_world(town, reset_settings=False)
+        if args.reuse_world and self.world is not None and self._loaded_town == town:
+            self._soft_reset_world()
+        else:
+            self._loaded_town = None
+            self.world = self.client.load_world(town, reset_settings=False)
 
         # Large Map settings are always reset, for some reason
         settings = self.world.get_settings()
@@ -298,6 +333,7 @@ class LeaderboardEvaluator(object):
         if map_name != town:
             raise Exception("The CARLA server uses the wrong map!"
                             " This scenario requires the use of map {}".format(town))
+        self._loaded_town = town
 
     def _register_statistics(self, route_index, entry_status, crash_message=""):
         """
@@ -347,6 +383,7 @@ class LeaderboardEvaluator(object):
             entry_status, crash_message = FAILURE_MESSAGES["Simulation"]
             self._register_statistics(config.index, entry_status, crash_message)
             self._cleanup()
+            self._loaded_town = None
             return True
 
         print("\033[1m> Setting up the agent\033[0m", flush=True)
@@ -366,8 +403,8 @@ class LeaderboardEvaluator(object):
 
             self.agent_instance = agent_class_obj(args.host, args.port, args.debug)
             self.agent_instance.set_global_plan(self.route_scenario.gps_route, self.route_scenario.route)
-            args.agent_config = args.agent_config + '+' + save_name
-            self.agent_instance.setup(args.agent_config)
+            # args.agent_config is not modified, the save name of a route must not carry over to the next one
+            self.agent_instance.setup(args.agent_config + '+' + save_name)
 
             # Check and store the sensors
             if not self.sensors:
@@ -453,6 +490,10 @@ class LeaderboardEvaluator(object):
 
             _, crash_message = FAILURE_MESSAGES["Simulation"]
 
+        # The world of a failed route is not reused
+        if crash_message:
+            self._loaded_town = None
+
         # If the simulation crashed, stop the leaderboard, for the rest, move to the next route
         return crash_message == "Simulation crashed"
 
@@ -460,7 +501,7 @@ class LeaderboardEvaluator(object):
         """
         Run the challenge mode
         """
-        route_indexer = RouteIndexer(args.routes, args.repetitions, args.routes_subset)
+        route_indexer = RouteIndexer(args.routes, args.repetitions, args.routes_subset, args.route_order)
 
         if args.resume:
             resume = route_indexer.validate_and_resume(args.checkpoint)
@@ -504,9 +545,8 @@ class LeaderboardEvaluator(object):
             self.statistics_manager.validate_and_write_statistics(self.sensors_initialized, crashed)
         
         if crashed:
-            cmd2 = "ps -ef | grep '-graphicsadapter="+ str(args.gpu_rank) + "' | grep -v grep | awk '{print $2}' | xargs -r kill -9"
-            server = subprocess.Popen(cmd2, shell=True, preexec_fn=os.setsid)
-            atexit.register(os.killpg, server.pid, signal.SIGKILL)
+            # Only kill the server of this evaluator, other evaluators may run their servers on the same GPU
+            self._kill_server()
 
         return crashed
 
@@ -529,6 +569,10 @@ def main():
                         help='Use CARLA recording feature to create a recording of the scenario')
     parser.add_argument('--timeout', default=600.0, type=float,
                         help='Set the CARLA client timeout value in seconds')
+    parser.add_argument('--startup-timeout', default=600.0, type=float,
+                        help='Maximum time in seconds until the started CARLA server has to be ready')
+    parser.add_argument('--startup-metrics', type=str, default='',
+                        help='jsonl file the startup times of the CARLA server are appended to')
 
     # simulation setup
     parser.add_argument('--routes', required=True,
@@ -537,6 +581,10 @@ def main():
                         help='Execute a specific set of routes')
     parser.add_argument('--repetitions', type=int, default=1,
                         help='Number of repetitions per route.')
+    parser.add_argument('--route-order', type=str, default='file', choices=['file', 'town'],
+                        help='Order of the routes: as in the routes file, or grouped by town (default: file)')
+    parser.add_argument('--reuse-world', type=int, default=0,
+                        help='Soft reset the world instead of reloading it if the next route uses the same town')
 
     # agent-related options
     parser.add_argument("-a", "--agent", type=str,
@@ -46,7 +46,7 @@ from srunner.scenariomanager.timer import RouteTimeoutBehavior
 from leaderboard.utils.route_parser import RouteParser, DIST_THRESHOLD
 from leaderboard.utils.route_manipulation import interpolate_trajectory
 
-import leaderboard.utils.parked_vehicles as parked_vehicles
+from leaderboard.utils.parking_slots import load_town as load_parking_slots
 
 
 class RouteScenario(BasicScenario):
@@ -161,76 +161,53 @@ class RouteScenario(BasicScenario):
         return ego_vehicle
 
     def _get_parking_slots(self, max_distance=100, route_step=10):
-        """Spawn parked vehicles."""
-
-        def is_close(slot_location):
-            for i in range(0, len(self.route), route_step):
-                route_transform = self.route[i][0]
-                if route_transform.location.distance(slot_location) < max_distance:
-                    return True
-            return False
-
-        min_x, min_y = float('inf'), float('inf')
-        max_x, max_y = float('-inf'), float('-inf')
-        for route_transform, _ in self.route:
-            min_x = min(min_x, route_transform.location.x - max_distance)
-            min_y = min(min_y, route_transform.location.y - max_distance)
-            max_x = max(max_x, route_transform.location.x + max_distance)
-            max_y = max(max_y, route_transform.location.y + max_distance)
-
-        # Occupied parking locations
-        occupied_parking_locations = []
-        for scenario in self.list_scenarios:
-            occupied_parking_locations.extend(scenario.get_parking_slots())
-
-        available_parking_locations = []
+        """Selects the parking slots close to the route, see leaderboard/utils/parking_slots.py"""
         map_name = self.map.name.split('/')[-1]
-        available_parking_locations = getattr(parked_vehicles, map_name, [])
-
-        # Exclude parking slots that are too far from the route
-        for slot in available_parking_locations:
-            slot_transform = carla.Transform(
-                location=carla.Location(slot["location"][0], slot["location"][1], slot["location"][2]),
-                rotation=carla.Rotation(slot["rotation"][0], slot["rotation"][1], slot["rotation"][2])
-            )
-
-            in_area = (min_x < slot_transform.location.x < max_x) and (min_y < slot_transform.location.y < max_y)
-            close_to_route = is_close(slot_transform.location)
-            if not in_area or not close_to_route:
-                available_parking_locations.remove(slot)
-                continue
+        self._town_parking_slots = load_parking_slots(map_name)
+        if self._town_parking_slots is None:
+            self.available_parking_locations = np.empty(0, dtype=np.int64)
+            return
 
-        self.available_parking_locations = available_parking_locations
+        route_locations = [(route_transform.location.x, route_transform.location.y, route_transform.location.z)
+                           for route_transform, _ in self.route]
+        # sorted indices of the slots that can still be spawned
+        self.available_parking_locations = np.flatnonzero(
+            self._town_parking_slots.corridor_slots(route_locations, max_distance, route_step))
 
     def spawn_parked_vehicles(self, ego_vehicle, max_scenario_distance=10):
         """Spawn parked vehicles."""
-        def is_close(slot_location, ego_location):
-            return slot_location.distance(ego_location) < self.PARKED_VEHICLES_INIT_THRESHOLD
-        def is_free(slot_location):
-            for occupied_slot in self.occupied_parking_locations:
-                if slot_location.distance(occupied_slot) < max_scenario_distance:
-                    return False
-            return True
-
-        new_parked_vehicles = []
+        if len(self.available_parking_locations) == 0:
+            return
 
         ego_location = CarlaDataProvider.get_location(ego_vehicle)
         if ego_location is None:
             return
 
-        for slot in self.available_parking_locations:
+        slots = self._town_parking_slots
+        spawned = slots.spawn_slots(
+            self.available_parking_locations,
+            (ego_location.x, ego_location.y, ego_location.z),
+            self.PARKED_VEHICLES_INIT_THRESHOLD,
+            [(location.x, location.y, location.z) for location in self.occupied_parking_locations],
+            max_scenario_distance
+        )
+        if len(spawned) == 0:
+            return
+
+        new_parked_vehicles = []
+        blueprint_library = CarlaDataProvider.get_world().get_blueprint_library()
+        for slot in spawned:
+            location = slots.locations[slot]
+            rotation = slots.rotations[slot]
             slot_transform = carla.Transform(
-                location=carla.Location(slot["location"][0], slot["location"][1], slot["location"][2]),
-                rotation=carla.Rotation(slot["rotation"][0], slot["rotation"][1], slot["rotation"][2])
+                location=carla.Location(float(location[0]), float(location[1]), float(location[2])),
+                rotation=carla.Rotation(float(rotation[0]), float(rotation[1]), float(rotation[2]))
             )
-
-            # Add all vehicles that are close to the ego and in a free space
-            if is_close(slot_transform.location, ego_location) and is_free(slot_transform.location):
-                mesh_bp = CarlaDataProvider.get_world().get_blueprint_library().filter("static.prop.mesh")[0]
-                mesh_bp.set_attribute("mesh_path", slot["mesh"])
-                mesh_bp.set_attribute("scale", "0.9")
-                new_parked_vehicles.append(carla.command.SpawnActor(mesh_bp, slot_transform))
-                self.available_parking_locations.remove(slot)
+            mesh_bp = blueprint_library.filter("static.prop.mesh")[0]
+            mesh_bp.set_attribute("mesh_path", slots.meshes[slots.mesh_ids[slot]])
+            mesh_bp.set_attribute("scale", "0.9")
+            new_parked_vehicles.append(carla.command.SpawnActor(mesh_bp, slot_transform))
+        self.available_parking_locations = np.setdiff1d(self.available_parking_locations, spawned, assume_unique=True)
 
         # Add the actors to _parked_ids
         for response in CarlaDataProvider.get_client().apply_batch_sync(new_parked_vehicles):
@@ -486,6 +463,14 @@ class RouteScenario(BasicScenario):
         criteria_tree.add_child(Idle())  # Avoid the indiviual criteria stopping the simulation
         return criteria_tree
 
+    def remove_parked_vehicles(self):
+        """
+        Synchronously destroys the parked vehicles, so that a reused world does not keep them
+        """
+        if self._parked_ids:
+            self.client.apply_batch_sync([carla.command.DestroyActor(x) for x in self._parked_ids])
+            self._parked_ids = []
+
     def __del__(self):
         """
         Remove all actors upon deletion
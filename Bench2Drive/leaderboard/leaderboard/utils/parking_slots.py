@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+"""
+Parking slots of the large maps, stored as numpy arrays per town (parking_slots_data/<town>.npz) with a
+uniform grid index for the spatial queries of RouteScenario.
+
+The slots used to be a 13k line python literal (parked_vehicles.py) that was imported with route_scenario.py and
+scanned completely for the route corridor and on every tick. The arrays of a town are only loaded when a route of
+that town is set up, and the queries only look at the grid cells around the query point.
+
+Distances are computed in float32 like carla.Location.distance, so the selected slots are the same as with the
+carla objects.
+
+Convert a python literal file (lists of dicts named like the towns) with:
+    python leaderboard/utils/parking_slots.py --source path/to/parked_vehicles.py
+"""
+
+from __future__ import print_function
+
+import argparse
+import ast
+import os
+
+import numpy as np
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'parking_slots_data')
+GRID_CELL_SIZE = 100.0
+
+_TOWN_SLOTS = {}
+
+
+class GridIndex(object):
+    """Uniform grid over the xy positions, each cell holds the sorted indices of its points"""
+
+    def __init__(self, xy, cell_size=GRID_CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells = {}
+        if len(xy) == 0:
+            return
+        cells = np.floor(xy / cell_size).astype(np.int64)
+        order = np.lexsort((np.arange(len(xy)), cells[:, 1], cells[:, 0]))
+        sorted_cells = cells[order]
+        boundaries = np.flatnonzero(np.any(sorted_cells[1:] != sorted_cells[:-1], axis=1)) + 1
+        for group in np.split(order, boundaries):
+            cx, cy = cells[group[0]]
+            self.cells[(int(cx), int(cy))] = group
+
+    def query_box(self, min_x, min_y, max_x, max_y):
+        """Sorted indices of the points in the cells overlapping the box (a superset of the points in the box)"""
+        cx0, cy0 = int(np.floor(min_x / self.cell_size)), int(np.floor(min_y / self.cell_size))
+        cx1, cy1 = int(np.floor(max_x / self.cell_size)), int(np.floor(max_y / self.cell_size))
+        if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > len(self.cells):
+            groups = [group for (cx, cy), group in self.cells.items() if cx0 <= cx <= cx1 and cy0 <= cy <= cy1]
+        else:
+            groups = [self.cells[(cx, cy)] for cx in range(cx0, cx1 + 1) for cy in range(cy0, cy1 + 1) if (cx, cy) in self.cells]
+        if len(groups) == 0:
+            return np.empty(0, dtype=np.int64)
+        return np.sort(np.concatenate(groups))
+
+
+class TownParkingSlots(object):
+    """Positions, rotations (pitch, yaw, roll) and meshes of the parking slots of one town"""
+
+    def __init__(self, locations, rotations, mesh_ids, meshes, tiles):
+        self.locations = locations.astype(np.float32)
+        self.rotations = rotations.astype(np.float32)
+        self.mesh_ids = mesh_ids
+        self.meshes = [str(mesh) for mesh in meshes]
+        self.tiles = tiles
+        self.index = GridIndex(self.locations[:, :2].astype(np.float64))
+
+    def __len__(self):
+        return len(self.locations)
+
+    def distances(self, indices, location):
+        """float32 3D distances of the slots to location (x, y, z), like carla.Location.distance"""
+        diff = self.locations[indices] - np.asarray(location, dtype=np.float32)
+        return np.sqrt(diff[:, 0] * diff[:, 0] + diff[:, 1] * diff[:, 1] + diff[:, 2] * diff[:, 2])
+
+    def query_radius(self, location, radius, candidates=None):
+        """Sorted indices of the slots closer than radius to location (strict, 3D)"""
+        indices = self.index.query_box(location[0] - radius, location[1] - radius, location[0] + radius, location[1] + radius)
+        if candidates is not None:
+            indices = indices[candidates[indices]]
+        return indices[self.distances(indices, location) < radius]
+
+    def corridor_slots(self, route_locations, max_distance=100, route_step=10):
+        """
+        The slots RouteScenario keeps for a route: slots in the bounding box of the route (+ max_distance) and
+        closer than max_distance to any route_step'th route point. As before, the slot following a removed one
+        is kept without being checked (the former filter removed from the list it iterated over).
+        Returns a boolean mask over all slots.
+        """
+        route_locations = np.asarray(route_locations, dtype=np.float32)
+        route_xy = route_locations[:, :2].astype(np.float64)
+        min_x, min_y = route_xy.min(axis=0) - max_distance
+        max_x, max_y = route_xy.max(axis=0) + max_distance
+
+        in_area = self.index.query_box(min_x, min_y, max_x, max_y)
+        x = self.locations[in_area, 0].astype(np.float64)
+        y = self.locations[in_area, 1].astype(np.float64)
+        in_area = in_area[(min_x < x) & (x < max_x) & (min_y < y) & (y < max_y)]
+
+        passes = np.zeros(len(self), dtype=bool)
+        candidates = np.zeros(len(self), dtype=bool)
+        candidates[in_area] = True
+        for route_location in route_locations[::route_step]:
+            passes[self.query_radius(route_location, max_distance, candidates)] = True
+
+        keep = passes.copy()
+        # a failed slot is removed and the iteration skips the next slot, which therefore stays
+        failed = np.flatnonzero(~passes)
+        next_check = 0
+        for i in failed:
+            if i < next_check:
+                continue
+            if i + 1 < len(self):
+                keep[i + 1] = True
+            next_check = i + 2
+        return keep
+
+    def spawn_slots(self, available, location, radius, occupied_locations, max_scenario_distance):
+        """
+        The slots RouteScenario spawns this tick: available slots closer than radius to location and not closer
+        than max_scenario_distance to a slot occupied by a scenario. available are the sorted indices of the
+        slots not spawned yet. As before, the available slot following a spawned one is skipped until the next
+        tick (the former loop removed from the list it iterated over).
+        """
+        if len(available) == 0:
+            return []
+        candidates = np.zeros(len(self), dtype=bool)
+        candidates[available] = True
+        close_slots = self.query_radius(location, radius, candidates)
+
+        is_free = np.ones(len(close_slots), dtype=bool)
+        for occupied_location in occupied_locations:
+            is_free &= ~(self.distances(close_slots, occupied_location) < max_scenario_distance)
+
+        positions = np.searchsorted(available, close_slots)
+        spawned = []
+        skipped_slot = -1
+        for slot, position, free in zip(close_slots, positions, is_free):
+            if slot == skipped_slot or not free:
+                continue
+            spawned.append(int(slot))
+            if position + 1 < len(available):
+                skipped_slot = available[position + 1]
+        return spawned
+
+
+def load_town(town):
+    """The parking slots of town (None if the town has none), loaded once per process"""
+    if town not in _TOWN_SLOTS:
+        path = os.path.join(DATA_DIR, '{}.npz'.format(town))
+        if os.path.exists(path):
+            with np.load(path, allow_pickle=False) as data:
+                _TOWN_SLOTS[town] = TownParkingSlots(data['locations'], data['rotations'], data['mesh_ids'],
+                                                     data['meshes'], data['tiles'])
+        else:
+            _TOWN_SLOTS[town] = None
+    return _TOWN_SLOTS[town]
+
+
+def convert(source, output_dir=DATA_DIR):
+    """Writes <town>.npz for every list of slots in the python literal file source"""
+    with open(source, 'r') as f:
+        tree = ast.parse(f.read())
+
+    os.makedirs(output_dir, exist_ok=True)
+    for node in tree.body:
+        if not isinstance(node, ast.Assign) or len(node.targets) != 1 or not isinstance(node.targets[0], ast.Name):
+            continue
+        town = node.targets[0].id
+        slots = ast.literal_eval(node.value)
+
+        meshes = list(dict.fromkeys(slot['mesh'] for slot in slots))
+        mesh_to_id = {mesh: i for i, mesh in enumerate(meshes)}
+        np.savez_compressed(
+            os.path.join(output_dir, '{}.npz'.format(town)),
+            locations=np.array([slot['location'] for slot in slots], dtype=np.float32).reshape(-1, 3),
+            rotations=np.array([slot['rotation'] for slot in slots], dtype=np.float32).reshape(-1, 3),
+            mesh_ids=np.array([mesh_to_id[slot['mesh']] for slot in slots], dtype=np.int32),
+            meshes=np.array(meshes, dtype=np.str_),
+            tiles=np.array([(slot['tilex'], slot['tiley']) for slot in slots], dtype=np.int32).reshape(-1, 2),
+        )
+        print('{}: {} slots, {} meshes'.format(town, len(slots), len(meshes)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert the parking slots of a python literal file to npz files')
+    parser.add_argument('--source', required=True, help='python file with one list of slot dicts per town')
+    parser.add_argument('--output-dir', default=DATA_DIR)
+    args = parser.parse_args()
+    convert(args.source, args.output_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,7 +8,7 @@ from leaderboard.utils.checkpoint_tools import fetch_dict
 
 
 class RouteIndexer():
-    def __init__(self, routes_file, repetitions, routes_subset):
+    def __init__(self, routes_file, repetitions, routes_subset, route_order='file'):
         self._configs_dict = OrderedDict()
         self._configs_list = []
         self.index = 0
@@ -24,6 +24,21 @@ class RouteIndexer():
 
         self._configs_list = list(self._configs_dict.values())
 
+        if route_order == 'town':
+            self._group_by_town()
+        elif route_order != 'file':
+            raise ValueError("Unknown route order {}".format(route_order))
+
+    def _group_by_town(self):
+        """
+        Runs the routes of the same town one after another, so the world only has to be loaded once per town.
+        The order is deterministic (towns by name, file order within a town), so resuming from a checkpoint
+        gives the same order. The indices are the positions in the new order, the records of the checkpoint
+        are written in that order.
+        """
+        self._configs_list = sorted(self._configs_list, key=lambda config: str(config.town))
+        for index, config in enumerate(self._configs_list):
+            config.index = index
 
     def peek(self):
         return self.index < self.total
@@ -0,0 +1,153 @@
+"""
+Readiness checks for the CARLA server started by the leaderboard evaluator.
+
+Instead of sleeping a fixed time after starting CarlaUE4.sh, the evaluator probes the ports of the server with
+exponential backoff until they are ready or an overall deadline has passed. Independent probes (RPC port,
+streaming port, traffic manager port) run in parallel. The time to readiness of every step is collected in
+StartupMetrics and appended to a jsonl file.
+
+A probe only needs a name and a check() method, so the logic can be tested against a local fake server (any TCP
+listener) without CARLA.
+"""
+import json
+import os
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ReadinessProbe(object):
+    """Interface of the probes: check() returns True once the probed service is ready (exceptions count as not ready)."""
+
+    name = "probe"
+
+    def check(self):
+        raise NotImplementedError
+
+
+class TCPPortProbe(ReadinessProbe):
+    """Ready once a TCP connection to host:port is accepted (RPC and streaming port of the server)."""
+
+    def __init__(self, host, port, name=None, connect_timeout=1.0):
+        self.host = host
+        self.port = port
+        self.name = name or "tcp:{}".format(port)
+        self.connect_timeout = connect_timeout
+
+    def check(self):
+        with socket.create_connection((self.host, self.port), timeout=self.connect_timeout):
+            return True
+
+
+class FreePortProbe(ReadinessProbe):
+    """Ready once nothing listens on the port anymore (e.g. the traffic manager port of a previous server)."""
+
+    def __init__(self, port, host="localhost", name=None):
+        self.host = host
+        self.port = port
+        self.name = name or "free:{}".format(port)
+
+    def check(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.bind((self.host, self.port))
+        return True
+
+
+class CallableProbe(ReadinessProbe):
+    """Ready once fn() returns without an exception (and not False), the result is kept in self.result."""
+
+    def __init__(self, name, fn):
+        self.name = name
+        self.fn = fn
+        self.result = None
+
+    def check(self):
+        result = self.fn()
+        if result is False:
+            return False
+        self.result = result
+        return True
+
+
+class ServerDiedError(RuntimeError):
+    pass
+
+
+class StartupTimeoutError(RuntimeError):
+    pass
+
+
+def wait_until_ready(probe, deadline, initial_delay=0.2, max_delay=5.0, backoff=2.0, alive_fn=None, verbose=True):
+    """
+    Calls probe.check() until it returns True, with exponentially growing pauses between the attempts.
+    deadline is an absolute time.monotonic() value. alive_fn (e.g. the poll of the server process) is checked
+    before every attempt, so a crashed server fails immediately instead of at the deadline.
+    Returns (seconds until ready, number of attempts).
+    """
+    start = time.monotonic()
+    delay = initial_delay
+    attempts = 0
+    last_error = None
+    while True:
+        if alive_fn is not None and not alive_fn():
+            raise ServerDiedError("The server died while waiting for {}".format(probe.name))
+        attempts += 1
+        try:
+            if probe.check():
+                elapsed = time.monotonic() - start
+                if verbose:
+                    print("{} ready after {:.1f}s ({} attempts)".format(probe.name, elapsed, attempts), flush=True)
+                return elapsed, attempts
+        except Exception as e:  # pylint: disable=broad-except
+            last_error = e
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise StartupTimeoutError("{} not ready after {:.1f}s ({} attempts), last error: {}".format(
+                probe.name, time.monotonic() - start, attempts, last_error))
+        time.sleep(min(delay, remaining))
+        delay = min(delay * backoff, max_delay)
+
+
+def wait_until_all_ready(probes, deadline, **kwargs):
+    """Runs wait_until_ready for all probes in parallel, returns {name: (seconds until ready, attempts)}."""
+    if len(probes) == 0:
+        return {}
+    with ThreadPoolExecutor(max_workers=len(probes)) as executor:
+        futures = {probe.name: executor.submit(wait_until_ready, probe, deadline, **kwargs) for probe in probes}
+        return {name: future.result() for name, future in futures.items()}
+
+
+class StartupMetrics(object):
+    """Durations (seconds) and attempts of the startup steps of one server start."""
+
+    def __init__(self, port, traffic_manager_port=None):
+        self.port = port
+        self.traffic_manager_port = traffic_manager_port
+        self.start = time.monotonic()
+        self.steps = {}
+
+    def add(self, name, seconds, attempts=1):
+        self.steps[name] = {"seconds": round(seconds, 3), "attempts": attempts}
+
+    def add_all(self, results):
+        for name, (seconds, attempts) in results.items():
+            self.add(name, seconds, attempts)
+
+    def to_dict(self):
+        return {
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "port": self.port,
+            "traffic_manager_port": self.traffic_manager_port,
+            "total_seconds": round(time.monotonic() - self.start, 3),
+            "steps": self.steps,
+        }
+
+    def write(self, path):
+        record = self.to_dict()
+        print("Simulator startup: {}".format(json.dumps(record)), flush=True)
+        if path:
+            directory = os.path.dirname(os.path.abspath(path))
+            os.makedirs(directory, exist_ok=True)
+            with open(path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+        return record
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+"""
+Microbenchmark of the sensor data path of the leaderboard (CallBack parsing + SensorInterface.get_data).
+
+Synthetic byte buffers stand in for the CARLA measurements: one thread per sensor delivers the measurement of
+every frame, the main thread waits for the complete frame like the agent wrapper does on every tick. The former
+SensorInterface (one shared Queue, stale entries dropped one by one) is measured for comparison, both use the
+same CallBack.
+Runs in the leaderboard environment (the carla module has to be importable), no CARLA server is needed.
+
+    python scripts/benchmark_sensor_interface.py --cameras 2 --width 1024 --height 512 --frames 500
+"""
+
+from __future__ import print_function
+
+import argparse
+import threading
+import time
+from queue import Empty, Queue
+
+import numpy as np
+
+from leaderboard.envs.sensor_interface import CallBack, SensorInterface, SensorReceivedNoData
+
+
+class FakeImage(object):
+    def __init__(self, raw_data, width, height, frame):
+        self.raw_data = raw_data
+        self.width = width
+        self.height = height
+        self.frame = frame
+
+
+class FakeLidar(object):
+    def __init__(self, raw_data, frame):
+        self.raw_data = raw_data
+        self.frame = frame
+
+
+class LegacySensorInterface(object):
+    """The former implementation: one Queue for all sensors, stale entries are dropped one by one"""
+
+    def __init__(self):
+        self._sensors_objects = {}
+        self._data_buffers = Queue()
+        self._queue_timeout = 300
+
+    def register_sensor(self, tag, sensor_type, sensor):
+        self._sensors_objects[tag] = sensor
+
+    def update_sensor(self, tag, data, frame):
+        self._data_buffers.put((tag, frame, data))
+
+    def get_data(self, frame):
+        try:
+            data_dict = {}
+            while len(data_dict.keys()) < len(self._sensors_objects.keys()):
+                sensor_data = self._data_buffers.get(True, self._queue_timeout)
+                if sensor_data[1] != frame:
+                    continue
+                data_dict[sensor_data[0]] = ((sensor_data[1], sensor_data[2]))
+        except Empty:
+            raise SensorReceivedNoData("A sensor took too long to send their data")
+        return data_dict
+
+
+def run(interface_class, args):
+    interface = interface_class()
+    rng = np.random.default_rng(0)
+    image_bytes = [rng.integers(0, 255, args.height * args.width * 4, dtype=np.uint8).tobytes() for _ in range(2)]
+    lidar_bytes = [rng.random(args.lidar_points * 4, dtype=np.float32).tobytes() for _ in range(2)]
+
+    sensors = []
+    for i in range(args.cameras):
+        callback = CallBack('rgb_{}'.format(i), 'sensor.camera.rgb', None, interface)
+        sensors.append((callback, lambda frame: FakeImage(image_bytes[frame % 2], args.width, args.height, frame),
+                        callback._parse_image_cb, 'rgb_{}'.format(i)))
+    for i in range(args.lidars):
+        callback = CallBack('lidar_{}'.format(i), 'sensor.lidar.ray_cast', None, interface)
+        sensors.append((callback, lambda frame: FakeLidar(lidar_bytes[frame % 2], frame),
+                        callback._parse_lidar_cb, 'lidar_{}'.format(i)))
+
+    callback_seconds = [0.0] * len(sensors)
+    tick = [threading.Event() for _ in sensors]
+    stop = threading.Event()
+
+    def producer(index, make_measurement, parse, tag):
+        frame = 0
+        while True:
+            tick[index].wait()
+            tick[index].clear()
+            if stop.is_set():
+                return
+            measurement = make_measurement(frame)
+            start = time.perf_counter()
+            parse(measurement, tag)
+            callback_seconds[index] += time.perf_counter() - start
+            frame += 1
+
+    threads = [threading.Thread(target=producer, args=(i, make, parse, tag), daemon=True)
+               for i, (_, make, parse, tag) in enumerate(sensors)]
+    for thread in threads:
+        thread.start()
+
+    start = time.perf_counter()
+    for frame in range(args.frames):
+        for event in tick:
+            event.set()
+        data = interface.get_data(frame)
+        assert len(data) == len(sensors)
+    total = time.perf_counter() - start
+
+    stop.set()
+    for event in tick:
+        event.set()
+    for thread in threads:
+        thread.join()
+
+    return {
+        'frames_per_second': args.frames / total,
+        'ms_per_frame': 1000.0 * total / args.frames,
+        'callback_ms_per_frame': 1000.0 * sum(callback_seconds) / args.frames,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--cameras', type=int, default=2)
+    parser.add_argument('--width', type=int, default=1024)
+    parser.add_argument('--height', type=int, default=512)
+    parser.add_argument('--lidars', type=int, default=0)
+    parser.add_argument('--lidar-points', type=int, default=60000)
+    parser.add_argument('--frames', type=int, default=500)
+    args = parser.parse_args()
+
+    for name, interface_class in [('legacy (shared queue)', LegacySensorInterface),
+                                  ('frame slots', SensorInterface)]:
+        results = run(interface_class, args)
+        print('{:35s} {:8.1f} frames/s  {:7.3f} ms/frame  {:7.3f} ms/frame in callbacks'.format(
+            name, results['frames_per_second'], results['ms_per_frame'], results['callback_ms_per_frame']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+import time
+
+from pytorch_lightning import Callback, LightningModule, Trainer
+
+
+class StageTimingCallback(Callback):
+    """
+    Logs percentiles of the data pipeline stage timings (utils/stage_timer.py) every log_every_n_steps steps.
+
+    Besides the dataset and collate stages it records data_wait (end of a training step until the next batch is
+    available) and train_step (forward, backward and optimizer step). A high data_wait means the run is bound by
+    the data loading, the dataset stages then show whether it is the I/O (measurements, image_decode) or the CPU.
+    """
+
+    def __init__(self, log_every_n_steps: int = 100):
+        super().__init__()
+        self.log_every_n_steps = log_every_n_steps
+        self.last_batch_end = None
+        self.batch_start = None
+
+    @staticmethod
+    def _stage_timer(trainer: Trainer):
+        datamodule = getattr(trainer, 'datamodule', None)
+        return getattr(datamodule, 'stage_timer', None)
+
+    def on_train_epoch_start(self, trainer: Trainer, pl_module: LightningModule) -> None:
+        # the first batch of an epoch also waits for the workers to start
+        self.last_batch_end = None
+
+    def on_train_batch_start(self, trainer: Trainer, pl_module: LightningModule, batch, batch_idx: int) -> None:
+        stage_timer = self._stage_timer(trainer)
+        self.batch_start = time.perf_counter()
+        if stage_timer is not None and self.last_batch_end is not None:
+            stage_timer.record('data_wait', self.batch_start - self.last_batch_end)
+
+    def on_train_batch_end(self, trainer: Trainer, pl_module: LightningModule, outputs, batch, batch_idx: int) -> None:
+        stage_timer = self._stage_timer(trainer)
+        if stage_timer is None:
+            return
+        self.last_batch_end = time.perf_counter()
+        stage_timer.record('train_step', self.last_batch_end - self.batch_start)
+
+        if trainer.global_step % self.log_every_n_steps != 0 or batch_idx % trainer.accumulate_grad_batches != 0:
+            return
+        metrics = {f'timing/{key}_ms' if not key.endswith('_count') else f'timing/{key}': value
+                   for key, value in stage_timer.summary().items()}
+        if len(metrics) == 0:
+            return
+        for logger in trainer.loggers:
+            logger.log_metrics(metrics, step=trainer.global_step)
@@ -9,6 +9,8 @@ class VLMEncoderConfig:
     variant: str = 'OpenGVLab/InternVL2-1B'
     embed_dim: int = 512
     freeze: bool = False
+    # False: empty weights, loaded from an inference checkpoint
+    pretrained: bool = True
 
     _target_: str = "simlingo_training.models.encoder.vlm.VLMEncoderModel"
 
@@ -20,6 +22,7 @@ class LanguageModelConfig:
     lora_alpha: int = 64
     lora_r: int = 32
     lora_dropout: float = 0.1
+    pretrained: bool = True
 
     _target_: str = "simlingo_training.models.language_model.llm.LLM"
 
@@ -45,6 +48,16 @@ class DatasetBaseConfig:
     data_path: str = "/home/katrinrenz/coding/wayve_carla/database/expertv3_2*"
     bucket_path: str = "data/buckets"
 
+    # persistent index of routes, filter outcomes and frame counts (relative to the repo root)
+    use_sample_index: bool = True
+    sample_index_path: str = "data/sample_index"
+    # json: read measurements/*.json.gz, packed: require measurements_packed.bin (see measurement_store.py),
+    # auto: use measurements_packed.bin where it is up to date and fall back to json otherwise
+    measurement_backend: str = "auto"
+    # folder written by dataloader/prebake.py, if set the training set is streamed from the pre-baked shards
+    prebaked_path: Optional[str] = None
+    prebaked_shuffle_buffer: int = 256
+
     cut_bottom_quarter: bool = False
     use_1d_wps: bool = False
 
@@ -63,6 +76,10 @@ class DatasetBaseConfig:
     
     img_augmentation: bool = True
     img_augmentation_prob: float = 0.5
+    # imgaug: per image in the dataset workers, torch: batched BatchImageAugmenter (see augmentation.py)
+    img_augmentation_backend: str = "imgaug"
+    # only for the torch backend, cpu: in the collate, cuda: on the training device after the batch transfer
+    img_augmentation_device: str = "cpu"
     img_shift_augmentation: bool = True
     img_shift_augmentation_prob: float = 0.5
     
@@ -109,6 +126,14 @@ class DrivingDataModuleConfig:
     train_partitions: Optional[Dict[str, float]] = None
     train_partitions_dreamer: Optional[Dict[str, float]] = None
     use_global_img: bool = False
+    # "pil": per image PIL dynamic_preprocess, "tensor": batched torch resize/tiling/normalization
+    # (within one uint8 level of "pil", see simlingo_training/tests/test_image_preprocessing.py)
+    image_preprocessing: str = "pil"
+    # time the stages of the datasets and the collate in all workers, logged as percentiles (see utils/stage_timer.py)
+    stage_timing: bool = False
+    stage_timing_log_every_n_steps: int = 100
+    # > 1: load this many batches at once and batch samples with similar conversation length (see length_grouping.py)
+    length_group_factor: int = 1
     
     _target_: str = "simlingo_training.dataloader.datamodule.DataModule"
 
@@ -0,0 +1,247 @@
+"""
+Batched torch version of the imgaug colour augmentation of BaseDataset (image_augmenter).
+
+imgaug runs per HxWx3 numpy image inside the data loader workers and is one of the largest CPU costs per sample.
+BatchImageAugmenter applies the same families (gaussian blur, additive gaussian noise, dropout, multiply,
+linear contrast, grayscale, elastic transformation and optional cutout) with the same parameter ranges to a whole
+[B, C, H, W] batch with vectorized ops. Every augmentation is applied with probability prob and its parameters are
+drawn per sample (and per channel where imgaug uses per_channel=0.5). It runs on the device of the input, so it
+can be used in the collate (CPU) or on the training device.
+
+On already tiled images (the InternVL tiles and thumbnail of a frame) pass groups, the index of the sample of every
+tile: all parameters (probabilities, strengths, per channel values) are then drawn once per sample and shared by its
+tiles. Only the per pixel fields (noise, dropout mask, elastic displacement) are drawn per tile.
+
+imgaug applies the augmentations in a random order per image, here one random order is drawn per batch.
+
+Compare the output statistics with the imgaug pipeline (or a single augmentation) with:
+    python -m simlingo_training.dataloader.augmentation --num_batches 20 [--augmentation gaussian_blur]
+The per augmentation comparison is tested in simlingo_training/tests/test_augmentation.py.
+"""
+import argparse
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+# same order as the augmentations of image_augmenter in dataset_base.py
+AUGMENTATIONS = ['gaussian_blur', 'additive_gaussian_noise', 'dropout', 'multiply', 'linear_contrast', 'grayscale',
+                 'elastic_transformation', 'cutout_boxes']
+
+
+class BatchImageAugmenter:
+    """Callable on [B, C, H, W] uint8 (or float in [0, 255]) images, returns uint8 images of the same shape."""
+
+    def __init__(self, prob=0.2, cutout=False, seed=None, augmentations=None):
+        self.prob = prob
+        self.cutout = cutout
+        self.generator = None
+        self.seed = seed
+        # sample index per image during __call__, None: every image is its own sample
+        self.groups = None
+        # augmentations: subset of AUGMENTATIONS (names), all of them if None
+        names = AUGMENTATIONS if cutout else AUGMENTATIONS[:-1]
+        if augmentations is not None:
+            names = [name for name in names if name in augmentations]
+        self.augmentations = [getattr(self, name) for name in names]
+
+    def _generator(self, device):
+        # one generator per device, seeded once so the stream of parameters is reproducible
+        if self.generator is None or self.generator.device != device:
+            self.generator = torch.Generator(device=device)
+            if self.seed is not None:
+                self.generator.manual_seed(self.seed)
+            else:
+                self.generator.seed()
+        return self.generator
+
+    def _rand(self, shape, images):
+        # per sample values, expanded to the images (tiles) of each sample
+        if self.groups is None:
+            return torch.rand(shape, generator=self.generator, device=images.device)
+        num_samples = int(self.groups.max()) + 1
+        return torch.rand((num_samples, *shape[1:]), generator=self.generator, device=images.device)[self.groups]
+
+    def _uniform(self, shape, low, high, images):
+        return self._rand(shape, images) * (high - low) + low
+
+    def _sometimes(self, images):
+        return self._rand((images.size(0),), images) < self.prob
+
+    def _per_channel(self, images, low, high):
+        # per_channel=0.5: half of the samples get one value per channel, the others one value for all channels
+        B, C = images.shape[:2]
+        values = self._uniform((B, C), low, high, images)
+        shared = self._uniform((B, 1), 0, 1, images) >= 0.5
+        values = torch.where(shared, values[:, :1].expand(B, C), values)
+        return values.view(B, C, 1, 1)
+
+    def gaussian_blur(self, images, active):
+        # ia.GaussianBlur((0, 1.0)), separable kernel with a per sample sigma
+        B, C, H, W = images.shape
+        sigma = self._uniform((B,), 0.0, 1.0, images).clamp(min=1e-3)
+        radius = 3
+        x = torch.arange(-radius, radius + 1, device=images.device, dtype=images.dtype)
+        kernel = torch.exp(-(x.view(1, -1) ** 2) / (2 * sigma.view(-1, 1) ** 2))
+        kernel = kernel / kernel.sum(dim=1, keepdim=True)
+        kernel = kernel.repeat_interleave(C, dim=0)  # [B * C, K]
+
+        flat = images.reshape(1, B * C, H, W)
+        flat = F.conv2d(F.pad(flat, (radius, radius, 0, 0), mode='reflect'), kernel.view(B * C, 1, 1, -1), groups=B * C)
+        flat = F.conv2d(F.pad(flat, (0, 0, radius, radius), mode='reflect'), kernel.view(B * C, 1, -1, 1), groups=B * C)
+        blurred = flat.view(B, C, H, W)
+        return torch.where(active.view(B, 1, 1, 1), blurred, images)
+
+    def additive_gaussian_noise(self, images, active):
+        # ia.AdditiveGaussianNoise(loc=0, scale=(0., 0.05 * 255), per_channel=0.5)
+        B, C, H, W = images.shape
+        scale = self._uniform((B, 1, 1, 1), 0.0, 0.05 * 255, images)
+        noise = torch.randn((B, C, H, W), generator=self.generator, device=images.device)
+        shared = (self._uniform((B, 1, 1, 1), 0, 1, images) >= 0.5)
+        noise = torch.where(shared, noise[:, :1].expand(B, C, H, W), noise)
+        return torch.where(active.view(B, 1, 1, 1), images + noise * scale, images)
+
+    def dropout(self, images, active):
+        # ia.Dropout((0.01, 0.1), per_channel=0.5)
+        B, C, H, W = images.shape
+        p = self._uniform((B, 1, 1, 1), 0.01, 0.1, images)
+        drop = torch.rand((B, C, H, W), generator=self.generator, device=images.device) < p
+        shared = (self._uniform((B, 1, 1, 1), 0, 1, images) >= 0.5)
+        drop = torch.where(shared, drop[:, :1].expand(B, C, H, W), drop)
+        return torch.where(active.view(B, 1, 1, 1) & drop, torch.zeros_like(images), images)
+
+    def multiply(self, images, active):
+        # ia.Multiply((1 / 1.2, 1.2), per_channel=0.5)
+        factor = self._per_channel(images, 1 / 1.2, 1.2)
+        return torch.where(active.view(-1, 1, 1, 1), images * factor, images)
+
+    def linear_contrast(self, images, active):
+        # ia.LinearContrast((1 / 1.2, 1.2), per_channel=0.5), around the center of the uint8 range
+        alpha = self._per_channel(images, 1 / 1.2, 1.2)
+        return torch.where(active.view(-1, 1, 1, 1), 127.5 + alpha * (images - 127.5), images)
+
+    def grayscale(self, images, active):
+        # ia.Grayscale((0.0, 0.5)), blend with the luminance (same weights as cv2 RGB2GRAY)
+        B = images.size(0)
+        alpha = self._uniform((B, 1, 1, 1), 0.0, 0.5, images)
+        weights = torch.tensor([0.299, 0.587, 0.114], device=images.device, dtype=images.dtype).view(1, 3, 1, 1)
+        gray = (images * weights).sum(dim=1, keepdim=True)
+        return torch.where(active.view(B, 1, 1, 1), (1 - alpha) * images + alpha * gray, images)
+
+    def elastic_transformation(self, images, active):
+        # ia.ElasticTransformation(alpha=(0.5, 1.5), sigma=0.25): with sigma 0.25 the displacement field is
+        # practically unsmoothed, every pixel is moved by up to alpha pixels
+        B, C, H, W = images.shape
+        if not active.any():
+            return images
+        alpha = self._uniform((B, 1, 1, 1), 0.5, 1.5, images)
+        displacement = (torch.rand((B, H, W, 2), generator=self.generator, device=images.device) * 2 - 1) * alpha.view(B, 1, 1, 1)
+        ys, xs = torch.meshgrid(torch.arange(H, device=images.device), torch.arange(W, device=images.device), indexing='ij')
+        grid_x = (xs.unsqueeze(0) + displacement[..., 0]) / (W - 1) * 2 - 1
+        grid_y = (ys.unsqueeze(0) + displacement[..., 1]) / (H - 1) * 2 - 1
+        grid = torch.stack((grid_x, grid_y), dim=-1).to(images.dtype)
+        warped = F.grid_sample(images, grid, mode='bilinear', padding_mode='reflection', align_corners=True)
+        return torch.where(active.view(B, 1, 1, 1), warped, images)
+
+    def cutout_boxes(self, images, active):
+        # ia.arithmetic.Cutout(squared=False): one box of 20% of the image size, filled with 128
+        B, C, H, W = images.shape
+        box_h, box_w = max(1, int(round(0.2 * H))), max(1, int(round(0.2 * W)))
+        center_y = self._uniform((B, 1, 1), 0, 1, images) * H
+        center_x = self._uniform((B, 1, 1), 0, 1, images) * W
+        ys = torch.arange(H, device=images.device).view(1, H, 1)
+        xs = torch.arange(W, device=images.device).view(1, 1, W)
+        inside = ((ys - center_y).abs() < box_h / 2) & ((xs - center_x).abs() < box_w / 2)
+        inside = inside.unsqueeze(1) & active.view(B, 1, 1, 1)
+        return torch.where(inside, torch.full_like(images, 128.0), images)
+
+    @torch.no_grad()
+    def __call__(self, images, groups=None):
+        # groups: [B] sample index (0 .. num_samples - 1) of every image, see the module docstring
+        self._generator(images.device)
+        self.groups = None if groups is None else groups.to(images.device)
+        images = images.float()
+        order = torch.randperm(len(self.augmentations), generator=self.generator, device=images.device).tolist()
+        try:
+            for i in order:
+                images = self.augmentations[i](images, self._sometimes(images))
+        finally:
+            self.groups = None
+        return images.round_().clamp_(0, 255).to(torch.uint8)
+
+
+def image_statistics(images):
+    """Per image statistics that the augmentations change: mean, std, gradient energy and saturation per image."""
+    images = images.float()
+    gray = images.mean(dim=1)
+    gradient = (gray[:, 1:, :] - gray[:, :-1, :]).abs().mean(dim=(1, 2)) + (gray[:, :, 1:] - gray[:, :, :-1]).abs().mean(dim=(1, 2))
+    saturation = (images.max(dim=1).values - images.min(dim=1).values).mean(dim=(1, 2))
+    return {
+        'mean': images.mean(dim=(1, 2, 3)),
+        'std': images.std(dim=(1, 2, 3)),
+        'gradient': gradient,
+        'saturation': saturation,
+    }
+
+
+def compare_with_imgaug(images, num_batches=20, prob=0.5, cutout=False, device='cpu', augmentation=None):
+    """
+    Statistical comparison of BatchImageAugmenter with image_augmenter (imgaug), of the full pipeline or of one
+    augmentation (a name of AUGMENTATIONS, applied to every image).
+    Both pipelines augment the same images num_batches times, the distributions of per image statistics are
+    compared with the two sample Kolmogorov-Smirnov statistic (0 = identical distributions).
+    """
+    from scipy.stats import ks_2samp
+    from simlingo_training.dataloader.dataset_base import image_augmenter
+
+    if augmentation is None:
+        reference = image_augmenter(prob=prob, cutout=cutout)
+        augmenter = BatchImageAugmenter(prob=prob, cutout=cutout, seed=0)
+    else:
+        # the Sometimes(1.0, ...) of the augmentation in the imgaug pipeline
+        reference = image_augmenter(prob=1.0, cutout=True)[AUGMENTATIONS.index(augmentation)]
+        augmenter = BatchImageAugmenter(prob=1.0, cutout=True, seed=0, augmentations=[augmentation])
+
+    stats_imgaug, stats_torch = {}, {}
+    images_hwc = [np.ascontiguousarray(image.permute(1, 2, 0).numpy()) for image in images]
+    for _ in range(num_batches):
+        out_imgaug = torch.from_numpy(np.stack([reference(image=image) for image in images_hwc])).permute(0, 3, 1, 2)
+        out_torch = augmenter(images.to(device)).cpu()
+        for stats, out in [(stats_imgaug, out_imgaug), (stats_torch, out_torch)]:
+            for key, value in image_statistics(out).items():
+                stats.setdefault(key, []).append(value)
+
+    result = {}
+    for key in stats_imgaug:
+        a = torch.cat(stats_imgaug[key]).numpy()
+        b = torch.cat(stats_torch[key]).numpy()
+        result[key] = {
+            'imgaug_mean': float(a.mean()),
+            'torch_mean': float(b.mean()),
+            'ks_statistic': float(ks_2samp(a, b).statistic),
+        }
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare BatchImageAugmenter with the imgaug pipeline.')
+    parser.add_argument('--image', type=str, default=None, help='image file, smooth random images if not given')
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--num_batches', type=int, default=20)
+    parser.add_argument('--prob', type=float, default=0.5)
+    parser.add_argument('--cutout', action='store_true')
+    parser.add_argument('--augmentation', type=str, default=None, choices=AUGMENTATIONS, help='compare only this augmentation')
+    parser.add_argument('--device', type=str, default='cpu')
+    args = parser.parse_args()
+
+    if args.image is not None:
+        import cv2
+        image = cv2.cvtColor(cv2.imread(args.image, cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+        images = torch.from_numpy(image).permute(2, 0, 1).unsqueeze(0).repeat(args.batch_size, 1, 1, 1)
+    else:
+        # low frequency random images, pure noise would hide the effect of blur and noise
+        low = torch.randint(0, 256, (args.batch_size, 3, 23, 64)).float()
+        images = F.interpolate(low, size=(359, 1024), mode='bilinear', align_corners=False).round().to(torch.uint8)
+
+    for key, value in compare_with_imgaug(images, args.num_batches, args.prob, args.cutout, args.device, args.augmentation).items():
+        print(f'{key}: {value}')
@@ -0,0 +1,85 @@
+"""
+Two stage sampler over the buckets of the training set.
+
+The ConcatDataset of all buckets used to be sampled with a WeightedRandomSampler that needs one weight per sample
+(millions of python floats per rank) and draws the same stream on every rank. BucketSampler first draws a bucket by
+its total weight and then a sample uniformly inside the bucket. With bucket_weights = per-sample weight * bucket size
+this is the same distribution as the per-sample weights, with O(#buckets) memory. The stream of an epoch only depends on (seed, epoch), every rank takes every num_replicas-th draw of it,
+and the number of samples already yielded is part of the state dict to resume in the middle of an epoch.
+"""
+import math
+
+import torch
+from torch.utils.data.distributed import DistributedSampler
+
+
+class BucketSampler(DistributedSampler):
+    """
+    Samples indices of a ConcatDataset of buckets with replacement, bucket i is drawn with probability
+    bucket_weights[i] / sum(bucket_weights).
+
+    Subclass of DistributedSampler so that lightning does not wrap it in another distributed sampler
+    and calls set_epoch at the start of every epoch.
+    """
+
+    def __init__(self, dataset, bucket_sizes, bucket_weights, num_samples, num_replicas=1, rank=0, seed=0, chunk_size=65536):
+        super().__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=True, seed=seed)
+        assert len(bucket_sizes) == len(bucket_weights), "One weight per bucket needed"
+        assert sum(bucket_sizes) == len(dataset), "Bucket sizes do not match the dataset"
+
+        self.bucket_sizes = torch.tensor(bucket_sizes, dtype=torch.long)
+        self.bucket_offsets = torch.cumsum(self.bucket_sizes, dim=0) - self.bucket_sizes
+        self.bucket_weights = torch.tensor(bucket_weights, dtype=torch.double)
+        self.chunk_size = chunk_size
+
+        # same as DistributedSampler: every rank gets the same number of samples
+        self.num_samples = math.ceil(num_samples / self.num_replicas)
+        self.total_size = self.num_samples * self.num_replicas
+
+        self.start_index = 0  # samples of the current epoch already consumed before a resume
+        self.num_yielded = 0
+
+    def set_epoch(self, epoch):
+        if epoch != self.epoch:
+            # a resumed position only applies to the epoch it was saved in
+            self.start_index = 0
+        super().set_epoch(epoch)
+
+    def __len__(self):
+        return self.num_samples
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+
+        self.num_yielded = self.start_index
+        skip = self.start_index
+        # draws are generated in chunks of the global stream, this rank takes positions rank, rank + num_replicas, ...
+        for chunk_start in range(0, self.total_size, self.chunk_size):
+            chunk_size = min(self.chunk_size, self.total_size - chunk_start)
+            buckets = torch.multinomial(self.bucket_weights, chunk_size, replacement=True, generator=generator)
+            within = (torch.rand(chunk_size, generator=generator, dtype=torch.double) * self.bucket_sizes[buckets]).long()
+            indices = self.bucket_offsets[buckets] + within
+
+            # chunk_size is a multiple of num_replicas except for the last chunk
+            first = (self.rank - chunk_start) % self.num_replicas
+            indices = indices[first::self.num_replicas].tolist()
+            if skip >= len(indices):
+                skip -= len(indices)
+                continue
+            for index in indices[skip:]:
+                self.num_yielded += 1
+                yield index
+            skip = 0
+        self.start_index = 0
+
+    def state_dict(self):
+        # num_yielded includes the batches the data loader prefetched, so at most a few batches are skipped on resume
+        return {'epoch': self.epoch, 'num_yielded': self.num_yielded, 'seed': self.seed, 'num_replicas': self.num_replicas}
+
+    def load_state_dict(self, state_dict):
+        if state_dict['seed'] != self.seed or state_dict['num_replicas'] != self.num_replicas:
+            print(f"BucketSampler: seed or number of ranks changed, not resuming the position in epoch {state_dict['epoch']}.")
+            return
+        self.epoch = state_dict['epoch']
+        self.start_index = state_dict['num_yielded'] % self.num_samples if self.num_samples > 0 else 0
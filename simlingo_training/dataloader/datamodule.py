@@ -1,5 +1,5 @@
 # Standard library imports
-import itertools
+import time
 from typing import List
 
 # Third-party imports
@@ -7,6 +7,7 @@ import hydra
 import line_profiler
 import numpy as np
 import torch
+from hydra.utils import to_absolute_path
 from pytorch_lightning import LightningDataModule
 from torch.utils.data import DataLoader
 from transformers import AutoProcessor
@@ -14,9 +15,14 @@ from transformers import AutoProcessor
 # Local/project specific imports
 # from simlingo_training.dataloader.dataset_driving import Data_Driving # is called directly by hydra.utils.instantiate, keeping here to make it easier to find
 # from simlingo_training.dataloader.dataset_dreamer import Data_Dreamer # is called directly by hydra.utils.instantiate, keeping here to make it easier to find
+from simlingo_training.dataloader.augmentation import BatchImageAugmenter
+from simlingo_training.dataloader.bucket_sampler import BucketSampler
+from simlingo_training.dataloader.length_grouping import LengthGroupedDataLoader
+from simlingo_training.dataloader.prebake import EpochDataLoader, PrebakedDataset
 from simlingo_training.utils.custom_types import DrivingExample, DrivingInput, DrivingLabel, LanguageLabel
-from simlingo_training.utils.internvl2_utils import preprocess_image_batch, get_custom_chat_template, get_num_image_tokens_per_patch
+from simlingo_training.utils.internvl2_utils import IMAGENET_MEAN, IMAGENET_STD, preprocess_image_batch, preprocess_image_batch_tensor, ChatTemplateEngine, get_num_image_tokens_per_patch
 from simlingo_training.utils.projection import get_camera_intrinsics, get_camera_extrinsics
+from simlingo_training.utils.stage_timer import StageTimer, timed
 
 def encode_uint8(strings: List[str], common_length: int) -> torch.Tensor:
     max_len = max(len(s) for s in strings)
@@ -46,6 +52,9 @@ class DataModule(LightningDataModule):
         self.predict = predict
         
         self.printed = False
+        # older configs do not have this option
+        if not hasattr(self, 'image_preprocessing'):
+            self.image_preprocessing = 'pil'
 
         self.NUM_IMAGE_PATCHES = 2
         self.IMAGES_TO_CONSIDER = ['image_ff'] # front-forward image, other images are not supported
@@ -58,6 +67,21 @@ class DataModule(LightningDataModule):
 
         self.num_image_tokens_per_patch = get_num_image_tokens_per_patch(self.encoder_variant)
         self.num_image_tokens_total = self.num_image_tokens_per_patch * self.NUM_IMAGE_PATCHES
+        # created on first use in each data loader worker
+        self.chat_template_engine = None
+        self.sampler_train = None
+        self.sampler_state = None
+
+        # batched image augmentation, replaces imgaug in the dataset with the torch backend
+        self.batch_augmenter = None
+        self.img_augmentation_device = base_dataset.get('img_augmentation_device', 'cpu')
+        if base_dataset.get('img_augmentation', False) and base_dataset.get('img_augmentation_backend', 'imgaug') == 'torch':
+            self.batch_augmenter = BatchImageAugmenter(prob=base_dataset.img_augmentation_prob)
+
+        # per stage timings of the datasets and the collate, shared with the workers (see utils/stage_timer.py)
+        self.stage_timer = None
+        if cfg.get('stage_timing', False):
+            self.stage_timer = StageTimer(num_workers=cfg.get('num_workers', 0))
             
         # add <WAYPOINT> token
         if 'tokenizer' in self.processor.__dict__:
@@ -161,17 +185,41 @@ class DataModule(LightningDataModule):
                 datasets = {key: value for key, value in datasets.items() if value.__len__() > 0}
 
                 self.train_dataset = torch.utils.data.ConcatDataset([datasets[bucket] for bucket in bucket_list])
-                weights_train = [[sample_weights[i]] * datasets[bucket].__len__() for i, bucket in enumerate(bucket_list)]
-                weights_train = list(itertools.chain.from_iterable(weights_train))
                 num_samples_all = [datasets[bucket].__len__() // sample_weights[i] for i, bucket in enumerate(bucket_list)]
                 num_samples = int(min(num_samples_all))# * num_datasets
                 print(f"Num samples: {num_samples}")
                 if self.driving_dataset is not None:
                     print(f"Num samples all: {datasets['all'].__len__()}")
-                self.sampler_train = torch.utils.data.WeightedRandomSampler(weights=weights_train, num_samples=num_samples, replacement=True)
+                # first draws a bucket by its total weight (per-sample weight * bucket size), then a sample uniformly
+                # inside the bucket (sharded over the ranks), same distribution as one weight per sample
+                bucket_sizes = [datasets[bucket].__len__() for bucket in bucket_list]
+                self.sampler_train = BucketSampler(
+                    self.train_dataset,
+                    bucket_sizes=bucket_sizes,
+                    bucket_weights=[sample_weights[i] * bucket_sizes[i] for i in range(len(bucket_list))],
+                    num_samples=num_samples,
+                    num_replicas=self.trainer.world_size if self.trainer is not None else 1,
+                    rank=self.trainer.global_rank if self.trainer is not None else 0,
+                )
+                if self.sampler_state is not None:
+                    self.sampler_train.load_state_dict(self.sampler_state)
+
+                if self.base_dataset.get('prebaked_path') is not None:
+                    # stream the pre-baked shards instead, bucket weights are not applied in this mode
+                    print(f"\033[93mStreaming training samples from {self.base_dataset.prebaked_path}, train_partitions are ignored.\033[00m")
+                    self.train_dataset = PrebakedDataset(
+                        self.train_dataset,
+                        to_absolute_path(self.base_dataset.prebaked_path),
+                        shuffle_buffer=self.base_dataset.get('prebaked_shuffle_buffer', 256),
+                        num_replicas=self.trainer.world_size if self.trainer is not None else 1,
+                        rank=self.trainer.global_rank if self.trainer is not None else 0,
+                    )
+                    self.sampler_train = None
 
             self.val_dataset = torch.utils.data.ConcatDataset(self.val_datasets)
             self.predict_dataset = None
+            for dataset in list(datasets.values()) + self.val_datasets:
+                dataset.stage_timer = self.stage_timer
 
         else:
             if self.qa_dataset is not None:
@@ -188,11 +236,60 @@ class DataModule(LightningDataModule):
                     **self.base_dataset,
                     _recursive_=False
                 )
-
+            self.predict_dataset.stage_timer = self.stage_timer
+
+
+    def state_dict(self):
+        # saved in the lightning checkpoint to resume the sampler in the middle of an epoch
+        if getattr(self, 'sampler_train', None) is None:
+            return {}
+        return {'sampler_train': self.sampler_train.state_dict()}
+
+    def load_state_dict(self, state_dict):
+        self.sampler_state = state_dict.get('sampler_train')
+        if self.sampler_state is not None and getattr(self, 'sampler_train', None) is not None:
+            self.sampler_train.load_state_dict(self.sampler_state)
+
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        if self.batch_augmenter is None or self.img_augmentation_device == 'cpu':
+            return batch
+
+        # augment the normalized tiles on the training device, with the same parameters for all tiles of a sample
+        images = batch.driving_input.camera_images
+        C, H, W = images.shape[-3:]
+        tiles_per_sample = images[0].numel() // (C * H * W)
+        groups = torch.arange(images.size(0), device=images.device).repeat_interleave(tiles_per_sample)
+        mean = torch.tensor(IMAGENET_MEAN, device=images.device).view(1, C, 1, 1)
+        std = torch.tensor(IMAGENET_STD, device=images.device).view(1, C, 1, 1)
+        pixels = (images.reshape(-1, C, H, W).float() * std + mean) * 255
+        pixels = self.batch_augmenter(pixels, groups=groups).float() / 255
+        images = ((pixels - mean) / std).view(images.shape).to(images.dtype)
+        return batch._replace(driving_input=batch.driving_input._replace(camera_images=images))
 
     def train_dataloader(self):
         if self.train_dataset is None:
             return None
+        if self.cfg.get('length_group_factor', 1) > 1:
+            # loads length_group_factor batches at once and batches samples with similar conversation length
+            return LengthGroupedDataLoader(
+                self.train_dataset,
+                batch_size=self.batch_size,
+                group_factor=self.length_group_factor,
+                num_workers=self.num_workers,
+                drop_last=True,
+                collate_fn=self.dl_collate_fn,
+                sampler=self.sampler_train,
+                pin_memory=True,
+            )
+        if isinstance(self.train_dataset, PrebakedDataset):
+            return EpochDataLoader(
+                self.train_dataset,
+                batch_size=self.batch_size,
+                num_workers=self.num_workers,
+                drop_last=True,
+                collate_fn=self.dl_collate_fn,
+                pin_memory=True,
+            )
         return DataLoader(
             self.train_dataset,
             batch_size=self.batch_size,
@@ -229,6 +326,7 @@ class DataModule(LightningDataModule):
 
     @line_profiler.profile
     def dl_collate_fn(self, data):
+        collate_start = time.perf_counter()
         BS = len(data)
         grid_nums = [self.NUM_IMAGE_PATCHES] # we split the front forward into two patches (1x2)
 
@@ -242,13 +340,22 @@ class DataModule(LightningDataModule):
             
             images_batch_tensor = torch.tensor(np.asarray([getattr(data[i], img_to_consider) if getattr(data[i], img_to_consider) is not None else np.zeros_like(img_tmp) for i in range(len(data))])).float()
             images_batch_tensor = images_batch_tensor.view(BS*T, C, H, W)
-            images_batch_list = list(images_batch_tensor)
-
-            if 'internvl2' in self.encoder_variant.lower():
-                # get image patches
-                images_processed = preprocess_image_batch(images_batch_list, input_size=448, use_global_img=self.use_global_img, max_num_grid=grid_nums[idx])    
-            else:
-                raise ValueError(f"Image preprocessing for {self.encoder_variant} not implemented")
+            if self.batch_augmenter is not None and self.img_augmentation_device == 'cpu':
+                with timed(self.stage_timer, 'collate_augmentation'):
+                    images_batch_tensor = self.batch_augmenter(images_batch_tensor).float()
+
+            with timed(self.stage_timer, 'image_tiling'):
+                if 'internvl2' in self.encoder_variant.lower():
+                    # get image patches
+                    if self.image_preprocessing == 'tensor':
+                        images_processed = preprocess_image_batch_tensor(images_batch_tensor, input_size=448, use_global_img=self.use_global_img, max_num_grid=grid_nums[idx])
+                    elif self.image_preprocessing == 'pil':
+                        images_batch_list = list(images_batch_tensor)
+                        images_processed = preprocess_image_batch(images_batch_list, input_size=448, use_global_img=self.use_global_img, max_num_grid=grid_nums[idx])    
+                    else:
+                        raise ValueError(f"Image preprocessing {self.image_preprocessing} not implemented")
+                else:
+                    raise ValueError(f"Image preprocessing for {self.encoder_variant} not implemented")
                 
             images_pixel = images_processed['pixel_values']
             image_sizes = images_processed['image_sizes']
@@ -267,7 +374,10 @@ class DataModule(LightningDataModule):
                 raise ValueError(f"Image type {img_to_consider} not supported")
 
         conversations = [data[i].conversation for i in range(BS)]
-        conversation_dict, question_dict = get_custom_chat_template(conversations, self.tokenizer, self.encoder_variant, self.num_image_tokens_total)
+        if self.chat_template_engine is None:
+            self.chat_template_engine = ChatTemplateEngine(self.tokenizer, self.encoder_variant, self.num_image_tokens_total)
+        with timed(self.stage_timer, 'tokenization'):
+            conversation_dict, question_dict = self.chat_template_engine(conversations)
 
         placeholder_batch_list = []
         for i in range(BS):
@@ -335,12 +445,15 @@ class DataModule(LightningDataModule):
                 eval_infos=eval_infos,
             )
             
-        return DrivingExample(
+        example = DrivingExample(
             driving_input=driving_input,
             driving_label=driving_label,
             run_id=encode_uint8([data[i].measurement_path for i in range(BS)], 1000),  # [B] str
             qa_templates=qa_templates,
         )
+        if self.stage_timer is not None:
+            self.stage_timer.record('collate', time.perf_counter() - collate_start)
+        return example
 
     def dl_collate_fn_val(self, data):
         pass
@@ -7,9 +7,9 @@ import datetime
 import glob
 import gzip
 import os
-import pickle as pkl
 import random
 import sys
+import time
 from pathlib import Path
 
 import numpy as np
@@ -24,8 +24,14 @@ from torch.utils.data import Dataset
 from tqdm import tqdm
 
 import simlingo_training.utils.transfuser_utils as t_u
+from simlingo_training.dataloader.measurement_store import PackedMeasurementCache
+from simlingo_training.dataloader.sample_index import (ROUTE_CRASHED, ROUTE_NO_RESULTS, ROUTE_OK,
+                                                       ROUTE_RESULTS_LOAD_ERROR, get_route_status,
+                                                       get_sample_index, load_bucket_dict)
+from simlingo_training.dataloader.sample_table import SamplePathView, SampleTable
 from simlingo_training.utils.custom_types import DatasetOutput
 from simlingo_training.utils.projection import get_camera_intrinsics, project_points
+from simlingo_training.utils.stage_timer import timed
 
 VIZ_DATA = False
 
@@ -42,19 +48,27 @@ class BaseDataset(Dataset):  # pylint: disable=locally-disabled, invalid-name
         for key, value in cfg.items():
             setattr(self, key, value)
 
+        if not hasattr(self, 'img_augmentation_backend'):
+            self.img_augmentation_backend = 'imgaug'
         self.tfs = image_augmenter(prob=self.img_augmentation_prob)
+        self.packed_measurements = PackedMeasurementCache()
+        # set by PrebakedDataset (prebake.py) for the sample that is loaded, images and label files are then
+        # taken from the shard instead of the disk
+        self.prebaked_images = None
+        self.prebaked_files = None
+        # shared StageTimer (utils/stage_timer.py), set by the DataModule if stage_timing is enabled
+        self.stage_timer = None
 
         filter_infractions_per_route = True
 
         self.rgb_folder = 'rgb'
         self.dreamer_folder = 'dreamer'
         
-        self.images = []
-        self.boxes = []
-        self.measurements = []
+        # samples are collected as (route_id, frame) pairs, the paths are built on access (see sample_table.py)
+        sample_route_dirs = []
+        sample_route_ids = []
         self.sample_start = []
         self.augment_exists = []
-        self.alternative_trajectories = []
 
         self.temporal_measurements = []
 
@@ -140,55 +154,58 @@ class BaseDataset(Dataset):  # pylint: disable=locally-disabled, invalid-name
 
 
 
-        if not self.bucket_name == "all":
-            with open(f"{repo_path}/" + self.bucket_path + '/buckets_paths.pkl', 'rb') as f:
-                bucket_dict = pkl.load(f)
-
-            bucket_run_ids = None
-
+        bucket_keys = None
+        if self.bucket_name is not None and self.bucket_name != "all":
             # TODO: this is stupid that its manual, should change bucket names to match the saved dict with pathes
-            if self.bucket_name == "all":
-                pass
-            elif self.bucket_name == 'acceleration_negative_5':
-                bucket_run_ids = bucket_dict['acceleration_-5']# + bucket_dict['acceleration_-20'] + bucket_dict['acceleration_-40']
+            if self.bucket_name == 'acceleration_negative_5':
+                bucket_keys = ['acceleration_-5']# + ['acceleration_-20', 'acceleration_-40']
             elif self.bucket_name == "acceleration_negative_1":
-                bucket_run_ids = bucket_dict['acceleration_-1']
+                bucket_keys = ['acceleration_-1']
             elif self.bucket_name == "acceleration_positive_1":
-                bucket_run_ids = bucket_dict['acceleration_5']
+                bucket_keys = ['acceleration_5']
             elif self.bucket_name == "acceleration_positive_5":
-                bucket_run_ids = bucket_dict['acceleration_20']# + bucket_dict['acceleration_40'] + bucket_dict['acceleration_1000000']
+                bucket_keys = ['acceleration_20']# + ['acceleration_40', 'acceleration_1000000']
             elif self.bucket_name == "lateral_control_1":
-                bucket_run_ids = bucket_dict['lateral_control_1']
+                bucket_keys = ['lateral_control_1']
             elif self.bucket_name == "lateral_control_1_2":
-                bucket_run_ids = bucket_dict['lateral_control_1'] + bucket_dict['lateral_control_2']
+                bucket_keys = ['lateral_control_1', 'lateral_control_2']
             elif self.bucket_name == "lateral_control_high":
-                bucket_run_ids = bucket_dict['lateral_control_2'] + bucket_dict['lateral_control_5'] + bucket_dict['lateral_control_1000000']
+                bucket_keys = ['lateral_control_2', 'lateral_control_5', 'lateral_control_1000000']
             elif self.bucket_name == "lateral_control_higher_5":
-                bucket_run_ids = bucket_dict['lateral_control_5'] + bucket_dict['lateral_control_1000000']
+                bucket_keys = ['lateral_control_5', 'lateral_control_1000000']
             elif self.bucket_name == "recovery":
-                bucket_run_ids = bucket_dict['recovery_data_small'] + bucket_dict['recovery_data_large']
+                bucket_keys = ['recovery_data_small', 'recovery_data_large']
             else:
-                if self.bucket_name not in bucket_dict:
-                    raise ValueError(f"Bucket name {self.bucket_name} not found.")
-                bucket_run_ids = bucket_dict[self.bucket_name]
+                bucket_keys = [self.bucket_name]
+        bucket_file = f"{repo_path}/" + self.bucket_path + '/buckets_paths.pkl'
+        # measurement files in buckets_paths.pkl are relative to this folder
+        bucket_source_prefix = 'database/simlingo_v2_2025_01_10'
+
+        route_pattern = f"{repo_path}/" + self.data_path + '/data/simlingo/*/*/*/Town*'
+        sample_index = None
+        if self.use_sample_index:
+            # cached route listing, filter outcomes and frame counts, see sample_index.py
+            sample_index = get_sample_index(route_pattern, self.rgb_folder, f"{repo_path}/{self.sample_index_path}")
+            route_dirs = list(sample_index.routes)
+        else:
+            route_dirs = glob.glob(route_pattern)
+        print(f'Found {len(route_dirs)} routes in {repo_path + self.data_path}')
 
+        bucket_mask, frame_starts, run_id_dict = None, None, None
+        if bucket_keys is not None and sample_index is not None:
+            # per frame membership stored in the index, see sample_index.py
+            sample_index.load_buckets(bucket_file, repo_path, bucket_source_prefix, self.bucket_path)
+            bucket_mask = sample_index.bucket_mask(bucket_keys)
+            frame_starts = sample_index.frame_starts()
+        elif bucket_keys is not None:
+            bucket_dict = load_bucket_dict(bucket_file)
             run_id_dict = {}
-            if bucket_run_ids is not None:
-                for run_id in bucket_run_ids:
-                    run_id = run_id.replace('database/simlingo_v2_2025_01_10', self.bucket_path)
-                    run_id_path = Path(run_id)
-                    run_id_parent = run_id_path.parent
-                    run_id_name = run_id_path.name
-                    run_id_absolut = str(run_id_parent)
-                    run_id_absolut = f"{repo_path}/{str(run_id_parent)}"
-                    if run_id_absolut not in run_id_dict:
-                        run_id_dict[run_id_absolut] = [run_id_name]
-                    else:
-                        run_id_dict[run_id_absolut].append(run_id_name)
-
-
-        route_dirs = glob.glob(f"{repo_path}/" + self.data_path + '/data/simlingo/*/*/*/Town*')
-        print(f'Found {len(route_dirs)} routes in {repo_path + self.data_path}')
+            for key in bucket_keys:
+                if key not in bucket_dict:
+                    raise ValueError(f"Bucket name {self.bucket_name} not found.")
+                for run_id in bucket_dict[key]:
+                    run_id_path = Path(f"{repo_path}/{run_id.replace(bucket_source_prefix, self.bucket_path)}")
+                    run_id_dict.setdefault(str(run_id_path.parent), set()).add(run_id_path.name)
         
         if not self.use_old_towns:
             route_dirs = [route_dir for route_dir in route_dirs if 'lb1_split' not in route_dir]
@@ -229,39 +246,36 @@ class BaseDataset(Dataset):  # pylint: disable=locally-disabled, invalid-name
                 if not os.path.exists(dreamer_dir):
                     continue
 
+            num_seq = None
+            if sample_index is not None:
+                route_status, num_seq = sample_index.get(route_dir)
+            elif filter_infractions_per_route:
+                route_status = get_route_status(route_dir)
+            else:
+                route_status = ROUTE_OK
+
             if filter_infractions_per_route:
-                if not os.path.isfile(route_dir + '/results.json.gz'):
-                    total_routes += 1
+                total_routes += 1
+                if route_status == ROUTE_NO_RESULTS:
                     crashed_routes += 1
                     if "no_results.json" not in fail_reasons:
                         fail_reasons["no_results.json"] = 1
                     else:
                         fail_reasons["no_results.json"] += 1
                     continue
-
-                with gzip.open(route_dir + '/results.json.gz', 'rt') as f:
-                    total_routes += 1
-                    try:
-                        results_route = ujson.load(f)
-                    except Exception as e:
-                        print(f"Error in {route_dir}")
-                        print(e)
-                        if "results.json_load_error" not in fail_reasons:
-                            fail_reasons["results.json_load_error"] = 1
-                        else:
-                            fail_reasons["results.json_load_error"] += 1
-                        continue
-
-                if results_route['scores']['score_composed'] < 100.0:  # we also count imperfect runs as failed (except minspeedinfractions)
-                    cond1 = results_route['scores']['score_route'] > 94.0  # we allow 6% of the route score to be missing
-                    cond2 = results_route['num_infractions'] == (len(results_route['infractions']['min_speed_infractions']) + len(results_route['infractions']['outside_route_lanes']))
-                    if not (cond1 and cond2):  # if the only problem is minspeedinfractions, keep it
-                        crashed_routes += 1
-                        if "route_crashed" not in fail_reasons:
-                            fail_reasons["route_crashed"] = 1
-                        else:
-                            fail_reasons["route_crashed"] += 1
-                        continue
+                elif route_status == ROUTE_RESULTS_LOAD_ERROR:
+                    if "results.json_load_error" not in fail_reasons:
+                        fail_reasons["results.json_load_error"] = 1
+                    else:
+                        fail_reasons["results.json_load_error"] += 1
+                    continue
+                elif route_status == ROUTE_CRASHED:
+                    crashed_routes += 1
+                    if "route_crashed" not in fail_reasons:
+                        fail_reasons["route_crashed"] = 1
+                    else:
+                        fail_reasons["route_crashed"] += 1
+                    continue
 
             perfect_routes += 1
 
@@ -272,78 +286,68 @@ class BaseDataset(Dataset):  # pylint: disable=locally-disabled, invalid-name
             #         fail_reasons["no_rgb_folder"] += 1
             #     continue
 
-            num_seq = len(os.listdir(route_dir + f'/{self.rgb_folder}'))
-
-            for seq in range(self.skip_first_n_frames, num_seq - self.pred_len - self.hist_len - 1):
-                image = []
-                box = []
-                measurement = []
-                augment_exist = False
+            if num_seq is None:
+                num_seq = len(os.listdir(route_dir + f'/{self.rgb_folder}'))
 
-                measurement_file = route_dir + '/measurements' + f'/{(seq + self.hist_len-1):04}.json.gz'
+            # sample seq uses the frames seq .. seq + hist_len + pred_len, its measurement file is the one of
+            # frame seq + hist_len - 1. images, boxes and measurements are route_dir + frame, dreamer files are
+            # derived from the measurement file in the same way
+            seqs = np.arange(self.skip_first_n_frames, max(self.skip_first_n_frames, num_seq - self.pred_len - self.hist_len - 1))
+            frames = seqs + self.hist_len - 1
+            keep = np.ones(len(seqs), dtype=bool)
 
-                if evaluation and measurement_file not in self.all_eval_samples:
-                    continue
-                
-                if dreamer:
-                    dreamer_file_path = measurement_file.replace('measurements', f'{self.dreamer_folder}').replace('data/', f'{self.dreamer_folder}/')
-                    if not os.path.exists(dreamer_file_path):
-                        continue
-                 
-                if self.bucket_name is not None and self.bucket_name != "all":
-                    measurement_file_path = Path(measurement_file)
-                    if str(measurement_file_path.parent) in run_id_dict:
-                        if measurement_file_path.name not in run_id_dict[str(measurement_file_path.parent)]:
-                            if "measurement_file_not_in_bucket" not in fail_reasons:
-                                fail_reasons["measurement_file_not_in_bucket"] = 1
-                            else:
-                                fail_reasons["measurement_file_not_in_bucket"] += 1
-                            continue
-                    else:
-                        if "measurement_folder_not_in_bucket" not in fail_reasons:
-                            fail_reasons["measurement_folder_not_in_bucket"] = 1
-                        else:
-                            fail_reasons["measurement_folder_not_in_bucket"] += 1
-                        continue
-
-                # Loads the current (and past) frames (if seq_len > 1)
-                skip = False
-                augment_exist = True
-                for idx in range(self.hist_len):
-                    image.append(route_dir +  f'/{self.rgb_folder}' + (f'/{(seq + idx):04}.jpg'))
-                    box.append(route_dir + '/boxes' + (f'/{(seq + idx):04}.json.gz'))
-
-                if skip:
-                    if "file_not_found" not in fail_reasons:
-                        fail_reasons["file_not_found"] = 1
-                    else:
-                        fail_reasons["file_not_found"] += 1
-                    continue
+            if evaluation:
+                keep &= np.array([route_dir + '/measurements' + f'/{frame:04}.json.gz' in self.all_eval_samples for frame in frames], dtype=bool)
 
-                measurement.append(route_dir + '/measurements')
+            if dreamer:
+                dreamer_files = [(route_dir + '/measurements' + f'/{frame:04}.json.gz').replace('measurements', f'{self.dreamer_folder}').replace('data/', f'{self.dreamer_folder}/') for frame in frames]
+                keep &= np.array([keep_i and os.path.exists(dreamer_file) for keep_i, dreamer_file in zip(keep, dreamer_files)], dtype=bool)
+
+            if bucket_mask is not None:
+                route_id_index = sample_index.route_ids[route_dir]
+                route_in_bucket = bucket_mask[frame_starts[route_id_index]:frame_starts[route_id_index + 1]]
+                in_bucket = route_in_bucket[frames] if route_in_bucket.any() else None
+            elif run_id_dict is not None:
+                bucket_files = run_id_dict.get(str(Path(route_dir + '/measurements')))
+                in_bucket = None
+                if bucket_files is not None:
+                    in_bucket = np.array([f'{frame:04}.json.gz' in bucket_files for frame in frames], dtype=bool)
+            if bucket_keys is not None:
+                if in_bucket is None:
+                    if keep.sum() > 0:
+                        fail_reasons["measurement_folder_not_in_bucket"] = fail_reasons.get("measurement_folder_not_in_bucket", 0) + int(keep.sum())
+                    keep[:] = False
+                else:
+                    if (keep & ~in_bucket).sum() > 0:
+                        fail_reasons["measurement_file_not_in_bucket"] = fail_reasons.get("measurement_file_not_in_bucket", 0) + int((keep & ~in_bucket).sum())
+                    keep &= in_bucket
 
-                self.images.append(image)
-                self.boxes.append(box)
-                self.measurements.append(measurement)
-                self.sample_start.append(seq)
-                self.augment_exists.append(augment_exist)
-                if dreamer:
-                    self.alternative_trajectories.append(dreamer_file_path)
+            route_id = len(sample_route_dirs)
+            sample_route_dirs.append(route_dir)
+            sample_route_ids.extend([route_id] * int(keep.sum()))
+            self.sample_start.extend(seqs[keep].tolist())
+            self.augment_exists.extend([True] * int(keep.sum()))
 
         # There is a complex "memory leak"/performance issue when using Python
         # objects like lists in a Dataloader that is loaded with
         # multiprocessing, num_workers > 0
         # A summary of that ongoing discussion can be found here
         # https://github.com/pytorch/pytorch/issues/13246#issuecomment-905703662
-        # A workaround is to store the string lists as numpy byte objects
-        # because they only have 1 refcount.
-        self.images = np.array(self.images).astype(np.string_)
-        self.boxes = np.array(self.boxes).astype(np.string_)
-        self.measurements = np.array(self.measurements).astype(np.string_)
+        # The samples are stored as int32 arrays in a memory mapped file that all workers share,
+        # the path arrays are views that return the same np.bytes_ values as before.
+        self.sample_table = SampleTable(
+            sample_route_dirs, sample_route_ids, self.sample_start, self.augment_exists,
+            hist_len=self.hist_len, rgb_folder=self.rgb_folder, dreamer_folder=self.dreamer_folder,
+        )
+        self.images = SamplePathView(self.sample_table, 'image_paths')
+        self.boxes = SamplePathView(self.sample_table, 'box_paths')
+        self.measurements = SamplePathView(self.sample_table, 'measurement_paths')
         if dreamer:
-            self.alternative_trajectories = np.array(self.alternative_trajectories).astype(np.string_)
+            self.alternative_trajectories = SamplePathView(self.sample_table, 'alternative_trajectory_path')
 
-        self.sample_start = np.array(self.sample_start)
+        # the lists were only needed to build the table, samples are read through self.sample_table (a pickled
+        # memmap field would be copied to every worker)
+        del self.sample_start, self.augment_exists
         # if rank == 0:
         print(f'[{self.split} samples]: Loading {len(self.images)} images from {self.data_path} for bucket {self.bucket_name}')
         print('Total amount of routes:', total_routes)
@@ -353,11 +357,35 @@ class BaseDataset(Dataset):  # pylint: disable=locally-disabled, invalid-name
 
     def __len__(self):
         """Returns the length of the dataset. """
-        return self.images.shape[0]
+        return len(self.sample_table)
     
 
+    def load_measurement(self, measurement_dir, frame, packed=None):
+        """Loads the measurement of one frame, from the packed store if available else from the json file."""
+        if packed is not None:
+            return packed[frame]
+
+        measurement_file = measurement_dir + (f'/{frame:04}.json.gz')
+        return self.load_json_gz(measurement_file)
+
+    def load_json_gz(self, path):
+        """Loads a .json.gz label file, from the pre-baked shard of the sample if it contains the file."""
+        if self.prebaked_files is not None and path in self.prebaked_files:
+            return ujson.loads(gzip.decompress(self.prebaked_files[path]))
+        with gzip.open(path, 'rt') as f:
+            return ujson.load(f)
+
     def load_current_and_future_measurements(self, measurements, sample_start):
         loaded_measurements = []
+        measurement_dir = str(measurements[0], encoding='utf-8')
+
+        # packed columnar store of the route, see measurement_store.py. json files are the fallback.
+        packed = None
+        # a pre-baked sample carries its measurement files
+        if self.measurement_backend != 'json' and self.prebaked_files is None:
+            packed = self.packed_measurements.get(measurement_dir)
+            if packed is None and self.measurement_backend == 'packed':
+                raise FileNotFoundError(f"No up to date packed measurements for {measurement_dir}")
 
         ######################################################
         ######## load current and future measurements ########
@@ -365,10 +393,7 @@ class BaseDataset(Dataset):  # pylint: disable=locally-disabled, invalid-name
 
         # Since we load measurements for future time steps, we load and store them separately
         for i in range(self.hist_len):
-            measurement_file = str(measurements[0], encoding='utf-8') + (f'/{(sample_start + i):04}.json.gz')
-
-            with gzip.open(measurement_file, 'rt') as f1:
-                measurements_i = ujson.load(f1)
+            measurements_i = self.load_measurement(measurement_dir, sample_start + i, packed)
             loaded_measurements.append(measurements_i)
 
         end = self.pred_len + self.hist_len
@@ -376,17 +401,14 @@ class BaseDataset(Dataset):  # pylint: disable=locally-disabled, invalid-name
 
         for i in range(start, end):
             try:
-                measurement_file = str(measurements[0], encoding='utf-8') + (f'/{(sample_start + i):04}.json.gz')
-
-                with gzip.open(measurement_file, 'rt') as f1:
-                    measurements_i = ujson.load(f1)
+                measurements_i = self.load_measurement(measurement_dir, sample_start + i, packed)
                 loaded_measurements.append(measurements_i)
             except FileNotFoundError:
                 # If the file is not found, we just use the last available measurement
-                print(f"File not found: {measurement_file}")
+                print(f"File not found: {measurement_dir}/{(sample_start + i):04}.json.gz")
                 loaded_measurements.append(loaded_measurements[-1])
         current_measurement = loaded_measurements[self.hist_len - 1]
-        measurement_file_current = str(measurements[0], encoding='utf-8') + (f'/{(sample_start + start-1):04}.json.gz')
+        measurement_file_current = measurement_dir + (f'/{(sample_start + start-1):04}.json.gz')
         return loaded_measurements, current_measurement, measurement_file_current
 
     def load_waypoints(self, data, loaded_measurements, aug_translation=0.0, aug_rotation=0.0):
@@ -441,6 +463,14 @@ class BaseDataset(Dataset):  # pylint: disable=locally-disabled, invalid-name
 
         return data
     
+    def timed(self, stage):
+        return timed(self.stage_timer, stage)
+
+    def record_stage(self, stage, start):
+        # for stages that are not a single block, start is a time.perf_counter() value
+        if self.stage_timer is not None:
+            self.stage_timer.record(stage, time.perf_counter() - start)
+
     def load_images(self, data, images, augment_sample=False):
         loaded_images = []
         loaded_images_org_size = []
@@ -450,15 +480,26 @@ class BaseDataset(Dataset):  # pylint: disable=locally-disabled, invalid-name
             if augment_sample:
                 images_path = images_path.replace('rgb', 'rgb_augmented')
 
-            if not os.path.isfile(images_path):
-                print(f"File not found: {images_path}")
-                raise FileNotFoundError
-
-            images_i = cv2.imread(images_path, cv2.IMREAD_COLOR)
-            images_i = cv2.cvtColor(images_i, cv2.COLOR_BGR2RGB)
-
-            if self.img_augmentation: # and random.random() <= self.img_augmentation_prob:
-                images_i = self.tfs(image=images_i)
+            if self.prebaked_images is not None:
+                # already decoded full resolution image of the pre-baked shard, [T, H, W, C] uint8
+                variant = 'rgb_augmented' if augment_sample else 'rgb'
+                if self.prebaked_images.get(variant) is None:
+                    print(f"Pre-baked image not found: {images_path}")
+                    raise FileNotFoundError
+                images_i = self.prebaked_images[variant][i]
+            else:
+                if not os.path.isfile(images_path):
+                    print(f"File not found: {images_path}")
+                    raise FileNotFoundError
+
+                with self.timed('image_decode'):
+                    images_i = cv2.imread(images_path, cv2.IMREAD_COLOR)
+                    images_i = cv2.cvtColor(images_i, cv2.COLOR_BGR2RGB)
+
+            # with the torch backend the batch is augmented in the collate instead
+            if self.img_augmentation and self.img_augmentation_backend == 'imgaug': # and random.random() <= self.img_augmentation_prob:
+                with self.timed('augmentation'):
+                    images_i = self.tfs(image=images_i)
             
             image_org = images_i.copy()
             if self.cut_bottom_quarter or self.img_shift_augmentation:
@@ -5,11 +5,9 @@ partially taken from https://github.com/autonomousvision/carla_garage/blob/main/
 """
 
 import os
-import ujson
 import numpy as np
 import random
 import cv2
-import gzip
 
 import torch
 from simlingo_training.utils.custom_types import DatasetOutput
@@ -36,8 +34,8 @@ class Data_Dreamer(BaseDataset):  # pylint: disable=locally-disabled, invalid-na
         data = {}
         images = self.images[index]
         measurements = self.measurements[index]
-        sample_start = self.sample_start[index]
-        augment_exists = self.augment_exists[index]
+        sample_start = self.sample_table.frame[index]
+        augment_exists = self.sample_table.augment_exists[index]
         alternative_trajectories = self.alternative_trajectories[index]
 
         ######################################################
@@ -83,8 +81,7 @@ class Data_Dreamer(BaseDataset):  # pylint: disable=locally-disabled, invalid-na
         ################## get alternatives ##################
         ######################################################
         alternative_file = str(alternative_trajectories, encoding='utf-8')
-        with gzip.open(alternative_file, 'rt') as f1:
-            alternative_trajectories = ujson.load(f1)
+        alternative_trajectories = self.load_json_gz(alternative_file)
 
         options = []
         for key, option in alternative_trajectories.items():
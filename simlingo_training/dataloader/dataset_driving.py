@@ -11,7 +11,7 @@ import numpy as np
 import random
 import cv2
 import re
-import gzip
+import time
 
 import torch
 from simlingo_training.utils.custom_types import DatasetOutput
@@ -34,20 +34,22 @@ class Data_Driving(BaseDataset):  # pylint: disable=locally-disabled, invalid-na
         """Returns the item at index idx. """
         # Disable threading because the data loader will already split in threads.
         cv2.setNumThreads(0)
+        getitem_start = time.perf_counter()
 
         data = {}
         images = self.images[index]
         measurements = self.measurements[index]
-        sample_start = self.sample_start[index]
-        augment_exists = self.augment_exists[index]
+        sample_start = self.sample_table.frame[index]
+        augment_exists = self.sample_table.augment_exists[index]
 
         ######################################################
         ######## load current and future measurements ########
         ######################################################
-        loaded_measurements, current_measurement, measurement_file_current = self.load_current_and_future_measurements(
-            measurements,
-            sample_start
-            )
+        with self.timed('measurements'):
+            loaded_measurements, current_measurement, measurement_file_current = self.load_current_and_future_measurements(
+                measurements,
+                sample_start
+                )
         
         data['measurement_path'] = measurement_file_current
 
@@ -65,17 +67,18 @@ class Data_Driving(BaseDataset):  # pylint: disable=locally-disabled, invalid-na
         ######################################################
         ################## load waypoints ####################
         ######################################################
-        data = self.load_waypoints(data, loaded_measurements, aug_translation, aug_rotation)
-       
-        speed_rounded = round(current_measurement['speed'], 1)
-        data['speed'] = current_measurement['speed']
+        with self.timed('route_waypoints'):
+            data = self.load_waypoints(data, loaded_measurements, aug_translation, aug_rotation)
 
-        data = self.load_route(data, current_measurement, aug_translation, aug_rotation)
+            speed_rounded = round(current_measurement['speed'], 1)
+            data['speed'] = current_measurement['speed']
 
-        target_point = np.array(current_measurement['target_point'])
-        target_point = self.augment_target_point(target_point, y_augmentation=aug_translation, yaw_augmentation=aug_rotation)
-        next_target_point = np.array(current_measurement['target_point_next'])
-        next_target_point = self.augment_target_point(next_target_point, y_augmentation=aug_translation, yaw_augmentation=aug_rotation)
+            data = self.load_route(data, current_measurement, aug_translation, aug_rotation)
+
+            target_point = np.array(current_measurement['target_point'])
+            target_point = self.augment_target_point(target_point, y_augmentation=aug_translation, yaw_augmentation=aug_rotation)
+            next_target_point = np.array(current_measurement['target_point_next'])
+            next_target_point = self.augment_target_point(next_target_point, y_augmentation=aug_translation, yaw_augmentation=aug_rotation)
 
         ######################################################
         ################## get commentary & qa ##################
@@ -89,8 +92,8 @@ class Data_Driving(BaseDataset):  # pylint: disable=locally-disabled, invalid-na
                 commentary_exists = False
             else:
                 try:
-                    with gzip.open(commentary_file_path, 'rt') as f:
-                        commentary_file = ujson.load(f)
+                    with self.timed('commentary_qa'):
+                        commentary_file = self.load_json_gz(commentary_file_path)
                         commentary_exists = True
                 except (FileNotFoundError, ujson.JSONDecodeError):
                     commentary_exists = False
@@ -123,8 +126,8 @@ class Data_Driving(BaseDataset):  # pylint: disable=locally-disabled, invalid-na
                 qa_exists = False
             else:
                 try:
-                    with gzip.open(qa_path, 'rt') as f:
-                        qa = ujson.load(f)
+                    with self.timed('commentary_qa'):
+                        qa = self.load_json_gz(qa_path)
                     qa_exists = True
                 except (FileNotFoundError, ujson.JSONDecodeError):
                     qa_exists = False
@@ -231,6 +234,7 @@ class Data_Driving(BaseDataset):  # pylint: disable=locally-disabled, invalid-na
         ######################################################
         ######## load navigational_conditioning ########
         ######################################################
+        conversation_start = time.perf_counter()
         target_options, placeholder_values = self.get_navigational_conditioning( data, current_measurement, target_point, next_target_point)
             
         answer = ''
@@ -270,6 +274,7 @@ class Data_Driving(BaseDataset):  # pylint: disable=locally-disabled, invalid-na
             
         answer = answer.replace('..', '.')
         prompt = prompt.replace('..', '.')
+        self.record_stage('conversation', conversation_start)
 
         ######################################################
         ######## load current and past images ########
@@ -321,6 +326,7 @@ class Data_Driving(BaseDataset):  # pylint: disable=locally-disabled, invalid-na
         if VIZ_DATA:
             # front image with path and waypoints and commentary
             self.visualise_cameras(data_new, commentary, data['route_adjusted'], data['waypoints'], options=None, prompt=prompt, answer=answer, name="img")
+        self.record_stage('getitem', getitem_start)
         return data_new
 
 
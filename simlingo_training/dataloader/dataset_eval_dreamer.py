@@ -36,8 +36,8 @@ class Eval_Dreamer(BaseDataset):  # pylint: disable=locally-disabled, invalid-na
         data = {}
         images = self.images[index]
         measurements = self.measurements[index]
-        sample_start = self.sample_start[index]
-        augment_exists = self.augment_exists[index]
+        sample_start = self.sample_table.frame[index]
+        augment_exists = self.sample_table.augment_exists[index]
         alternative_trajectories = self.alternative_trajectories[index]
 
         ######################################################
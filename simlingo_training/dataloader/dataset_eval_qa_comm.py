@@ -31,8 +31,8 @@ class Data_Eval(BaseDataset):  # pylint: disable=locally-disabled, invalid-name
         data = {}
         images = self.images[index]
         measurements = self.measurements[index]
-        sample_start = self.sample_start[index]
-        augment_exists = self.augment_exists[index]
+        sample_start = self.sample_table.frame[index]
+        augment_exists = self.sample_table.augment_exists[index]
 
         ######################################################
         ######## load current and future measurements ########
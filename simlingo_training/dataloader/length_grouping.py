@@ -0,0 +1,95 @@
+"""
+Length grouped batching of the conversations.
+
+The chat tokens of a batch are padded to the longest conversation. Driving only samples have short answers,
+commentary and QA samples long ones, so a randomly mixed batch is mostly padding for the shorter rows. Which kind
+of conversation a sample gets is drawn in Data_Driving.__getitem__, so the length is only known after loading.
+LengthGroupedDataLoader therefore loads group_factor batches at once (same sampler, so the bucket weights of
+DataModule.setup are unchanged), sorts the samples by the length of their conversation, splits them into
+group_factor batches of batch_size and yields them in random order.
+
+The padding ratio of the chat tokens is reported for the grouped batches and for the same samples batched in
+sampling order, i.e. the ratio without grouping.
+"""
+import random
+
+from simlingo_training.dataloader.prebake import EpochDataLoader
+
+
+def conversation_length(sample):
+    # number of characters of all turns, only used to sort the samples
+    return sum(len(content['text']) for turn in sample.conversation for content in turn['content'] if content['type'] == 'text')
+
+
+def padded_tokens(lengths):
+    # number of padding tokens of a batch that is padded to its longest row
+    return max(lengths) * len(lengths) - sum(lengths)
+
+
+class GroupCollate:
+    """Collate of the data loader workers, returns (list of batches sorted by length in random order, padding stats)."""
+
+    def __init__(self, collate_fn, batch_size):
+        self.collate_fn = collate_fn
+        self.batch_size = batch_size
+
+    def __call__(self, samples):
+        order = sorted(range(len(samples)), key=lambda i: conversation_length(samples[i]))
+        batches, lengths = [], [0] * len(samples)
+        for start in range(0, len(order), self.batch_size):
+            indices = order[start:start + self.batch_size]
+            batch = self.collate_fn([samples[i] for i in indices])
+            for i, length in zip(indices, batch.driving_input.prompt.phrase_mask.sum(dim=1).tolist()):
+                lengths[i] = length
+            batches.append(batch)
+        random.shuffle(batches)
+
+        stats = {
+            'tokens': sum(lengths),
+            'padded_before': sum(padded_tokens(lengths[start:start + self.batch_size]) for start in range(0, len(lengths), self.batch_size)),
+            'padded_after': sum(padded_tokens([lengths[i] for i in order[start:start + self.batch_size]]) for start in range(0, len(order), self.batch_size)),
+        }
+        return batches, stats
+
+
+class LengthGroupedDataLoader(EpochDataLoader):
+    """
+    DataLoader that loads group_factor * batch_size samples per step of its workers and yields group_factor
+    batches of samples with similar conversation length. len() is the number of batches of batch_size.
+    """
+
+    def __init__(self, *args, batch_size=1, group_factor=8, collate_fn=None, report_every=1000, **kwargs):
+        self.group_factor = group_factor
+        self.report_every = report_every
+        self.reset_padding_stats()
+        super().__init__(*args, batch_size=batch_size * group_factor, collate_fn=GroupCollate(collate_fn, batch_size), **kwargs)
+
+    def reset_padding_stats(self):
+        self.padding_stats = {'tokens': 0, 'padded_before': 0, 'padded_after': 0}
+        self.num_groups = 0
+
+    def padding_ratios(self):
+        """(ratio before, ratio after) of padding tokens to all chat tokens since the last reset."""
+        tokens = self.padding_stats['tokens']
+        before = self.padding_stats['padded_before']
+        after = self.padding_stats['padded_after']
+        return before / max(tokens + before, 1), after / max(tokens + after, 1)
+
+    def report(self):
+        before, after = self.padding_ratios()
+        print(f"Chat token padding ratio without length grouping: {before:.3f}, with length grouping: {after:.3f} "
+              f"({self.num_groups} groups of {self.group_factor} batches)", flush=True)
+
+    def __len__(self):
+        return super().__len__() * self.group_factor
+
+    def __iter__(self):
+        self.reset_padding_stats()
+        for batches, stats in super().__iter__():
+            for key, value in stats.items():
+                self.padding_stats[key] += value
+            self.num_groups += 1
+            if self.report_every and self.num_groups % self.report_every == 0:
+                self.report()
+            yield from batches
+        self.report()
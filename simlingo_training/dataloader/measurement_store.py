@@ -0,0 +1,274 @@
+"""
+Packed, memory mapped measurement store.
+
+Every sample reads hist_len + pred_len measurements/XXXX.json.gz files and neighbouring samples read almost the
+same files again. This module packs the fields the data loader uses of all frames of a route into one file
+(measurements_packed.bin): a json header with the layout, followed by one fixed dtype array per field. The file is
+memory mapped once (one file descriptor per open route), so a window of future frames is a slice without
+decompression or json parsing.
+
+Convert a dataset with:
+    python -m simlingo_training.dataloader.measurement_store --data_path database/simlingo --num_workers 16
+Routes without a packed file (or with one older than the json files) are still read from the json files.
+"""
+import argparse
+import errno
+import glob
+import gzip
+import os
+import sys
+from collections import OrderedDict
+from multiprocessing import Pool
+
+import numpy as np
+import ujson
+from tqdm import tqdm
+
+PACKED_VERSION = 2
+PACKED_FILE_SUFFIX = '_packed.bin'
+PACKED_MAGIC = b'SLPACKED'
+# the arrays start at multiples of this (bytes) in the packed file
+PACKED_ALIGNMENT = 64
+
+# name: (dtype, shape of one frame)
+FIXED_FIELDS = {
+    'ego_matrix': (np.float64, (4, 4)),
+    'speed': (np.float64, ()),
+    'target_point': (np.float64, (2,)),
+    'target_point_next': (np.float64, (2,)),
+    'augmentation_rotation': (np.float64, ()),
+    'augmentation_translation': (np.float64, ()),
+    'command': (np.int16, ()),
+    'next_command': (np.int16, ()),
+}
+# fields with a different number of points per frame, stored as flat [P, 2] values plus [N + 1] offsets
+RAGGED_FIELDS = ['route', 'route_original']
+INT_FIELDS = ('command', 'next_command')
+MISSING_INT = -1
+
+
+def _frame_files(measurement_dir):
+    files = {}
+    for file_name in os.listdir(measurement_dir):
+        if file_name.endswith('.json.gz'):
+            files[int(file_name[:-len('.json.gz')])] = file_name
+    return files
+
+
+def _write_packed_file(path, arrays, meta):
+    """Writes arrays (name: ndarray) and meta into one file: magic, header length, json header, aligned arrays."""
+    layout = {}
+    offset = 0
+    for name, values in arrays.items():
+        offset = -(-offset // PACKED_ALIGNMENT) * PACKED_ALIGNMENT
+        layout[name] = {'dtype': values.dtype.str, 'shape': list(values.shape), 'offset': offset}
+        offset += values.nbytes
+    header = ujson.dumps(dict(meta, arrays=layout)).encode('utf-8')
+    data_start = -(-(len(PACKED_MAGIC) + 8 + len(header)) // PACKED_ALIGNMENT) * PACKED_ALIGNMENT
+
+    with open(path, 'wb') as f:
+        f.write(PACKED_MAGIC)
+        f.write(np.uint64(len(header)).tobytes())
+        f.write(header)
+        for name, values in arrays.items():
+            f.seek(data_start + layout[name]['offset'])
+            f.write(np.ascontiguousarray(values).tobytes())
+        f.truncate(data_start + offset)
+
+
+def read_packed_header(path):
+    """Returns (header, byte offset of the arrays) of a packed file."""
+    with open(path, 'rb') as f:
+        if f.read(len(PACKED_MAGIC)) != PACKED_MAGIC:
+            raise ValueError(f'{path} is not a packed measurement file')
+        header_len = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        header = ujson.loads(f.read(header_len).decode('utf-8'))
+    data_start = -(-(len(PACKED_MAGIC) + 8 + header_len) // PACKED_ALIGNMENT) * PACKED_ALIGNMENT
+    return header, data_start
+
+
+def pack_route(measurement_dir):
+    """Packs measurements/XXXX.json.gz of one route into measurements_packed.bin. Returns the number of frames."""
+    packed_file = measurement_dir + PACKED_FILE_SUFFIX
+    files = _frame_files(measurement_dir)
+    num_frames = max(files.keys()) + 1 if len(files) > 0 else 0
+
+    present = np.zeros(num_frames, dtype=bool)
+    fixed = {}
+    for name, (dtype, shape) in FIXED_FIELDS.items():
+        fill = MISSING_INT if name in INT_FIELDS else np.nan
+        fixed[name] = np.full((num_frames,) + shape, fill, dtype=dtype)
+    ragged_values = {name: [] for name in RAGGED_FIELDS}
+    ragged_offsets = {name: np.zeros(num_frames + 1, dtype=np.int64) for name in RAGGED_FIELDS}
+
+    for frame in range(num_frames):
+        measurement = None
+        if frame in files:
+            try:
+                with gzip.open(os.path.join(measurement_dir, files[frame]), 'rt') as f:
+                    measurement = ujson.load(f)
+            except (OSError, ValueError) as e:
+                print(f'Could not read {measurement_dir}/{files[frame]}: {e}')
+
+        if measurement is not None:
+            present[frame] = True
+            for name in FIXED_FIELDS:
+                if measurement.get(name) is not None:
+                    fixed[name][frame] = measurement[name]
+
+        for name in RAGGED_FIELDS:
+            points = [] if measurement is None else measurement.get(name, [])
+            points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+            ragged_values[name].append(points)
+            ragged_offsets[name][frame + 1] = ragged_offsets[name][frame] + len(points)
+
+    arrays = {'present': present}
+    arrays.update(fixed)
+    for name in RAGGED_FIELDS:
+        arrays[name] = np.concatenate(ragged_values[name]) if num_frames > 0 else np.zeros((0, 2))
+        arrays[f'{name}_offsets'] = ragged_offsets[name]
+    meta = {
+        'version': PACKED_VERSION,
+        'num_frames': num_frames,
+        'num_files': len(files),
+    }
+
+    tmp_file = f'{packed_file}.{os.getpid()}.tmp'
+    _write_packed_file(tmp_file, arrays, meta)
+    os.replace(tmp_file, packed_file)
+    return num_frames
+
+
+class PackedMeasurements:
+    """
+    Read access to the packed measurements of one route.
+    Indexing with a frame number returns a dict with the same keys as the json file (only the packed fields).
+    Array values are views into the memory mapped file.
+    """
+
+    def __init__(self, packed_file):
+        self.packed_file = packed_file
+        header, data_start = read_packed_header(packed_file)
+        # a single mapping of the whole file, the fields are views into it
+        data = np.memmap(packed_file, dtype=np.uint8, mode='r')
+        arrays = {}
+        for name, layout in header['arrays'].items():
+            dtype = np.dtype(layout['dtype'])
+            shape = tuple(layout['shape'])
+            start = data_start + layout['offset']
+            count = int(np.prod(shape, dtype=np.int64))
+            arrays[name] = data[start:start + count * dtype.itemsize].view(dtype).reshape(shape)
+
+        self.present = arrays['present']
+        self.fixed = {name: arrays[name] for name in FIXED_FIELDS}
+        self.ragged = {name: (arrays[name], arrays[f'{name}_offsets']) for name in RAGGED_FIELDS}
+
+    def __len__(self):
+        return len(self.present)
+
+    def __getitem__(self, frame):
+        if frame < 0 or frame >= len(self.present) or not self.present[frame]:
+            raise FileNotFoundError(f'{self.packed_file}: frame {frame:04} not found')
+
+        measurement = {}
+        for name, values in self.fixed.items():
+            value = values[frame]
+            if name in INT_FIELDS:
+                if value != MISSING_INT:
+                    measurement[name] = int(value)
+            elif value.ndim == 0:
+                if not np.isnan(value):
+                    measurement[name] = float(value)
+            else:
+                measurement[name] = value
+        for name, (values, offsets) in self.ragged.items():
+            measurement[name] = values[offsets[frame]:offsets[frame + 1]]
+        return measurement
+
+
+def is_packed_up_to_date(measurement_dir):
+    """The packed file is up to date if it has the current version and is newer than the folder and every json file."""
+    packed_file = measurement_dir + PACKED_FILE_SUFFIX
+    try:
+        packed_mtime = os.stat(packed_file).st_mtime_ns
+        header, _ = read_packed_header(packed_file)
+        # the folder mtime changes when files are added or removed, the file mtimes when a file is rewritten
+        source_mtime = os.stat(measurement_dir).st_mtime_ns
+        with os.scandir(measurement_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith('.json.gz'):
+                    source_mtime = max(source_mtime, entry.stat().st_mtime_ns)
+    except (OSError, ValueError):
+        return False
+    return header.get('version') == PACKED_VERSION and packed_mtime >= source_mtime
+
+
+class PackedMeasurementCache:
+    """
+    Keeps the packed stores of the most recently used routes open (per data loader worker).
+    Every open route holds one file descriptor (its memory mapping), max_routes has to stay well below the fd limit.
+    """
+
+    def __init__(self, max_routes=256):
+        self.max_routes = max_routes
+        self.routes = OrderedDict()
+        # result of the (directory scanning) staleness check, kept for routes that were evicted
+        self.up_to_date = {}
+
+    def get(self, measurement_dir):
+        """Returns the PackedMeasurements of a route or None if the route is not (or not correctly) packed."""
+        if measurement_dir in self.routes:
+            self.routes.move_to_end(measurement_dir)
+            return self.routes[measurement_dir]
+
+        if measurement_dir not in self.up_to_date:
+            self.up_to_date[measurement_dir] = is_packed_up_to_date(measurement_dir)
+
+        packed = None
+        if self.up_to_date[measurement_dir]:
+            try:
+                packed = PackedMeasurements(measurement_dir + PACKED_FILE_SUFFIX)
+            except (OSError, ValueError) as e:
+                if isinstance(e, OSError) and e.errno in (errno.EMFILE, errno.ENFILE, errno.ENOMEM):
+                    # out of file descriptors or mappings, not a problem of this route
+                    raise
+                print(f'Could not open packed measurements of {measurement_dir}: {e}')
+
+        self.routes[measurement_dir] = packed
+        if len(self.routes) > self.max_routes:
+            self.routes.popitem(last=False)
+        return packed
+
+
+def _pack_route_worker(measurement_dir):
+    try:
+        pack_route(measurement_dir)
+    except Exception as e:  # pylint: disable=broad-except
+        return f'{measurement_dir}: {e}'
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pack measurements/*.json.gz of every route into memory mapped arrays.')
+    parser.add_argument('--data_path', type=str, default='database/simlingo', help='same as data_module.base_dataset.data_path')
+    parser.add_argument('--num_workers', type=int, default=8)
+    parser.add_argument('--force', action='store_true', help='repack routes that are already up to date')
+    args = parser.parse_args()
+
+    route_dirs = glob.glob(args.data_path + '/data/simlingo/*/*/*/Town*')
+    measurement_dirs = [route_dir + '/measurements' for route_dir in route_dirs if os.path.isdir(route_dir + '/measurements')]
+    if not args.force:
+        measurement_dirs = [m for m in measurement_dirs if not is_packed_up_to_date(m)]
+    print(f'Packing {len(measurement_dirs)} of {len(route_dirs)} routes.')
+
+    errors = []
+    with Pool(args.num_workers) as p:
+        for error in tqdm(p.imap_unordered(_pack_route_worker, measurement_dirs), total=len(measurement_dirs), file=sys.stdout):
+            if error is not None:
+                errors.append(error)
+    for error in errors:
+        print(f'Error: {error}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,321 @@
+"""
+Offline pre-bake of the camera images and label files into sharded, memory mapped arrays.
+
+For every sample the data loader decodes a full resolution jpg (rgb or rgb_augmented) and reads a few small
+.json.gz label files (measurements, commentary, vqa) from the network storage. The pre-bake command walks the
+samples in index order (route by route) and writes the decoded uint8 images of rgb and rgb_augmented and the raw
+label files of every sample into shards of a few thousand samples. PrebakedDataset streams the shards
+sequentially through a shuffle buffer and runs the normal __getitem__ of the wrapped dataset with the pre-baked
+images and files, so the augmentation, crop and prompt sampling are unchanged: imgaug still runs on the full
+resolution image, the crop follows in load_images and the resize to the tile grid in the collate.
+
+Layout of a pre-baked folder:
+    meta.json                       version, image shape, hist_len, pred_len, route folders, shards
+    shard_XXXXX/samples.npy         [N, 2] int32 (route id in meta.json, first frame)
+    shard_XXXXX/rgb.npy             [N, T, H, W, 3] uint8, decoded full resolution images
+    shard_XXXXX/rgb_augmented.npy   same for the shifted camera (zeros if it does not exist)
+    shard_XXXXX/has_augmented.npy   [N] bool
+    shard_XXXXX/labels.npy          [B] uint8, the .json.gz label files of all samples (as stored on disk)
+    shard_XXXXX/label_paths.npy     [F] paths of the label files
+    shard_XXXXX/label_offsets.npy   [F + 1] int64, file f is labels[label_offsets[f]:label_offsets[f + 1]]
+    shard_XXXXX/sample_files.npy    [N + 1] int64, the files of sample i are sample_files[i]:sample_files[i + 1]
+
+The images take ~1.5 MB per image and variant, i.e. more than the jpgs, in exchange for sequential reads and no
+decoding. Create them with:
+    python -m simlingo_training.dataloader.prebake --output_path database/prebaked --num_workers 16 [experiment=...]
+(from the repo root, the dataset paths are relative to it).
+"""
+import argparse
+import os
+import shutil
+import sys
+from multiprocessing import Pool
+
+import cv2
+import numpy as np
+import ujson
+from torch.utils.data import ConcatDataset, DataLoader, IterableDataset, get_worker_info
+from tqdm import tqdm
+
+PREBAKE_VERSION = 2
+VARIANTS = ['rgb', 'rgb_augmented']
+
+
+def load_image(image_path):
+    image = cv2.imread(image_path, cv2.IMREAD_COLOR)
+    if image is None:
+        return None
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+def label_paths(route_dir, frame, hist_len, pred_len, dreamer_folder):
+    """Paths of the label files __getitem__ of Data_Driving and Data_Dreamer reads for the sample starting at frame."""
+    paths = [f'{route_dir}/measurements/{(frame + i):04}.json.gz' for i in range(hist_len + pred_len)]
+    measurement_file_current = paths[hist_len - 1]
+    paths.append(measurement_file_current.replace('measurements', 'commentary').replace('data/', 'commentary/'))
+    paths.append(measurement_file_current.replace('measurements', 'vqa').replace('data/', 'drivelm/'))
+    paths.append(measurement_file_current.replace('measurements', dreamer_folder).replace('data/', f'{dreamer_folder}/'))
+    return paths
+
+
+def _write_shard(args):
+    shard_dir, route_dirs, samples, hist_len, pred_len, rgb_folder, dreamer_folder, image_shape = args
+    tmp_dir = shard_dir + '.tmp'
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    num_samples = len(samples)
+    images = {
+        variant: np.lib.format.open_memmap(f'{tmp_dir}/{variant}.npy', mode='w+', dtype=np.uint8, shape=(num_samples, hist_len) + image_shape)
+        for variant in VARIANTS
+    }
+    has_augmented = np.ones(num_samples, dtype=bool)
+    files, paths = [], []
+    sample_files = np.zeros(num_samples + 1, dtype=np.int64)
+    for i, (route_id, frame) in enumerate(samples):
+        for t in range(hist_len):
+            rgb_path = f'{route_dirs[route_id]}/{rgb_folder}/{(frame + t):04}.jpg'
+            for variant in VARIANTS:
+                image = load_image(rgb_path.replace('rgb', variant))
+                if image is None:
+                    if variant == 'rgb':
+                        raise FileNotFoundError(rgb_path)
+                    has_augmented[i] = False
+                    continue
+                if image.shape != image_shape:
+                    raise ValueError(f'{rgb_path}: image shape {image.shape} differs from {image_shape}')
+                images[variant][i, t] = image
+
+        # label files that do not exist are read (and not found) from the disk as before
+        for path in label_paths(route_dirs[route_id], frame, hist_len, pred_len, dreamer_folder):
+            if os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    files.append(np.frombuffer(f.read(), dtype=np.uint8))
+                paths.append(path)
+        sample_files[i + 1] = len(paths)
+
+    for variant in VARIANTS:
+        images[variant].flush()
+        del images[variant]
+    np.save(f'{tmp_dir}/samples.npy', np.asarray(samples, dtype=np.int32).reshape(-1, 2))
+    np.save(f'{tmp_dir}/has_augmented.npy', has_augmented)
+    np.save(f'{tmp_dir}/labels.npy', np.concatenate(files) if len(files) > 0 else np.zeros(0, dtype=np.uint8))
+    np.save(f'{tmp_dir}/label_paths.npy', np.array(paths, dtype=np.bytes_))
+    np.save(f'{tmp_dir}/label_offsets.npy', np.cumsum([0] + [len(f) for f in files]).astype(np.int64))
+    np.save(f'{tmp_dir}/sample_files.npy', sample_files)
+
+    if os.path.isdir(shard_dir):
+        shutil.rmtree(shard_dir)
+    os.rename(tmp_dir, shard_dir)
+    return num_samples
+
+
+def prebake(dataset, output_path, shard_size=2048, num_workers=8):
+    """Writes the images and label files of all samples of dataset (a BaseDataset) into shards below output_path."""
+    table = dataset.sample_table
+    route_dirs = [str(route_dir, encoding='utf-8') for route_dir in table.route_dirs]
+    samples = np.stack([np.asarray(table.route_id), np.asarray(table.frame)], axis=1)
+    image_shape = load_image(table.image_paths(0)[0]).shape
+
+    os.makedirs(output_path, exist_ok=True)
+    jobs = []
+    shards = []
+    for shard_id, start in enumerate(range(0, len(samples), shard_size)):
+        name = f'shard_{shard_id:05}'
+        shard_samples = samples[start:start + shard_size].tolist()
+        shards.append({'name': name, 'num_samples': len(shard_samples)})
+        jobs.append((f'{output_path}/{name}', route_dirs, shard_samples, dataset.hist_len, dataset.pred_len,
+                     dataset.rgb_folder, table.dreamer_folder, image_shape))
+
+    with Pool(num_workers) as p:
+        for _ in tqdm(p.imap_unordered(_write_shard, jobs), total=len(jobs), file=sys.stdout):
+            pass
+
+    meta = {
+        'version': PREBAKE_VERSION,
+        'hist_len': dataset.hist_len,
+        'pred_len': dataset.pred_len,
+        'image_shape': list(image_shape),
+        'route_dirs': route_dirs,
+        'shards': shards,
+    }
+    with open(f'{output_path}/meta.json', 'w') as f:
+        ujson.dump(meta, f)
+    print(f'Pre-baked {len(samples)} samples into {len(shards)} shards in {output_path}.')
+
+
+class PrebakedDataset(IterableDataset):
+    """
+    Streams pre-baked shards for a BaseDataset (or a ConcatDataset of them).
+
+    Shards are shuffled per epoch and split over all ranks and data loader workers, samples are read sequentially
+    through a shuffle buffer. Only samples that are part of the wrapped dataset are used. Every worker yields a
+    fixed number of samples (wrapping around its shards) so all ranks see the same number of batches.
+    Bucket weights of the BucketSampler are not applied, the shards are streamed uniformly.
+    """
+
+    def __init__(self, dataset, prebaked_path, shuffle_buffer=256, seed=0, num_replicas=1, rank=0):
+        super().__init__()
+        with open(f'{prebaked_path}/meta.json', 'r') as f:
+            self.meta = ujson.load(f)
+        assert self.meta['version'] == PREBAKE_VERSION, f"Pre-baked data in {prebaked_path} has version {self.meta['version']}"
+
+        self.prebaked_path = prebaked_path
+        self.datasets = dataset.datasets if isinstance(dataset, ConcatDataset) else [dataset]
+        self.offsets = np.cumsum([0] + [len(d) for d in self.datasets])
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        self.num_replicas = num_replicas
+        self.rank = rank
+        for d in self.datasets:
+            assert d.hist_len == self.meta['hist_len'], "Pre-baked data has a different hist_len"
+
+        self.shards, self.shard_records, self.shard_indices = self._match_samples()
+        num_matched = sum(len(records) for records in self.shard_records)
+        self.num_samples = num_matched // self.num_replicas
+        print(f'Pre-baked data: {num_matched} of {sum(s["num_samples"] for s in self.meta["shards"])} samples are in the dataset.')
+
+    def _match_samples(self):
+        # per shard: positions in the shard and global indices of the samples that are part of the wrapped dataset
+        keys, indices = [], []
+        prebaked_route_ids = {route_dir: i for i, route_dir in enumerate(self.meta['route_dirs'])}
+        for dataset_id, d in enumerate(self.datasets):
+            route_map = np.full(len(d.sample_table.route_dirs), -1, dtype=np.int64)
+            for i, route_dir in enumerate(d.sample_table.route_dirs):
+                route_map[i] = prebaked_route_ids.get(str(route_dir, encoding='utf-8'), -1)
+            route_ids = route_map[np.asarray(d.sample_table.route_id)]
+            valid = route_ids >= 0
+            keys.append((route_ids[valid] << 32) | np.asarray(d.sample_table.frame, dtype=np.int64)[valid])
+            indices.append(np.nonzero(valid)[0] + self.offsets[dataset_id])
+        keys = np.concatenate(keys) if len(keys) > 0 else np.zeros(0, dtype=np.int64)
+        indices = np.concatenate(indices) if len(indices) > 0 else np.zeros(0, dtype=np.int64)
+        # a sample that is in several buckets is only used once
+        keys, first = np.unique(keys, return_index=True)
+        indices = indices[first]
+
+        shards, shard_records, shard_indices = [], [], []
+        for shard in self.meta['shards']:
+            samples = np.load(f"{self.prebaked_path}/{shard['name']}/samples.npy").astype(np.int64)
+            shard_keys = (samples[:, 0] << 32) | samples[:, 1]
+            position = np.searchsorted(keys, shard_keys).clip(max=max(len(keys) - 1, 0))
+            found = (keys[position] == shard_keys) if len(keys) > 0 else np.zeros(len(shard_keys), dtype=bool)
+            if found.any():
+                shards.append(shard['name'])
+                shard_records.append(np.nonzero(found)[0])
+                shard_indices.append(indices[position[found]])
+        return shards, shard_records, shard_indices
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.num_samples
+
+    def _load_sample(self, index, images, files):
+        dataset_id = int(np.searchsorted(self.offsets, index, side='right')) - 1
+        dataset = self.datasets[dataset_id]
+        dataset.prebaked_images = images
+        dataset.prebaked_files = files
+        try:
+            return dataset[index - self.offsets[dataset_id]]
+        finally:
+            dataset.prebaked_images = None
+            dataset.prebaked_files = None
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        num_workers = worker_info.num_workers if worker_info is not None else 1
+        worker_id = worker_info.id if worker_info is not None else 0
+        total_workers = self.num_replicas * num_workers
+        global_worker = self.rank * num_workers + worker_id
+
+        # same shard order on all ranks and workers, every worker takes its own subset
+        order = np.random.default_rng(self.seed + self.epoch).permutation(len(self.shards))
+        my_shards = order[global_worker::total_workers]
+        if len(my_shards) == 0 and len(order) > 0:
+            my_shards = order[global_worker % len(order):][:1]
+        num_target = self.num_samples // num_workers + int(worker_id < self.num_samples % num_workers)
+        rng = np.random.default_rng([self.seed, self.epoch, global_worker])
+
+        variants = VARIANTS if any(d.img_shift_augmentation for d in self.datasets) else ['rgb']
+        buffer = []
+        num_yielded = 0
+        while num_yielded < num_target and len(my_shards) > 0:
+            for shard_pos in my_shards:
+                shard_dir = f'{self.prebaked_path}/{self.shards[shard_pos]}'
+                arrays = {variant: np.load(f'{shard_dir}/{variant}.npy', mmap_mode='r') for variant in variants}
+                has_augmented = np.load(f'{shard_dir}/has_augmented.npy')
+                labels = np.load(f'{shard_dir}/labels.npy', mmap_mode='r')
+                paths = np.load(f'{shard_dir}/label_paths.npy')
+                label_offsets = np.load(f'{shard_dir}/label_offsets.npy')
+                sample_files = np.load(f'{shard_dir}/sample_files.npy')
+                for record, index in zip(self.shard_records[shard_pos], self.shard_indices[shard_pos]):
+                    # copy out of the memory map while reading the shard sequentially
+                    images = {variant: np.array(arrays[variant][record]) for variant in variants}
+                    if 'rgb_augmented' in images and not has_augmented[record]:
+                        images['rgb_augmented'] = None
+                    files = {
+                        str(paths[f], encoding='utf-8'): labels[label_offsets[f]:label_offsets[f + 1]].tobytes()
+                        for f in range(sample_files[record], sample_files[record + 1])
+                    }
+                    buffer.append((index, images, files))
+                    if len(buffer) < self.shuffle_buffer:
+                        continue
+                    j = rng.integers(len(buffer))
+                    buffer[j], buffer[-1] = buffer[-1], buffer[j]
+                    yield self._load_sample(*buffer.pop())
+                    num_yielded += 1
+                    if num_yielded >= num_target:
+                        return
+            # fewer samples than the shuffle buffer: empty it
+            rng.shuffle(buffer)
+            while len(buffer) > 0 and num_yielded < num_target:
+                yield self._load_sample(*buffer.pop())
+                num_yielded += 1
+
+
+class EpochDataLoader(DataLoader):
+    """DataLoader that passes the epoch to its (iterable) dataset, lightning only calls set_epoch on samplers."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.epoch = 0
+
+    def __iter__(self):
+        if hasattr(self.dataset, 'set_epoch'):
+            self.dataset.set_epoch(self.epoch)
+        self.epoch += 1
+        return super().__iter__()
+
+
+def main():
+    from hydra import compose, initialize
+    from hydra.core.hydra_config import HydraConfig
+    import simlingo_training.config  # noqa: F401, registers the structured configs (train_base, ...)
+    from simlingo_training.dataloader.dataset_driving import Data_Driving
+
+    parser = argparse.ArgumentParser(description='Pre-bake the camera images and label files of the training set into shards.')
+    parser.add_argument('--output_path', type=str, required=True)
+    parser.add_argument('--config_name', type=str, default='config')
+    parser.add_argument('--shard_size', type=int, default=2048)
+    parser.add_argument('--num_workers', type=int, default=8)
+    parser.add_argument('overrides', nargs='*', help='hydra overrides, e.g. experiment=... (run from the repo root)')
+    args = parser.parse_args()
+
+    initialize(config_path="../config")
+    cfg = compose(config_name=args.config_name, overrides=args.overrides, return_hydra_config=True)
+    # BaseDataset resolves its paths with get_original_cwd(), which needs the hydra config of a run
+    HydraConfig.instance().set_config(cfg)
+    dataset = Data_Driving(
+        split="train",
+        bucket_name='all',
+        **cfg.data_module,
+        **cfg.data_module.base_dataset,
+    )
+    prebake(dataset, args.output_path, shard_size=args.shard_size, num_workers=args.num_workers)
+
+
+if __name__ == '__main__':
+    main()
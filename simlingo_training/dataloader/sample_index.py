@@ -0,0 +1,332 @@
+"""
+Persistent on-disk index of the routes of a dataset.
+
+BaseDataset needs, for every route, whether the expert finished it cleanly (results.json.gz) and how many
+frames it has (rgb folder). Computing this means globbing all routes, decompressing every results file and
+listing every rgb folder, which is slow on network storage and is repeated for every bucket, split and rank.
+The index stores these values once per data root and revalidates them with directory mtimes, so only routes
+that changed (or are new) are scanned again.
+
+Bucket membership (buckets_paths.pkl lists the measurement files of every bucket) is stored per frame as a bitmask
+over the bucket keys, so a dataset of a bucket selects its samples with a vectorized mask per route instead of
+looking up every measurement file.
+"""
+import fnmatch
+import glob
+import gzip
+import hashlib
+import os
+import pickle as pkl
+from functools import lru_cache
+
+import numpy as np
+import ujson
+
+SAMPLE_INDEX_VERSION = 1
+BUCKET_INDEX_VERSION = 1
+
+# route level filter outcomes, stored as int8 in the index
+ROUTE_OK = 0
+ROUTE_NO_RESULTS = 1
+ROUTE_RESULTS_LOAD_ERROR = 2
+ROUTE_CRASHED = 3
+
+ROUTE_DTYPE = np.dtype([
+    ('mtime', np.int64),  # mtime_ns of the route folder
+    ('rgb_mtime', np.int64),  # mtime_ns of the rgb folder, -1 if it does not exist
+    ('status', np.int8),
+    ('num_seq', np.int32),  # number of frames in the rgb folder
+])
+
+
+def bucket_frame_dtype(num_keys):
+    # one bit per bucket key, frame i of route r is row frame_starts[r] + i of the bucket table
+    return np.dtype([('buckets', np.uint64, (max(1, -(-num_keys // 64)),))])
+
+
+# the index is loaded (and validated) once per process and then shared by all datasets
+_LOADED_INDICES = {}
+
+
+def _mtime_ns(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return -1
+
+
+def get_route_status(route_dir):
+    """Applies the same route filter as BaseDataset: only keep (almost) perfect expert runs."""
+    if not os.path.isfile(route_dir + '/results.json.gz'):
+        return ROUTE_NO_RESULTS
+
+    with gzip.open(route_dir + '/results.json.gz', 'rt') as f:
+        try:
+            results_route = ujson.load(f)
+        except Exception as e:
+            print(f"Error in {route_dir}")
+            print(e)
+            return ROUTE_RESULTS_LOAD_ERROR
+
+    if results_route['scores']['score_composed'] < 100.0:  # we also count imperfect runs as failed (except minspeedinfractions)
+        cond1 = results_route['scores']['score_route'] > 94.0  # we allow 6% of the route score to be missing
+        cond2 = results_route['num_infractions'] == (len(results_route['infractions']['min_speed_infractions']) + len(results_route['infractions']['outside_route_lanes']))
+        if not (cond1 and cond2):  # if the only problem is minspeedinfractions, keep it
+            return ROUTE_CRASHED
+    return ROUTE_OK
+
+
+@lru_cache(maxsize=8)
+def _load_bucket_dict(bucket_file, mtime):
+    del mtime  # only part of the cache key
+    with open(bucket_file, 'rb') as f:
+        return pkl.load(f)
+
+
+def load_bucket_dict(bucket_file):
+    """Loads buckets_paths.pkl once per process instead of once per bucket."""
+    return _load_bucket_dict(bucket_file, _mtime_ns(bucket_file))
+
+
+class SampleIndex:
+    """
+    Route table for one glob pattern of route folders.
+
+    The table is stored as a structured numpy array next to a json file with the route paths and the cached
+    folder listings that were used to discover them. The numpy file is memory mapped when loaded.
+    """
+
+    def __init__(self, pattern, rgb_folder, index_dir):
+        self.pattern = pattern
+        self.rgb_folder = rgb_folder
+        key = hashlib.sha1(f'{pattern}|{rgb_folder}'.encode('utf-8')).hexdigest()[:16]
+        self.index_dir = index_dir
+        self.meta_file = os.path.join(index_dir, f'{key}.json')
+        self.table_file = os.path.join(index_dir, f'{key}.npy')
+
+        self.bucket_meta_file = os.path.join(index_dir, f'{key}.buckets.json')
+        self.bucket_table_file = os.path.join(index_dir, f'{key}.buckets.npy')
+
+        self.routes = []
+        self.table = np.zeros(0, dtype=ROUTE_DTYPE)
+        self.route_ids = {}
+        self._dirs = {}
+        self.bucket_keys = None
+        self.bucket_table = None
+        self._bucket_source_loaded = None
+
+    def load(self):
+        """Reads the index from disk. Returns False if there is none or it belongs to another version."""
+        if not (os.path.isfile(self.meta_file) and os.path.isfile(self.table_file)):
+            return False
+        try:
+            with open(self.meta_file, 'r') as f:
+                meta = ujson.load(f)
+            table = np.load(self.table_file, mmap_mode='r')
+        except (ValueError, OSError) as e:
+            print(f'Could not read sample index {self.meta_file}: {e}')
+            return False
+
+        if meta.get('version') != SAMPLE_INDEX_VERSION or meta.get('pattern') != self.pattern \
+                or table.dtype != ROUTE_DTYPE or len(table) != len(meta['routes']):
+            return False
+
+        self.routes = meta['routes']
+        self.table = table
+        self.route_ids = {route: i for i, route in enumerate(self.routes)}
+        self._dirs = {path: (mtime, children) for path, mtime, children in meta['dirs']}
+        return True
+
+    def save(self):
+        os.makedirs(self.index_dir, exist_ok=True)
+        meta = {
+            'version': SAMPLE_INDEX_VERSION,
+            'pattern': self.pattern,
+            'rgb_folder': self.rgb_folder,
+            'routes': self.routes,
+            'dirs': [[path, mtime, children] for path, (mtime, children) in self._dirs.items()],
+        }
+        # write to temporary files first, several ranks might update the index at the same time
+        pid = os.getpid()
+        with open(f'{self.table_file}.{pid}.tmp', 'wb') as f:
+            np.save(f, np.ascontiguousarray(self.table))
+        with open(f'{self.meta_file}.{pid}.tmp', 'w') as f:
+            ujson.dump(meta, f)
+        os.replace(f'{self.table_file}.{pid}.tmp', self.table_file)
+        os.replace(f'{self.meta_file}.{pid}.tmp', self.meta_file)
+
+    def _listdir(self, path, listings):
+        mtime = _mtime_ns(path)
+        if mtime == -1:
+            return []
+        cached = self._dirs.get(path)
+        if cached is not None and cached[0] == mtime:
+            children = cached[1]
+        else:
+            children = sorted(os.listdir(path))
+        listings[path] = (mtime, children)
+        return children
+
+    def _expand(self, base, parts, listings):
+        if len(parts) == 0:
+            return [base]
+        head, rest = parts[0], parts[1:]
+        if not glob.has_magic(head):
+            return self._expand(os.path.join(base, head), rest, listings)
+
+        children = self._listdir(base, listings)
+        if not head.startswith('.'):
+            # same as glob, wildcards do not match hidden files
+            children = [child for child in children if not child.startswith('.')]
+        matches = []
+        for child in fnmatch.filter(children, head):
+            child_path = os.path.join(base, child)
+            if len(rest) > 0 and not os.path.isdir(child_path):
+                continue
+            matches.extend(self._expand(child_path, rest, listings))
+        return matches
+
+    def _discover(self):
+        """Same result as glob.glob(pattern), but folders whose mtime did not change are not listed again."""
+        parts = os.path.normpath(self.pattern).split(os.sep)
+        first_magic = next((i for i, part in enumerate(parts) if glob.has_magic(part)), len(parts))
+        base = os.sep.join(parts[:first_magic]) or os.sep
+        if first_magic == len(parts):
+            return [base] if os.path.exists(base) else []
+
+        listings = {}
+        route_dirs = self._expand(base, parts[first_magic:], listings)
+        self._dirs = listings
+        return sorted(route_dirs)
+
+    def update(self):
+        """Brings the index up to date with the file system. Only new or modified routes are scanned."""
+        route_dirs = self._discover()
+
+        table = np.zeros(len(route_dirs), dtype=ROUTE_DTYPE)
+        num_scanned = 0
+        for i, route_dir in enumerate(route_dirs):
+            mtime = _mtime_ns(route_dir)
+            rgb_mtime = _mtime_ns(route_dir + f'/{self.rgb_folder}')
+
+            old_id = self.route_ids.get(route_dir)
+            if old_id is not None and self.table[old_id]['mtime'] == mtime and self.table[old_id]['rgb_mtime'] == rgb_mtime:
+                table[i] = self.table[old_id]
+                continue
+
+            num_scanned += 1
+            status = get_route_status(route_dir)
+            num_seq = 0
+            if status == ROUTE_OK and rgb_mtime != -1:
+                num_seq = len(os.listdir(route_dir + f'/{self.rgb_folder}'))
+            table[i] = (mtime, rgb_mtime, status, num_seq)
+
+        changed = num_scanned > 0 or route_dirs != self.routes
+        self.routes = route_dirs
+        self.table = table
+        self.route_ids = {route: i for i, route in enumerate(self.routes)}
+        print(f'Sample index: {len(route_dirs)} routes, {num_scanned} (re)scanned.')
+        return changed
+
+    def get(self, route_dir):
+        """Returns (status, num_seq) of a route."""
+        entry = self.table[self.route_ids[route_dir]]
+        return int(entry['status']), int(entry['num_seq'])
+
+    def frame_starts(self):
+        """Row of the first frame of every route in the bucket table (plus the total number of frames)."""
+        return np.concatenate(([0], np.cumsum(self.table['num_seq'], dtype=np.int64)))
+
+    def _bucket_source(self, bucket_file, root, source_prefix, target_prefix):
+        # everything the bucket table is derived from, it is rebuilt if any of it changed
+        digest = hashlib.sha1()
+        for route in self.routes:
+            digest.update(route.encode('utf-8') + b'\0')
+        digest.update(np.ascontiguousarray(self.table['num_seq']).tobytes())
+        return {
+            'version': BUCKET_INDEX_VERSION,
+            'bucket_file': bucket_file,
+            'bucket_file_mtime': _mtime_ns(bucket_file),
+            'path_map': [root, source_prefix, target_prefix],
+            'routes': digest.hexdigest(),
+        }
+
+    def _build_bucket_table(self, bucket_file, root, source_prefix, target_prefix):
+        bucket_dict = load_bucket_dict(bucket_file)
+        keys = sorted(bucket_dict.keys())
+        frame_starts = self.frame_starts()
+        num_seq = self.table['num_seq']
+        table = np.zeros(frame_starts[-1], dtype=bucket_frame_dtype(len(keys)))
+        for k, key in enumerate(keys):
+            word, bit = divmod(k, 64)
+            rows = []
+            for run_id in bucket_dict[key]:
+                # same path mapping as the former run_id_dict of BaseDataset
+                measurement_file = os.path.normpath(f"{root}/{run_id.replace(source_prefix, target_prefix)}")
+                measurement_dir, file_name = os.path.split(measurement_file)
+                route_id = self.route_ids.get(os.path.dirname(measurement_dir))
+                if route_id is None or os.path.basename(measurement_dir) != 'measurements':
+                    continue
+                frame = int(file_name.split('.')[0])
+                if frame < num_seq[route_id]:
+                    rows.append(frame_starts[route_id] + frame)
+            table['buckets'][np.asarray(rows, dtype=np.int64), word] |= np.uint64(1 << bit)
+        return keys, table
+
+    def load_buckets(self, bucket_file, root, source_prefix, target_prefix):
+        """
+        Loads (or builds) the per frame bucket membership of buckets_paths.pkl. Measurement file paths of the
+        bucket file are mapped to f"{root}/{run_id.replace(source_prefix, target_prefix)}".
+        """
+        source = self._bucket_source(bucket_file, root, source_prefix, target_prefix)
+        if self.bucket_table is not None and self._bucket_source_loaded == source:
+            return
+        try:
+            with open(self.bucket_meta_file, 'r') as f:
+                meta = ujson.load(f)
+            if meta.get('source') == source:
+                table = np.load(self.bucket_table_file, mmap_mode='r')
+                if table.dtype == bucket_frame_dtype(len(meta['keys'])) and len(table) == self.frame_starts()[-1]:
+                    self.bucket_keys, self.bucket_table, self._bucket_source_loaded = meta['keys'], table, source
+                    return
+        except (ValueError, OSError):
+            pass
+
+        self.bucket_keys, self.bucket_table = self._build_bucket_table(bucket_file, root, source_prefix, target_prefix)
+        self._bucket_source_loaded = source
+        print(f'Sample index: bucket table of {len(self.bucket_keys)} buckets built.')
+
+        os.makedirs(self.index_dir, exist_ok=True)
+        pid = os.getpid()
+        with open(f'{self.bucket_table_file}.{pid}.tmp', 'wb') as f:
+            np.save(f, self.bucket_table)
+        with open(f'{self.bucket_meta_file}.{pid}.tmp', 'w') as f:
+            ujson.dump({'source': source, 'keys': self.bucket_keys}, f)
+        os.replace(f'{self.bucket_table_file}.{pid}.tmp', self.bucket_table_file)
+        os.replace(f'{self.bucket_meta_file}.{pid}.tmp', self.bucket_meta_file)
+
+    def bucket_mask(self, keys):
+        """Boolean mask over all frames of the index: the measurement file of the frame is in any of the buckets keys."""
+        key_mask = np.zeros(self.bucket_table.dtype['buckets'].shape[0], dtype=np.uint64)
+        for key in keys:
+            if key not in self.bucket_keys:
+                raise ValueError(f"Bucket {key} not found.")
+            word, bit = divmod(self.bucket_keys.index(key), 64)
+            key_mask[word] |= np.uint64(1 << bit)
+        return np.any(self.bucket_table['buckets'] & key_mask, axis=1)
+
+
+def get_sample_index(pattern, rgb_folder, index_dir):
+    """
+    Returns the up to date index for the routes matching pattern.
+    It is validated against the file system only the first time it is requested in a process.
+    """
+    index = SampleIndex(pattern, rgb_folder, index_dir)
+    if index.meta_file in _LOADED_INDICES:
+        return _LOADED_INDICES[index.meta_file]
+
+    index.load()
+    if index.update():
+        index.save()
+    _LOADED_INDICES[index.meta_file] = index
+    return index
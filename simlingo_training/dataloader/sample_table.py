@@ -0,0 +1,121 @@
+"""
+Compact sample table for BaseDataset.
+
+The dataset used to keep the image, box and measurement paths of every sample as fixed width np.bytes_ matrices
+(to avoid the refcount copy-on-access problem of python lists in DataLoader workers). They are padded to the
+longest absolute path and get large with millions of samples. Here every route directory is stored once and a
+sample is only (route_id, frame_idx). The int32 arrays are written to a memory mapped file in shared memory, so
+workers map the same pages instead of receiving a copy. Paths are built when a sample is accessed.
+"""
+import atexit
+import os
+import tempfile
+import uuid
+
+import numpy as np
+
+SAMPLE_DTYPE = np.dtype([
+    ('route_id', np.int32),
+    ('frame', np.int32),  # first frame of the sample (sample_start)
+    ('augment_exists', np.bool_),
+])
+
+
+def _shared_dir():
+    # /dev/shm is backed by memory on linux, fall back to the temp dir elsewhere
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+def _remove_file(path, owner_pid):
+    if os.getpid() == owner_pid and os.path.isfile(path):
+        os.remove(path)
+
+
+class SampleTable:
+    """(route_id, frame_idx) table of all samples of a dataset plus the interned route directories."""
+
+    def __init__(self, route_dirs, route_ids, frames, augment_exists, hist_len, rgb_folder, dreamer_folder):
+        self.route_dirs = np.array(route_dirs).astype(np.bytes_)
+        self.hist_len = hist_len
+        self.rgb_folder = rgb_folder
+        self.dreamer_folder = dreamer_folder
+
+        samples = np.zeros(len(route_ids), dtype=SAMPLE_DTYPE)
+        samples['route_id'] = route_ids
+        samples['frame'] = frames
+        samples['augment_exists'] = augment_exists
+
+        self.samples_file = None
+        if len(samples) > 0:
+            self.samples_file = os.path.join(_shared_dir(), f'simlingo_samples_{os.getpid()}_{uuid.uuid4().hex}.npy')
+            np.save(self.samples_file, samples)
+            atexit.register(_remove_file, self.samples_file, os.getpid())
+        self._open(samples)
+
+    def _open(self, samples=None):
+        # empty files can not be memory mapped
+        if self.samples_file is None:
+            self.samples = samples if samples is not None else np.zeros(0, dtype=SAMPLE_DTYPE)
+        else:
+            self.samples = np.load(self.samples_file, mmap_mode='r')
+        self.route_id = self.samples['route_id']
+        self.frame = self.samples['frame']
+        self.augment_exists = self.samples['augment_exists']
+
+    def __getstate__(self):
+        # workers started with spawn (or ddp_spawn) get the file name, not a copy of the arrays
+        state = self.__dict__.copy()
+        for key in ['samples', 'route_id', 'frame', 'augment_exists']:
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def __len__(self):
+        return len(self.samples)
+
+    def route_dir(self, index):
+        return str(self.route_dirs[self.route_id[index]], encoding='utf-8')
+
+    def image_paths(self, index):
+        route_dir, frame = self.route_dir(index), int(self.frame[index])
+        return [f'{route_dir}/{self.rgb_folder}/{(frame + idx):04}.jpg' for idx in range(self.hist_len)]
+
+    def box_paths(self, index):
+        route_dir, frame = self.route_dir(index), int(self.frame[index])
+        return [f'{route_dir}/boxes/{(frame + idx):04}.json.gz' for idx in range(self.hist_len)]
+
+    def measurement_paths(self, index):
+        return [f'{self.route_dir(index)}/measurements']
+
+    def alternative_trajectory_path(self, index):
+        measurement_file = f'{self.route_dir(index)}/measurements/{(int(self.frame[index]) + self.hist_len - 1):04}.json.gz'
+        return measurement_file.replace('measurements', f'{self.dreamer_folder}').replace('data/', f'{self.dreamer_folder}/')
+
+
+class SamplePathView:
+    """
+    Read only view that returns the same values as the former np.bytes_ path arrays,
+    e.g. dataset.images[index] is a np.bytes_ array with hist_len image paths.
+    """
+
+    def __init__(self, table, get_paths):
+        self.table = table
+        self.get_paths = get_paths
+
+    def __len__(self):
+        return len(self.table)
+
+    @property
+    def shape(self):
+        return (len(self.table),)
+
+    def __getitem__(self, index):
+        paths = getattr(self.table, self.get_paths)(index)
+        if isinstance(paths, str):
+            return np.bytes_(paths.encode('utf-8'))
+        return np.array(paths).astype(np.bytes_)
@@ -10,6 +10,7 @@ from pytorch_lightning import Trainer
 from transformers import AutoProcessor, AutoTokenizer
 
 from simlingo_training.config import TrainConfig
+from simlingo_training.utils.inference_checkpoint import is_inference_checkpoint, load_inference_checkpoint
 from simlingo_training.utils.logging_project import setup_logging
 # from simlingo_training.callbacks.visualise import VisualiseCallback
 
@@ -80,15 +81,19 @@ def main(cfg: TrainConfig):
         _recursive_=False
     )
     
-    model = hydra.utils.instantiate(
-        cfg.model,
-        cfg_data_module=cfg.data_module,
-        processor=processor,
-        cache_dir=cache_dir,
-        _recursive_=False
-        )
+    if cfg.checkpoint is not None and is_inference_checkpoint(cfg.checkpoint):
+        # exported bf16 checkpoint with merged LoRA weights, no pretrained weights are loaded
+        model, _, _ = load_inference_checkpoint(cfg.checkpoint, processor=processor, device="cpu")
+    else:
+        model = hydra.utils.instantiate(
+            cfg.model,
+            cfg_data_module=cfg.data_module,
+            processor=processor,
+            cache_dir=cache_dir,
+            _recursive_=False
+            )
 
-    if cfg.checkpoint is not None:
+    if cfg.checkpoint is not None and not is_inference_checkpoint(cfg.checkpoint):
         if os.path.isdir(cfg.checkpoint):
             state_dict = get_fp32_state_dict_from_zero_checkpoint(cfg.checkpoint)
         else:
@@ -124,6 +129,11 @@ def main(cfg: TrainConfig):
   
     print(f"Number of GPUS: {cfg.gpus}")
     overfit = 0
+
+    precision = cfg.precision
+    if cfg.checkpoint is not None and is_inference_checkpoint(cfg.checkpoint):
+        # the weights of an inference checkpoint are bf16, fp16 autocast would run them in a different dtype
+        precision = "bf16-mixed"
     
     if cfg.gpus >= 1:
         trainer = Trainer(
@@ -133,7 +143,7 @@ def main(cfg: TrainConfig):
             gradient_clip_val=0.3,
             log_every_n_steps=20,
             logger=loggers,
-            precision=cfg.precision,
+            precision=precision,
             strategy=strategy,
             sync_batchnorm=True,
             max_epochs=cfg.max_epochs,
@@ -3,18 +3,22 @@ import argparse
 import json
 import numpy as np
 import torch.nn as nn
-import language_evaluation
 from multiprocessing import Pool
 from tqdm import tqdm
 
 import sys
 sys.path.append(".")
 from utils.gpt_eval import *
+from utils.language_metrics import evaluate_language
 
 
 class evaluation_suit():
-    def __init__(self):
-        self.language_eval = language_evaluation.CocoEvaluator(coco_types=["BLEU", "ROUGE_L", "CIDEr", "METEOR", "SPICE"])
+    def __init__(self, judge_scorer=None, language_workers=4, language_cache_dir=None):
+        # AsyncJudgeScorer (utils/gpt_eval.py), if None the pairs are scored with gpt_forward in a process pool
+        self.judge_scorer = judge_scorer
+        # see utils/language_metrics.py
+        self.language_workers = language_workers
+        self.language_cache_dir = language_cache_dir
         self.GPT = []
         self.accuracy = {"answer": [], "GT": []}
         self.language = {"answer": [], "GT": []}
@@ -33,8 +37,11 @@ class evaluation_suit():
         return scores
 
     def eval_chatGPT(self, data):
-        with Pool(16) as p:  # Change the number based on your CPU cores
-            scores_all = p.map(gpt_forward, data)
+        if self.judge_scorer is not None:
+            scores_all = self.judge_scorer.score(data)
+        else:
+            with Pool(16) as p:  # Change the number based on your CPU cores
+                scores_all = p.map(gpt_forward, data)
         
 
         scores = [x for x in scores_all if x != -1]
@@ -51,33 +58,9 @@ class evaluation_suit():
         """
         answer = self.language["answer"]
         GT = self.language["GT"]
-        chunk_size = 500
-        n_total = len(answer)
-
-        # Fast path: single chunk
-        if n_total <= chunk_size:
-            results = self.language_eval.run_evaluation(answer, GT)
-            return {f"val/{k}": float(v) for k, v in results.items()}
-
-        # Split and combine afterwards (weighted by chunk size)
-        results_accumulator = {}
-        total_items = 0
-
-        for i in range(0, n_total, chunk_size):
-            answer_split = answer[i:i + chunk_size]
-            GT_split = GT[i:i + chunk_size]
-            chunk_len = len(answer_split)
-            total_items += chunk_len
-
-            results_gen = self.language_eval.run_evaluation(answer_split, GT_split)
-
-            # Accumulate weighted sums
-            for k, v in results_gen.items():
-                results_accumulator[k] = results_accumulator.get(k, 0.0) + float(v) * chunk_len
-
-        # Weighted mean over all items
-        results_gen_dict = {f"val/{k}": v_sum / total_items for k, v_sum in results_accumulator.items()}
-        return results_gen_dict
+        # chunks are evaluated in parallel and merged to the result of a single evaluation over all samples
+        results = evaluate_language(answer, GT, chunk_size=500, num_workers=self.language_workers, cache_dir=self.language_cache_dir)
+        return {f"val/{k}": float(v) for k, v in results.items()}
 
 
     def forward(self, answer, GT):
@@ -121,7 +104,25 @@ if __name__ == '__main__':
     # get args
     parser = argparse.ArgumentParser(description='Evaluation')
     parser.add_argument('--root_path1', type=str, default="outputs/simlingo/predictions/language_preds_cot_rank_0.json", help='path to prediction file')
+    parser.add_argument('--judge_backend', type=str, default="openai", choices=["openai", "http", "pool"], help='pool: former multiprocessing gpt_forward without cache')
+    parser.add_argument('--judge_model', type=str, default="gpt-4o-2024-08-06")
+    parser.add_argument('--judge_url', type=str, default=None, help='http: url of the judge server, openai: base url of an OpenAI compatible server')
+    parser.add_argument('--judge_cache', type=str, default="outputs/judge_cache.sqlite", help='persistent cache of the judge scores')
+    parser.add_argument('--judge_concurrency', type=int, default=16)
+    parser.add_argument('--judge_batch_size', type=int, default=8)
+    parser.add_argument('--language_workers', type=int, default=4, help='processes for the caption metrics (java, memory heavy)')
+    parser.add_argument('--language_cache_dir', type=str, default=None, help='cache of the per chunk results, to resume interrupted runs')
     args = parser.parse_args()
+
+    if args.judge_backend == "openai":
+        judge_backend = OpenAIJudgeBackend(model=args.judge_model, base_url=args.judge_url)
+    elif args.judge_backend == "http":
+        judge_backend = HTTPJudgeBackend(args.judge_url, name=args.judge_model)
+    else:
+        judge_backend = None
+    judge_scorer = None
+    if judge_backend is not None:
+        judge_scorer = AsyncJudgeScorer(judge_backend, cache_path=args.judge_cache, max_concurrency=args.judge_concurrency, batch_size=args.judge_batch_size)
     
     with open(args.root_path1, 'r') as f :
         pred_file = json.load(f)
@@ -132,7 +133,7 @@ if __name__ == '__main__':
     print("Number of predictions: ", len(pred))
     print("Number of ground truths: ", len(gt))
     
-    evaluation = evaluation_suit()
+    evaluation = evaluation_suit(judge_scorer=judge_scorer, language_workers=args.language_workers, language_cache_dir=args.language_cache_dir)
     
     for i in range(len(pred)):
         evaluation.forward(pred[i], gt[i])
@@ -144,6 +145,6 @@ if __name__ == '__main__':
     print("language score: ", output["language"])
     
     # save the evaluation results
-    save_path = args.root_path1.replace(".json", "_metrics_gpt-4o-2024-08-06.json")
+    save_path = args.root_path1.replace(".json", f"_metrics_{args.judge_model}.json")
     with open(save_path, 'w') as f:
         json.dump(output, f, indent=4)
\ No newline at end of file
@@ -20,6 +20,7 @@ from simlingo_training.models.utils import summarise_losses
 from simlingo_training.utils.custom_types import (DrivingExample, DrivingInput,
                                                 DrivingLabel, DrivingOutput,
                                                 TrainingOutput)
+from simlingo_training.utils.prediction_metrics import PredictionTable
 
 
 pprint = PrettyPrinter().pprint
@@ -129,51 +130,68 @@ class DrivingModel(pl.LightningModule):
 
 
         if self.predict_language:
-            # per batch item because of padding
-            for b_idx, (input_embed, attention_mask) in enumerate(zip(input_embeds_all, attention_masks)):
-                input_embed = input_embed.unsqueeze(0)
-                attention_mask = attention_mask.unsqueeze(0)
-                if self.language_model.variant == 'OpenGVLab/InternVL2-4B':
-                    eos = self.tokenizer.added_tokens_encoder['<|end|>']
-                elif self.language_model.variant == 'OpenGVLab/InternVL2-2B':
-                    eos = self.tokenizer.added_tokens_encoder['<|im_end|>']
-                else:
-                    eos = self.tokenizer.eos_token_id
-
-                # BUG: input_embeds, cot
-                sampled_tokens, input_embeds = self.language_model.greedy_sample(
-                    input_embed,
-                    eos_token_id=eos,
-                    max_new_tokens=100,
-                    input_embed_matrix=self.adaptors.language.embed_tokens.weight,
-                    logit_matrix=self.adaptors.language.lm_head.weight,
-                    attention_mask=attention_mask,
-                    # position_ids=position_ids,
+            if self.language_model.variant == 'OpenGVLab/InternVL2-4B':
+                eos = self.tokenizer.added_tokens_encoder['<|end|>']
+            elif self.language_model.variant == 'OpenGVLab/InternVL2-2B':
+                eos = self.tokenizer.added_tokens_encoder['<|im_end|>']
+            else:
+                eos = self.tokenizer.eos_token_id
+
+            # the prompts are left padded, so the whole batch is sampled at once and every row stops at its own eos
+            sampled_tokens, input_embeds, past_key_values = self.language_model.greedy_sample(
+                input_embeds_all,
+                eos_token_id=eos,
+                max_new_tokens=100,
+                input_embed_matrix=self.adaptors.language.embed_tokens.weight,
+                logit_matrix=self.adaptors.language.lm_head.weight,
+                attention_mask=attention_masks,
+                return_past_key_values=True,
+            )
+
+            # number of generated tokens per row including its eos token
+            is_eos = sampled_tokens == eos
+            num_generated = torch.where(
+                is_eos.any(dim=1),
+                is_eos.int().argmax(dim=1) + 1,
+                torch.full_like(is_eos[:, 0], sampled_tokens.size(1), dtype=torch.long),
+            )
+
+            inputs_driving = self.adaptors.driving(driving_input)
+            if past_key_values is not None:
+                # the image and prompt prefix is already in the cache, only the driving queries are encoded
+                driving_embeds, driving_mask, driving_position_ids = self.build_cached_driving_inputs(
+                    input_embeds, attention_masks, num_generated, inputs_driving["inputs"]
+                )
+                features, logits, _ = self.language_model.forward_cached(
+                    driving_embeds,
+                    attention_mask=driving_mask,
+                    past_key_values=past_key_values,
+                    position_ids=driving_position_ids,
+                )
+            else:
+                driving_embeds, driving_mask, driving_position_ids = self.build_driving_inputs(
+                    input_embeds, attention_masks, num_generated, inputs_driving["inputs"]
+                )
+                features, logits = self.language_model.forward(
+                    driving_embeds,
+                    attention_mask=driving_mask,
+                    position_ids=driving_position_ids,
                 )
-                
-                inputs_driving = self.adaptors.driving(driving_input)
-                input_embed_concat = torch.cat((input_embeds, inputs_driving["inputs"][b_idx].unsqueeze(0)), dim=1)
-                features, logits = self.language_model.forward(input_embed_concat)
-
-                len_driving = inputs_driving["inputs"].size(1)
-
-                driving_features = features[:, -len_driving:]
-                driving_logits = logits[:, -len_driving:]
-                predictions = self.adaptors.driving.get_predictions(driving_features, driving_logits)
-                    
-                for k, v in predictions.items():
-                    if v is not None:
-                        if hasattr(self, k) and getattr(self, k) is not None:
-                            if isinstance(v, torch.Tensor):
-                                setattr(self, k, torch.cat((getattr(self, k), v), dim=0))
-                            elif isinstance(v, list):
-                                getattr(self, k).append(v)
-                            else:
-                                raise NotImplementedError(f"Type of {k} not supported")
-                        else:
-                            setattr(self, k, v)
-                                
-                self.language.append(self.tokenizer.batch_decode(sampled_tokens, skip_special_tokens=True)[0])
+
+            len_driving = inputs_driving["inputs"].size(1)
+
+            driving_features = features[:, -len_driving:]
+            driving_logits = logits[:, -len_driving:]
+            predictions = self.adaptors.driving.get_predictions(driving_features, driving_logits)
+
+            for k, v in predictions.items():
+                if v is not None:
+                    setattr(self, k, v)
+
+            num_generated = num_generated.tolist()
+            self.language = self.tokenizer.batch_decode(
+                [tokens[:n] for tokens, n in zip(sampled_tokens.tolist(), num_generated)], skip_special_tokens=True
+            )
         else:
             # single forward pass same as during training so we can use the same function
             features = self.forward_model(driving_input, adaptor_dict)
@@ -187,6 +205,74 @@ class DrivingModel(pl.LightningModule):
         return self.speed_wps, self.route, self.language
 
 
+    def build_driving_inputs(self,
+        input_embeds: Tensor,
+        prompt_mask: Tensor,
+        num_generated: Tensor,
+        driving_embeds: Tensor,
+    ) -> Tuple[Tensor, Tensor, Tensor]:
+        """
+        Builds the batched input of the driving pass: [prompt, generated tokens up to eos, driving queries] per row.
+        Rows with fewer generated tokens get additional left padding, which is masked out and skipped in the
+        position ids, so every row sees the same positions as if it was processed alone.
+        """
+        prompt_len = prompt_mask.size(1)
+        num_generated = num_generated.to(input_embeds.device)
+        max_generated = int(num_generated.max())
+        extra_pad = max_generated - num_generated
+        total_len = prompt_len + max_generated + driving_embeds.size(1)
+
+        # source position in input_embeds (or the driving queries) for every output position
+        positions = torch.arange(total_len, device=input_embeds.device).unsqueeze(0) - extra_pad.unsqueeze(1)
+        is_pad = positions < 0
+        is_driving = positions >= (prompt_len + num_generated).unsqueeze(1)
+
+        text_index = positions.clamp(0, input_embeds.size(1) - 1)
+        embeds = input_embeds.gather(1, text_index.unsqueeze(-1).expand(-1, -1, input_embeds.size(-1)))
+        driving_index = (positions - (prompt_len + num_generated).unsqueeze(1)).clamp(0, driving_embeds.size(1) - 1)
+        driving = driving_embeds.to(embeds.dtype).gather(1, driving_index.unsqueeze(-1).expand(-1, -1, embeds.size(-1)))
+        embeds = torch.where(is_driving.unsqueeze(-1), driving, embeds)
+        embeds = embeds.masked_fill(is_pad.unsqueeze(-1), 0)
+
+        prompt_part_mask = prompt_mask.gather(1, positions.clamp(0, prompt_len - 1))
+        mask = torch.where(positions < prompt_len, prompt_part_mask, torch.ones_like(prompt_part_mask))
+        mask = mask.masked_fill(is_pad, 0)
+
+        return embeds, mask, positions.clamp(min=0)
+
+
+    def build_cached_driving_inputs(self,
+        input_embeds: Tensor,
+        prompt_mask: Tensor,
+        num_generated: Tensor,
+        driving_embeds: Tensor,
+    ) -> Tuple[Tensor, Tensor, Tensor]:
+        """
+        Builds the input of the driving pass on top of the key/value cache left by greedy_sample.
+        The cache holds the prompt and all but the last sampled token, so the new tokens are
+        [last sampled token, driving queries]. Tokens a row sampled after its eos are masked out and the
+        driving queries of every row continue at the position right after its own eos.
+        """
+        prompt_len = prompt_mask.size(1)
+        num_steps = input_embeds.size(1) - prompt_len
+        num_generated = num_generated.to(input_embeds.device)
+        len_driving = driving_embeds.size(1)
+
+        embeds = torch.cat((input_embeds[:, -1:], driving_embeds.to(input_embeds.dtype)), dim=1)
+
+        generated_mask = torch.arange(num_steps, device=input_embeds.device).unsqueeze(0) < num_generated.unsqueeze(1)
+        mask = torch.cat((
+            prompt_mask,
+            generated_mask.to(prompt_mask.dtype),
+            torch.ones((prompt_mask.size(0), len_driving), dtype=prompt_mask.dtype, device=prompt_mask.device),
+        ), dim=1)
+
+        last_position = torch.full_like(num_generated, prompt_len + num_steps - 1).unsqueeze(1)
+        driving_positions = prompt_len + num_generated.unsqueeze(1) + torch.arange(len_driving, device=input_embeds.device).unsqueeze(0)
+        position_ids = torch.cat((last_position, driving_positions), dim=1)
+
+        return embeds, mask, position_ids
+
     def forward_model(self, 
                       driving_input: DrivingInput, 
                       adaptor_dict: Dict, 
@@ -352,12 +438,10 @@ class DrivingModel(pl.LightningModule):
         save_prediction_path = ckpt_path / "predictions"
         save_prediction_path.mkdir(exist_ok=True, parents=True)
         
-        samples_cot = [i for i, l in enumerate(self.prediction["prompt"]) if "What should the ego do next?" in l]
-        samples_qa = [i for i, l in enumerate(self.prediction["prompt"]) if "Q:" in l]
-        samples_all = [i for i in range(len(self.prediction["prompt"]))]
+        table = PredictionTable(self.prediction)
         language = [(l, l_gt, p) for l, l_gt, p in zip(self.prediction["language"], self.prediction["language_gt"], self.prediction["path"])]
         
-        if len(samples_qa) > 0:
+        if table.masks['qa'].any():
             # sort by templates
             sorted_samples = {} # question: {answer: [language, language_gt]}
             for qa_template, language_sample in zip(self.prediction["qa_templates"], language):
@@ -377,8 +461,8 @@ class DrivingModel(pl.LightningModule):
                 with open(f"{str(save_prediction_path)}/sorted_qa_templates_rank_{self.local_rank}.json", "w") as f:
                     json.dump(sorted_samples, f, indent=4)
         
-        for samples, name in zip([samples_cot, samples_qa, samples_all], ["cot", "qa", "all"]):
-            language_samples = [l for i, l in enumerate(language) if i in samples]
+        for name in ["cot", "qa", "all"]:
+            language_samples = table.language_samples(table.masks[name])
         
             # save language predictions
             save_path_tmp = f"{str(save_prediction_path)}/language_preds_{name}_rank_{self.local_rank}.json"
@@ -387,315 +471,24 @@ class DrivingModel(pl.LightningModule):
                 save_path_tmp = f"{str(save_prediction_path)}/language_preds_{name}_rank_{self.local_rank}_{time}.json"
             with open(save_path_tmp, "w") as f:
                 json.dump(language_samples, f, indent=4)
-            
-        route_preds = self.prediction["route"]
-        route_preds = torch.cat(route_preds, dim=0)
-        route_gt = self.prediction["route_gt"]
-        route_gt = torch.cat(route_gt, dim=0)
-        
-        waypoints_preds = self.prediction["waypoints"]
-        waypoints_preds = torch.cat(waypoints_preds, dim=0)
-        waypoints_gt = self.prediction["waypoints_gt"]
-        waypoints_gt = torch.cat(waypoints_gt, dim=0)
-        
-        # calc distance between wps for 1d wps
-        waypoints_preds_1d = []
-        for i in range(len(waypoints_preds)):
-            waypoint_pred = waypoints_preds[i]
-            waypoints_preds_1d_tmp = torch.tensor([torch.linalg.norm(waypoint_pred[i+1] - waypoint_pred[i]) for i in range(len(waypoint_pred)-1)])
-            # cumsum to get the distance from the start
-            waypoints_preds_1d_tmp = torch.cumsum(waypoints_preds_1d_tmp, dim=0)
-            waypoints_preds_1d_tmp = [[x, 0] for x in waypoints_preds_1d_tmp]
-            waypoints_preds_1d.append(waypoints_preds_1d_tmp)
-        waypoints_preds_1d = torch.tensor(waypoints_preds_1d)
-        
-        waypoints_gt_1d = []
-        for i in range(len(waypoints_gt)):
-            waypoint_gt = waypoints_gt[i]
-            waypoints_gt_1d_tmp = torch.tensor([torch.linalg.norm(waypoint_gt[i+1] - waypoint_gt[i]) for i in range(len(waypoint_gt)-1)])
-            # cumsum to get the distance from the start
-            waypoints_gt_1d_tmp = torch.cumsum(waypoints_gt_1d_tmp, dim=0)
-            waypoints_gt_1d_tmp = [[x, 0] for x in waypoints_gt_1d_tmp]
-            waypoints_gt_1d.append(waypoints_gt_1d_tmp)
-        waypoints_gt_1d = torch.tensor(waypoints_gt_1d)
-        
-        # calculate ade and fde for samples seperatly whihc have <SAFETY> in prompt and for <INSTRUCTION_FOLLOWING>
-        samples_safety = [i for i, l in enumerate(self.prediction["prompt"]) if "<SAFETY>" in l]
-        samples_instruction = [i for i, l in enumerate(self.prediction["prompt"]) if "<INSTRUCTION_FOLLOWING>" in l]
-        samples_neither = [i for i, l in enumerate(self.prediction["prompt"]) if "<SAFETY>" not in l and "<INSTRUCTION_FOLLOWING>" not in l]
-        samples_all = [i for i in range(len(self.prediction["prompt"]))]
         
+        # calculate success rates for samples seperatly whihc have <SAFETY> in prompt and for <INSTRUCTION_FOLLOWING>
+        # NOTE: only the <SAFETY> samples are evaluated (stored under the name "instruction"), as before
         ade_fde = {}
-        
-        def get_desired_end_speed(wps):
-            wp_freq = 5
-            carla_fps = 20
-            # one WP every 0.25 seconds
-            # we want to get speed at the last WP
-            last_wp = wps[-1] #.cpu().numpy()
-            # we want the WP half second earlier than the last WP
-            one_second = int(carla_fps // (wp_freq))
-            half_second = one_second // 2
-            prev_wp = wps[-1 - half_second] #.cpu().numpy()
-            desired_speed = np.linalg.norm(prev_wp - last_wp) * 2.0
-            return desired_speed
-        def get_desired_speed(wps):
-            wp_freq = 5
-            carla_fps = 20
-            # one WP every 0.25 seconds
-            # we want to get speed at the last WP
-            # last_wp = wps[-1] #.cpu().numpy()
-            # we want the WP half second earlier than the last WP
-            one_second = int(carla_fps // (wp_freq))
-            half_second = one_second // 2
-            wp_half_second = wps[half_second] #.cpu().numpy()
-            wp_one_second = wps[one_second] #.cpu().numpy()
-            desired_speed = np.linalg.norm(wp_half_second - wp_one_second) * 2.0
-            return desired_speed
-        
-        def get_desired_avg_speed(wps):
-            wp_freq = 5
-            carla_fps = 20
-            # one WP every 0.25 seconds
-            # we want to get speed at the last WP
-            # last_wp = wps[-1] #.cpu().numpy()
-            # # we want the WP half second earlier than the last WP
-            # one_second = int(carla_fps // (wp_freq))
-            # half_second = one_second // 2
-            first_wp = wps[0] #.cpu().numpy()
-            last_wp = wps[-1] #.cpu().numpy()
-            desired_speed = np.linalg.norm(first_wp - last_wp) / (len(wps) * 0.25)
-            return desired_speed
-        
-        def get_1d_wps(wps):
-            waypoints_1d = [np.linalg.norm(wps[i+1] - wps[i]) for i in range(len(wps)-1)]
-            # cumsum to get the distance from the start
-            waypoints_1d = np.cumsum(waypoints_1d)
-            waypoints_1d = [[x, 0] for x in waypoints_1d]
-            
-            # prepend 0,0
-            waypoints_1d = [[0, 0]] + waypoints_1d
-            
-            return np.array(waypoints_1d).reshape(-1, 2)
-        
-            
-        wp_freq = 5
-        carla_fps = 20
-            
-        
-        for samples, name in zip([samples_safety, samples_instruction, samples_neither, samples_all], ["instruction"]):
-            if len(samples) == 0:
+        category_masks = [table.masks['safety'], table.masks['instruction'], table.masks['neither'], table.masks['all']]
+        for mask, name in zip(category_masks, ["instruction"]):
+            if not mask.any():
                 continue
-            route_preds_sample = route_preds[samples].cpu().numpy()
-            route_gt_sample = route_gt[samples].cpu().numpy()
-            waypoints_preds_sample = waypoints_preds[samples].cpu().numpy()
-            waypoints_gt_sample = waypoints_gt[samples].cpu().numpy()
-            eval_infos_sample = [self.prediction["eval_infos"][i] for i in samples]
-            waypoints_org_sample = [eval_infos_sample[i]["org_wps"] for i in range(len(samples))]
-            route_org_sample = [eval_infos_sample[i]["org_path"] for i in range(len(samples))]
-            waypoints_instruction_sample = [np.array(eval_infos_sample[i]["new_wps"]) for i in range(len(samples))]
-            route_instruction_sample = [eval_infos_sample[i]["new_path"] for i in range(len(samples))]
-            prompts = [self.prediction["prompt"][i].replace("<IMG_CONTEXT>", "") for i in samples]
-            pred_language = [self.prediction["language"][i] for i in samples]
-            paths = [self.prediction["path"][i] for i in samples]
-            
-            success_rate_all = []
-            success_rate_by_mode = {}
-            success_rate_by_allowed = {}
-            
-            paths_by_mode = {}
-            
-            for i in range(len(samples)):
-                mode = eval_infos_sample[i]["mode"]
-                allowed = eval_infos_sample[i]['allowed']
-                sample_path = paths[i]
-                
-                # Initialize mode in dictionary if not present
-                if mode not in success_rate_by_mode:
-                    success_rate_by_mode[mode] = []
-                if mode not in paths_by_mode:
-                    paths_by_mode[mode] = []
-                
-                # Initialize allowed in dictionary if not present
-                if allowed not in success_rate_by_allowed:
-                    success_rate_by_allowed[allowed] = []
-                
-                # get desired speed form WPs
-                desired_end_speed_pred = get_desired_end_speed(waypoints_preds_sample[i])
-                desired_end_speed_gt = get_desired_end_speed(waypoints_gt_sample[i])
-                desired_end_speed_org = get_desired_end_speed(waypoints_org_sample[i])
-                desired_end_speed_instruction = get_desired_end_speed(waypoints_instruction_sample[i])
-                
-                desired_speed_pred = get_desired_speed(waypoints_preds_sample[i])
-                desired_speed_gt = get_desired_speed(waypoints_gt_sample[i])
-                desired_speed_org = get_desired_speed(waypoints_org_sample[i])
-                desired_speed_instruction = get_desired_speed(waypoints_instruction_sample[i])
-                
-                desired_avg_speed_pred = get_desired_avg_speed(waypoints_preds_sample[i])
-                desired_avg_speed_gt = get_desired_avg_speed(waypoints_gt_sample[i])
-                desired_avg_speed_org = get_desired_avg_speed(waypoints_org_sample[i])
-                desired_avg_speed_instruction = get_desired_avg_speed(waypoints_instruction_sample[i])
-
-                
-                pred_wps_1d = get_1d_wps(waypoints_preds_sample[i])
-                pred_wps_1d_diffs = np.diff(pred_wps_1d[:, 0])
-                pred_speeds = pred_wps_1d_diffs / (wp_freq/carla_fps)
-                
-                org_wps_1d = get_1d_wps(waypoints_org_sample[i])
-                org_wps_1d_diffs = np.diff(org_wps_1d[:, 0])
-                org_speeds = org_wps_1d_diffs / (wp_freq/carla_fps)
-                
-                instruction_wps_1d = get_1d_wps(waypoints_instruction_sample[i])
-                instruction_wps_1d_diffs = np.diff(instruction_wps_1d[:, 0])
-                instruction_speeds = instruction_wps_1d_diffs / (wp_freq/carla_fps)
-                
-                x = np.arange(len(pred_speeds))*0.25
-                
-                # linear regression np
-                slope_pred, intercept_pred = np.polyfit(x, pred_speeds, 1)
-                slope_org, intercept_org = np.polyfit(x, org_speeds, 1)
-                slope_instruction, intercept_instruction = np.polyfit(x, instruction_speeds, 1)
-                
-                current_speed = float(prompts[i].split("Current speed: ")[-1].split(" ")[0])
-                
-                if mode == 'stop':
-                    # route doesnt matter
-                    paths_by_mode[mode].append(sample_path)
-                    if name == 'instruction' or name == 'neither':
-                        if np.min(pred_speeds) < 0.1:
-                            success_rate_all.append(1)
-                            success_rate_by_mode[mode].append(1)
-                            success_rate_by_allowed[allowed].append(1)
-                        else:
-                            success_rate_all.append(0)
-                            success_rate_by_mode[mode].append(0)
-                            success_rate_by_allowed[allowed].append(0)
-                            
-                elif mode == 'slower':
-                    paths_by_mode[mode].append(sample_path)
-
-                    if name == 'instruction' or name == 'neither':
-                        # forced instruction following
-                        if slope_pred < (-0.05 * current_speed):
-                            success_rate_all.append(1)
-                            success_rate_by_mode[mode].append(1)
-                            success_rate_by_allowed[allowed].append(1)
-                        else:
-                            success_rate_all.append(0)
-                            success_rate_by_mode[mode].append(0)
-                            success_rate_by_allowed[allowed].append(0)
-                        
-                elif mode == 'faster':
-                    paths_by_mode[mode].append(sample_path)
-                    
-                    if name == 'instruction' or name == 'neither':
-                        # forced instruction following
-                        if slope_pred > (0.05 * current_speed):
-                            success_rate_all.append(1)
-                            success_rate_by_mode[mode].append(1)
-                            success_rate_by_allowed[allowed].append(1)
-                        else:
-                            success_rate_all.append(0)
-                            success_rate_by_mode[mode].append(0)
-                            success_rate_by_allowed[allowed].append(0)
-                elif mode == 'target_speed':
-                    paths_by_mode[mode].append(sample_path)
-                    
-                    try:
-                        target_speed = float(prompts[i].split("Target waypoint: ")[-1].split("Command")[-1].split(".<|im_end|>")[0].split(" ")[-2])
-                    except:
-                        target_speed = float(prompts[i].split("Target waypoint: ")[-1].split("Command")[-1].split(".<|im_end|>")[0].split(" ")[-3])
-                    # ade from pred to instruction WP should be closer than to the GT WP
-                    # ade_pred_org = np.mean(np.linalg.norm(waypoints_preds_sample[i] - waypoints_org_sample[i], axis=-1))
-                    # ade_pred_instruction = np.mean(np.linalg.norm(waypoints_preds_sample[i] - waypoints_instruction_sample[i], axis=-1))
-                    if name == 'instruction' or name == 'neither':
-                        if ((desired_end_speed_pred > 0.8 * desired_end_speed_instruction and desired_end_speed_pred < 1.2 * desired_end_speed_instruction) or (desired_end_speed_pred > 0.8 * target_speed and desired_end_speed_pred < 1.2 * target_speed)):
-                            success_rate_all.append(1)
-                            success_rate_by_mode[mode].append(1)
-                            success_rate_by_allowed[allowed].append(1)
-                        else:
-                            success_rate_all.append(0)
-                            success_rate_by_mode[mode].append(0)
-                            success_rate_by_allowed[allowed].append(0)
-                    
-                elif mode == 'lane_change':
-                    paths_by_mode[mode].append(sample_path)
-                    
-                    # on path
-                    fde_pred_org = np.linalg.norm(route_preds_sample[i][-1] - route_org_sample[i][-1], axis=-1)
-                    fde_pred_instruction = np.linalg.norm(route_preds_sample[i][-1] - route_instruction_sample[i][-1], axis=-1)
-                    if name == 'instruction' or name == 'neither':
-                        if fde_pred_instruction < fde_pred_org:
-                            success_rate_all.append(1)
-                            success_rate_by_mode[mode].append(1)
-                            success_rate_by_allowed[allowed].append(1)
-                        else:
-                            success_rate_all.append(0)
-                            success_rate_by_mode[mode].append(0)
-                            success_rate_by_allowed[allowed].append(0)
-                elif mode == 'crash':
-                    paths_by_mode[mode].append(sample_path)
-                    
-                    ade_path_org_instruction = np.mean(np.linalg.norm(route_org_sample[i] - route_instruction_sample[i], axis=-1))
-                    ade_path_pred_org = np.mean(np.linalg.norm(route_preds_sample[i] - route_org_sample[i], axis=-1))
-                    ade_path_pred_instruction = np.mean(np.linalg.norm(route_preds_sample[i] - route_instruction_sample[i], axis=-1))
-                    if ade_path_org_instruction > 1.0:
-                        if name == 'instruction' or name == 'neither':
-                            if ade_path_pred_instruction < ade_path_pred_org:
-                                success_rate_all.append(1)
-                                success_rate_by_mode[mode].append(1)
-                                success_rate_by_allowed[allowed].append(1)
-                            else:
-                                success_rate_all.append(0)
-                                success_rate_by_mode[mode].append(0)
-                                success_rate_by_allowed[allowed].append(0)
-                    else:
-                        if name == 'instruction' or name == 'neither':
-                            if ade_path_pred_instruction < 1.0 and (np.mean(pred_speeds) < 1.3 * np.mean(instruction_speeds) or np.mean(pred_speeds) > 0.7 * np.mean(instruction_speeds)):
-                                success_rate_all.append(1)
-                                success_rate_by_mode[mode].append(1)
-                                success_rate_by_allowed[allowed].append(1)
-                            else:
-                                success_rate_all.append(0)
-                                success_rate_by_mode[mode].append(0)
-                                success_rate_by_allowed[allowed].append(0)
-
-                else:
-                    print(f"Unknown mode: {mode} in sample {i} with path {sample_path}")
-                                
+            per_sample_results, metrics = table.instruction_metrics(mask, name)
+            ade_fde.update(metrics)
+
             # save result per sample
-            per_sample_results = {
-                'paths_by_mode': paths_by_mode,
-                'success_rate_by_mode': success_rate_by_mode
-            }
             save_path_tmp = f"{str(save_prediction_path)}/results_per_sample_{name}_rank_{self.local_rank}.json"
             if os.path.exists(save_path_tmp):
                 time = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
                 save_path_tmp = f"{str(save_prediction_path)}/results_per_sample_{name}_rank_{self.local_rank}_{time}.json"
             with open(save_path_tmp, "w") as f:
                 json.dump(per_sample_results, f, indent=4)
-            
-            if len(success_rate_all) > 0:
-                total_success_rate = sum(success_rate_all) / len(success_rate_all)
-                ade_fde.update({f"success_rate_total_{name}": total_success_rate})
-            else:
-                ade_fde.update({f"success_rate_total_{name}": 0})
-                
-            min_samples_per_mode = min([len(success_rate_by_mode[mode]) for mode in success_rate_by_mode])
-            balanced_total_success_rate = 0
-            # Calculate success rate for each mode
-            for mode in success_rate_by_mode:
-                if len(success_rate_by_mode[mode]) > 0:
-                    success_rate = sum(success_rate_by_mode[mode]) / len(success_rate_by_mode[mode])
-                    ade_fde.update({f"success_rate_{name}_{mode}": success_rate})
-                else:
-                    ade_fde.update({f"success_rate_{name}_{mode}": 0})
-                
-            ade_route = np.mean(np.linalg.norm(route_preds_sample - route_gt_sample, axis=-1), axis=-1)
-            
-            ade_fde.update({
-                f"num_samples_{name}": len(ade_route),
-            })
 
         save_path_tmp = f"{str(save_prediction_path)}/dreamer_results_rank_{self.local_rank}.json"
         if os.path.exists(save_path_tmp):
@@ -1,12 +1,24 @@
 import torch
 from torch import nn
 from typing import List, Optional
-from transformers import AutoModel
+from transformers import AutoConfig, AutoModel
+
+
+def load_internvl(variant, pretrained=True):
+    """InternVL chat model, with empty (meta) parameters if pretrained is False (weights come from a checkpoint)."""
+    if pretrained:
+        return AutoModel.from_pretrained(variant, trust_remote_code=True)
+    from accelerate import init_empty_weights
+
+    config = AutoConfig.from_pretrained(variant, trust_remote_code=True)
+    with init_empty_weights():
+        return AutoModel.from_config(config, trust_remote_code=True)
+
 
 class LingoInternVLModel(nn.Module):
-    def __init__(self, variant, *args, **kwargs):
+    def __init__(self, variant, *args, pretrained=True, **kwargs):
         super().__init__()
-        self.model = AutoModel.from_pretrained(variant, trust_remote_code=True)
+        self.model = load_internvl(variant, pretrained)
         try:
             self.num_embeddings = self.model.language_model.model.embed_tokens.num_embeddings
         except:
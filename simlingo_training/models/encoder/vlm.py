@@ -20,7 +20,7 @@ class VLMEncoderModel(nn.Module):
         self.token_size = self.embed_dim
 
         if 'internvl2' in self.variant.lower():
-            self.image_encoder = LingoInternVLModel(self.variant, *cfg)
+            self.image_encoder = LingoInternVLModel(self.variant, *cfg, pretrained=getattr(self, 'pretrained', True))
         else:
             raise ValueError(f"Unknown variant {self.variant}")
         
@@ -5,12 +5,15 @@ from transformers import GPTNeoXForCausalLM
 from transformers import LlavaNextProcessor, LlavaNextForConditionalGeneration
 from transformers import AutoModel, AutoTokenizer
 
+import time
 from typing import Any, Dict, Optional, Tuple
 from torch.nn import functional as F
 
 import torch
 from torch import Tensor, nn
 
+from simlingo_training.models.encoder.internvl2_model import load_internvl
+
 CONFIGS: Dict[str, Dict[str, Any]] = {
     "debug": dict(num_hidden_layers=2, num_attention_heads=2, hidden_size=32, intermediate_size=64),
     "legacy-tiny": dict(num_hidden_layers=8, num_attention_heads=16, hidden_size=2048, intermediate_size=4096),
@@ -85,7 +88,7 @@ class LLM(nn.Module):
             self.model = self.model.language_model
             self.model.embed_tokens = self.model.base_model.embed_tokens
         elif 'internvl' in self.variant.lower():
-            self.model = AutoModel.from_pretrained(self.variant, trust_remote_code=True)
+            self.model = load_internvl(self.variant, getattr(self, 'pretrained', True))
             self.model = self.model.language_model
             try:
                 self.model.embed_tokens = self.model.base_model.embed_tokens
@@ -142,6 +145,31 @@ class LLM(nn.Module):
 
         return features, logits
 
+    def forward_cached(self,
+        embeddings: Tensor,
+        attention_mask: Tensor = None,
+        past_key_values: Optional[Any] = None,
+        position_ids: Optional[Tensor] = None,
+    ) -> Tuple[Tensor, Tensor, Any]:
+        """
+        Same as forward but reuses and returns the key/value cache of the underlying HF model.
+        embeddings only contains the tokens that are not in past_key_values yet, attention_mask covers
+        the cached and the new tokens.
+        """
+        outputs = self.model(
+            inputs_embeds=embeddings,
+            attention_mask=attention_mask,
+            output_hidden_states=True,
+            position_ids=position_ids,
+            past_key_values=past_key_values,
+            use_cache=True,
+            return_dict=True,
+        )
+        features = outputs.hidden_states[-1]
+        logits = outputs[0]
+
+        return features, logits, outputs.past_key_values
+
     def sample_categorical(
         self,
         logits: Tensor,
@@ -190,7 +218,16 @@ class LLM(nn.Module):
         restrict_tokens: Optional[Tuple[int, int]] = None,
         attention_mask = None,
         position_ids = None,
+        use_kv_cache: bool = True,
+        return_past_key_values: bool = False,
     ) -> Tuple[Tensor, int]:
+        """
+        Greedy (or temperature) sampling of up to max_new_tokens tokens.
+        With use_kv_cache the prefix is encoded once and every step only feeds the newest token embedding,
+        otherwise the whole growing sequence is encoded again in every step. Both give the same tokens.
+        With return_past_key_values the cache is returned as third value (None without use_kv_cache). It covers
+        all returned input_embeds except the last sampled token, which was never fed to the model.
+        """
         
         if input_embed_matrix is None:
             if self.embed_tokens is None:
@@ -212,14 +249,28 @@ class LLM(nn.Module):
         if eos_token_id is not None:
             sampled_tokens.fill_(eos_token_id)
 
+        if attention_mask is None:
+            attention_mask = torch.ones(input_embeds.shape[:2], dtype=torch.long, device=input_embeds.device)
+
         # we start with all sequences left to complete
         incomplete_seq_mask = torch.ones(input_embeds.size(0), dtype=torch.bool, device=input_embeds.device)
+        past_key_values = None
+        step_embeds = input_embeds
+        step_position_ids = position_ids
         for i in range(max_new_tokens):
-            features, logits = self.forward(
-                embeddings=input_embeds, 
-                attention_mask=attention_mask,
-                position_ids=position_ids,
-            )
+            if use_kv_cache:
+                features, _, past_key_values = self.forward_cached(
+                    embeddings=step_embeds,
+                    attention_mask=attention_mask,
+                    past_key_values=past_key_values,
+                    position_ids=step_position_ids,
+                )
+            else:
+                features, logits = self.forward(
+                    embeddings=input_embeds, 
+                    attention_mask=attention_mask,
+                    position_ids=position_ids,
+                )
 
             last_hidden_state = features[:, -1]
 
@@ -232,7 +283,10 @@ class LLM(nn.Module):
             x = F.embedding(next_token.unsqueeze(1), input_embed_matrix)
 
             input_embeds = torch.cat([input_embeds, x], dim=1)
-            attention_mask = torch.cat([attention_mask, torch.ones((input_embeds.size(0), 1), device=input_embeds.device)], dim=1)
+            attention_mask = torch.cat([attention_mask, torch.ones((input_embeds.size(0), 1), dtype=attention_mask.dtype, device=input_embeds.device)], dim=1)
+            step_embeds = x
+            if step_position_ids is not None:
+                step_position_ids = step_position_ids[:, -1:] + 1
 
             # only update sequences where we haven't predicted the eos token before
             sampled_tokens[incomplete_seq_mask, i] = next_token[incomplete_seq_mask]
@@ -247,9 +301,66 @@ class LLM(nn.Module):
                     sampled_tokens = sampled_tokens[:, : i + 1]
                     break
 
+        if return_past_key_values:
+            return sampled_tokens, input_embeds, past_key_values
         return sampled_tokens, input_embeds
 
 
+def benchmark_greedy_sample(llm: LLM, prefix_len: int = 600, max_new_tokens: int = 100, batch_size: int = 1, repeats: int = 3):
+    """
+    Compares greedy decoding with and without key/value cache on a random prefix.
+    Returns the tokens/s of both paths and whether they sampled the same tokens.
+    """
+    param = next(llm.parameters())
+    embed_matrix = llm.model.embed_tokens.weight
+    if hasattr(llm.model, "lm_head"):
+        logit_matrix = llm.model.lm_head.weight
+    else:
+        logit_matrix = llm.model.base_model.model.output.weight
+
+    prefix_ids = torch.randint(0, embed_matrix.size(0), (batch_size, prefix_len), device=param.device)
+    prefix = F.embedding(prefix_ids, embed_matrix).to(param.dtype)
+    attention_mask = torch.ones((batch_size, prefix_len), dtype=torch.long, device=param.device)
+
+    results = {}
+    sampled = {}
+    for use_kv_cache in [False, True]:
+        timings = []
+        for _ in range(repeats):
+            if param.device.type == 'cuda':
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            with torch.inference_mode():
+                tokens, _ = llm.greedy_sample(
+                    prefix,
+                    max_new_tokens=max_new_tokens,
+                    input_embed_matrix=embed_matrix,
+                    logit_matrix=logit_matrix,
+                    attention_mask=attention_mask,
+                    use_kv_cache=use_kv_cache,
+                )
+            if param.device.type == 'cuda':
+                torch.cuda.synchronize()
+            timings.append(time.perf_counter() - start)
+        name = 'kv_cache' if use_kv_cache else 'full_recompute'
+        sampled[name] = tokens
+        results[f'{name}_tokens_per_s'] = tokens.numel() / min(timings)
+
+    results['identical'] = bool(torch.equal(sampled['kv_cache'], sampled['full_recompute']))
+    return results
+
+
 if __name__ == "__main__":
-    model = LLM("x-small", False)
-    print(model)
\ No newline at end of file
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark greedy decoding with and without key/value cache.')
+    parser.add_argument('--variant', type=str, default='OpenGVLab/InternVL2-1B')
+    parser.add_argument('--prefix_len', type=int, default=600)
+    parser.add_argument('--max_new_tokens', type=int, default=100)
+    parser.add_argument('--batch_size', type=int, default=1)
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    dtype = torch.bfloat16 if device.type == 'cuda' else torch.float32
+    model = LLM(variant=args.variant, lora=False).to(device, dtype=dtype).eval()
+    print(benchmark_greedy_sample(model, prefix_len=args.prefix_len, max_new_tokens=args.max_new_tokens, batch_size=args.batch_size))
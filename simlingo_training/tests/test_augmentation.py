@@ -0,0 +1,68 @@
+"""
+Tests the batched torch image augmentation (img_augmentation_backend="torch") against the imgaug pipeline, one
+augmentation at a time, with the Kolmogorov-Smirnov statistic of per image statistics, and the shared parameters of
+the tiles of one sample.
+"""
+import pytest
+
+torch = pytest.importorskip("torch")
+
+import torch.nn.functional as F  # noqa: E402
+
+from simlingo_training.dataloader.augmentation import AUGMENTATIONS, BatchImageAugmenter, compare_with_imgaug  # noqa: E402
+
+BATCH_SIZE = 32
+NUM_BATCHES = 8
+# with 256 samples per pipeline the KS statistic of two identical distributions stays below ~0.17 (p = 0.001), the
+# bounds leave room for the documented implementation differences (kernel truncation, interpolation order)
+KS_THRESHOLDS = {
+    'gaussian_blur': 0.25,
+    'additive_gaussian_noise': 0.25,
+    'dropout': 0.25,
+    'multiply': 0.25,
+    'linear_contrast': 0.25,
+    'grayscale': 0.25,
+    # imgaug remaps with cubic interpolation, the torch version samples bilinearly (affects the gradient energy)
+    'elastic_transformation': 0.4,
+    'cutout_boxes': 0.25,
+}
+
+
+@pytest.fixture(scope="module")
+def images():
+    # one low frequency random image repeated, the spread of the statistics then only comes from the augmentation
+    generator = torch.Generator().manual_seed(0)
+    low = torch.randint(0, 256, (1, 3, 12, 32), generator=generator).float()
+    image = F.interpolate(low, size=(128, 256), mode='bilinear', align_corners=False).round().to(torch.uint8)
+    return image.repeat(BATCH_SIZE, 1, 1, 1)
+
+
+def test_thresholds_cover_all_augmentations():
+    assert set(KS_THRESHOLDS) == set(AUGMENTATIONS)
+
+
+@pytest.mark.parametrize("augmentation", AUGMENTATIONS)
+def test_augmentation_matches_imgaug(images, augmentation):
+    imgaug = pytest.importorskip("imgaug")
+    pytest.importorskip("scipy")
+    imgaug.seed(0)
+    result = compare_with_imgaug(images, num_batches=NUM_BATCHES, augmentation=augmentation)
+
+    for statistic, value in result.items():
+        assert value['ks_statistic'] <= KS_THRESHOLDS[augmentation], f"{augmentation} {statistic}: {value}"
+
+
+def test_tiles_of_a_sample_share_parameters():
+    # constant tiles: with the per pixel augmentations left out every tile of a sample has to come out identical
+    num_samples, tiles_per_sample = 16, 3
+    augmenter = BatchImageAugmenter(prob=0.5, seed=0, augmentations=['gaussian_blur', 'multiply', 'linear_contrast', 'grayscale'])
+    colors = torch.randint(0, 256, (num_samples, 3, 1, 1), generator=torch.Generator().manual_seed(0))
+    tiles = colors.repeat_interleave(tiles_per_sample, dim=0).expand(-1, -1, 16, 16).to(torch.uint8)
+    groups = torch.arange(num_samples).repeat_interleave(tiles_per_sample)
+
+    out = augmenter(tiles, groups=groups).view(num_samples, tiles_per_sample, 3, 16, 16)
+
+    assert (out == out[:, :1]).all()
+    # the parameters still differ between the samples
+    assert (out[:, 0] != tiles.view(num_samples, tiles_per_sample, 3, 16, 16)[:, 0]).any(dim=(1, 2, 3)).sum() > 1
+    assert augmenter.groups is None
@@ -0,0 +1,50 @@
+"""
+Tests the batched tensor image preprocessing (image_preprocessing="tensor") against the PIL pipeline of InternVL2.
+"""
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchvision")
+pytest.importorskip("transformers")
+
+from simlingo_training.utils.internvl2_utils import IMAGENET_STD, compare_image_preprocessing  # noqa: E402
+
+# PIL rounds to uint8 between its horizontal and vertical pass and uses fixed point weights, the torch kernel
+# rounds once at the end. Pixels can differ by one level, a fraction of them do.
+MAX_LEVEL_DIFF = 1
+MAX_MEAN_LEVEL_DIFF = 0.25
+# one uint8 level in normalized pixel values is 1 / (255 * std)
+MAX_ABS_DIFF = MAX_LEVEL_DIFF / (255 * min(IMAGENET_STD)) + 1e-5
+
+
+def camera_images(batch_size, height, width, seed=0):
+    """Smooth gradients with noise, closer to camera images than uniform noise."""
+    generator = torch.Generator().manual_seed(seed)
+    y = torch.linspace(0, 1, height).view(1, 1, height, 1)
+    x = torch.linspace(0, 1, width).view(1, 1, 1, width)
+    phase = torch.rand(batch_size, 3, 1, 1, generator=generator) * 6.28
+    images = 127.5 + 80 * torch.sin(6 * x + 3 * y + phase)
+    images = images + 30 * torch.randn(batch_size, 3, height, width, generator=generator)
+    return images.clamp(0, 255).round().to(torch.uint8)
+
+
+@pytest.mark.parametrize("height,width", [
+    (359, 1024),  # front camera 512x1024 with the bonnet cropped (training and agent)
+    (512, 1024),
+    (448, 448),
+    (300, 700),
+])
+@pytest.mark.parametrize("use_global_img", [False, True])
+def test_tensor_preprocessing_matches_pil(height, width, use_global_img):
+    diff = compare_image_preprocessing(camera_images(2, height, width), input_size=448, use_global_img=use_global_img, max_num_grid=2)
+
+    assert diff['max_abs_diff'] <= MAX_ABS_DIFF, diff
+    assert diff['max_level_diff'] <= MAX_LEVEL_DIFF, diff
+    assert diff['mean_level_diff'] <= MAX_MEAN_LEVEL_DIFF, diff
+
+
+def test_tensor_preprocessing_accepts_float_input():
+    images = camera_images(1, 359, 1024, seed=1)
+    diff = compare_image_preprocessing(images.float(), input_size=448, use_global_img=True, max_num_grid=2)
+
+    assert diff['max_abs_diff'] <= MAX_ABS_DIFF, diff
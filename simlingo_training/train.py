@@ -15,6 +15,7 @@ from transformers import AutoProcessor
 from simlingo_training.utils.logging_project import setup_logging, sync_wandb
 
 from simlingo_training.config import TrainConfig
+from simlingo_training.callbacks.stage_timing import StageTimingCallback
 from simlingo_training.callbacks.visualise import VisualiseCallback
 
 
@@ -125,6 +126,8 @@ def main(cfg: TrainConfig):
     ]
     if not cfg.debug: 
         callbacks.append(lr_monitor)
+    if cfg.data_module.get('stage_timing', False):
+        callbacks.append(StageTimingCallback(log_every_n_steps=cfg.data_module.get('stage_timing_log_every_n_steps', 100)))
     
     print(f"Number of GPUS: {cfg.gpus}")
     overfit = 0
@@ -1,12 +1,29 @@
+import abc
+import asyncio
+import hashlib
+import json
+import os
+import random
+import sqlite3
+import urllib.request
+from typing import List, Optional, Sequence, Tuple
+
 import openai
 from retry import retry
 
+SYSTEM_MESSAGE = "an evaluator who rates my answer based on the correct answer"
+JUDGE_PROMPT_TEMPLATE = ("Rate my answer based on the correct answer out of 100, with higher "
+        "scores indicating that the answer is closer to the correct answer. "
+        "Just rate the similarity of the content not the sentence structure. "
+        "If the content is completely different rate with 0. You should be accurate to single digits like 62, 78, 41, etc. "
+        "Output the number only. This is the correct answer: {GT} This is my answer: {answer}")
+
 def initialize_client():
     openai.api_key = "ADD_YOUR_KEY_HERE"  # Replace with your OpenAI API key
     return openai
 
 @retry(tries=5, delay=1, backoff=1, jitter=(0, 5), max_delay=10)
-def call_chatgpt(client, chatgpt_messages, max_tokens=40, model="gpt-4o-2024-08-06"): 
+def call_chatgpt(client, chatgpt_messages, max_tokens=40, model="gpt-4o-2024-08-06"):
     response = client.chat.completions.create(
         model=model, messages=chatgpt_messages, temperature=0.6, max_tokens=max_tokens
     )
@@ -15,11 +32,20 @@ def call_chatgpt(client, chatgpt_messages, max_tokens=40, model="gpt-4o-2024-08-
     return reply, total_tokens
 
 def prepare_chatgpt_message(prompt):
-    system_message = "an evaluator who rates my answer based on the correct answer"
-    messages = [{"role": "system", "content": system_message}]
+    messages = [{"role": "system", "content": SYSTEM_MESSAGE}]
     messages.append({"role": "user", "content": "{}".format(prompt)})
     return messages
 
+def build_judge_prompt(answer, GT):
+    return JUDGE_PROMPT_TEMPLATE.format(GT=GT, answer=answer)
+
+def parse_score(reply):
+    # the judge is asked for the number only, anything else is an invalid sample (-1)
+    try:
+        return int(reply)
+    except (TypeError, ValueError):
+        return -1
+
 def gpt_forward(data):
     try:
         answer, GT = data
@@ -27,12 +53,7 @@ def gpt_forward(data):
         # Initialize the client inside the worker process
         client = initialize_client()
 
-        prompts = ("Rate my answer based on the correct answer out of 100, with higher "
-                "scores indicating that the answer is closer to the correct answer. "
-                "Just rate the similarity of the content not the sentence structure. "
-                "If the content is completely different rate with 0. You should be accurate to single digits like 62, 78, 41, etc. "
-                "Output the number only. This is the correct answer: " + GT + 
-                " This is my answer: " + answer)
+        prompts = build_judge_prompt(answer, GT)
 
         messages = prepare_chatgpt_message(prompts)
         reply, total_tokens = call_chatgpt(client, messages, max_tokens=3000)
@@ -40,3 +61,170 @@ def gpt_forward(data):
         print(f"Error: {e}")
         return -1
     return int(reply)
+
+
+class JudgeBackend(abc.ABC):
+    """
+    Interface of the judges used by AsyncJudgeScorer.
+    score_batch gets a batch of judge prompts and returns one reply per prompt (None if it failed).
+    cache_id identifies the judge in the result cache, so replies of different judges are not mixed.
+    """
+
+    cache_id = "judge"
+
+    @abc.abstractmethod
+    async def score_batch(self, prompts: List[str]) -> List[Optional[str]]:
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class OpenAIJudgeBackend(JudgeBackend):
+    """Chat completions API of OpenAI or of an OpenAI compatible server (base_url), one request per prompt."""
+
+    def __init__(self, model="gpt-4o-2024-08-06", api_key=None, base_url=None, max_tokens=3000, temperature=0.6, tries=5, max_delay=10):
+        self.model = model
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.tries = tries
+        self.max_delay = max_delay
+        self.api_key = api_key or os.environ.get("OPENAI_API_KEY", "ADD_YOUR_KEY_HERE")
+        self.base_url = base_url
+        # created in the event loop of AsyncJudgeScorer.score
+        self.client = None
+        self.cache_id = f"openai:{model}:{temperature}"
+
+    async def score_one(self, prompt):
+        if self.client is None:
+            self.client = openai.AsyncOpenAI(api_key=self.api_key, base_url=self.base_url)
+        delay = 1
+        for attempt in range(self.tries):
+            try:
+                response = await self.client.chat.completions.create(
+                    model=self.model, messages=prepare_chatgpt_message(prompt), temperature=self.temperature, max_tokens=self.max_tokens
+                )
+                return response.choices[0].message.content
+            except Exception as e:
+                if attempt == self.tries - 1:
+                    print(f"Error: {e}")
+                    return None
+                await asyncio.sleep(min(delay + random.uniform(0, 1), self.max_delay))
+                delay *= 2
+
+    async def score_batch(self, prompts):
+        return await asyncio.gather(*[self.score_one(prompt) for prompt in prompts])
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.close()
+            self.client = None
+
+
+class HTTPJudgeBackend(JudgeBackend):
+    """
+    Local stand-in judge server that scores a whole batch per request:
+    POST {"system": str, "prompts": [str]} to url, response {"replies": [str]}.
+    """
+
+    def __init__(self, url, name="local", timeout=120):
+        self.url = url
+        self.timeout = timeout
+        self.cache_id = f"http:{name}"
+
+    def _post(self, prompts):
+        payload = json.dumps({"system": SYSTEM_MESSAGE, "prompts": prompts}).encode("utf-8")
+        request = urllib.request.Request(self.url, data=payload, headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read().decode("utf-8"))["replies"]
+
+    async def score_batch(self, prompts):
+        try:
+            replies = await asyncio.to_thread(self._post, prompts)
+        except Exception as e:
+            print(f"Error: {e}")
+            return [None] * len(prompts)
+        if len(replies) != len(prompts):
+            print(f"Error: judge returned {len(replies)} replies for {len(prompts)} prompts")
+            return [None] * len(prompts)
+        return replies
+
+
+class JudgeCache:
+    """Persistent (sqlite) cache of judge scores, keyed by a hash of (judge, prompt template, answer, GT)."""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS scores (key TEXT PRIMARY KEY, score INTEGER)")
+        self.connection.commit()
+
+    @staticmethod
+    def key(cache_id, answer, GT):
+        content = json.dumps([cache_id, SYSTEM_MESSAGE, JUDGE_PROMPT_TEMPLATE, answer, GT])
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def get_many(self, keys):
+        found = {}
+        keys = list(keys)
+        # sqlite limits the number of parameters per statement
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = self.connection.execute(f"SELECT key, score FROM scores WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+            found.update(rows.fetchall())
+        return found
+
+    def put_many(self, items):
+        self.connection.executemany("INSERT OR REPLACE INTO scores (key, score) VALUES (?, ?)", items)
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+class AsyncJudgeScorer:
+    """
+    Scores (answer, GT) pairs with a JudgeBackend. Pairs that are already in the cache are not sent again,
+    the others are sent in batches of batch_size with at most max_concurrency batches in flight.
+    Invalid or failed replies give -1 (like gpt_forward) and are not cached, so they are retried on the next run.
+    """
+
+    def __init__(self, backend: JudgeBackend, cache_path: Optional[str] = None, max_concurrency=16, batch_size=8):
+        self.backend = backend
+        self.cache = JudgeCache(cache_path) if cache_path is not None else None
+        self.max_concurrency = max_concurrency
+        self.batch_size = batch_size
+
+    async def _score_async(self, pairs):
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        batches = [pairs[start:start + self.batch_size] for start in range(0, len(pairs), self.batch_size)]
+
+        async def score_batch(batch):
+            async with semaphore:
+                replies = await self.backend.score_batch([build_judge_prompt(answer, GT) for answer, GT in batch])
+            scores = [parse_score(reply) for reply in replies]
+            if self.cache is not None:
+                self.cache.put_many([(JudgeCache.key(self.backend.cache_id, answer, GT), score)
+                                     for (answer, GT), score in zip(batch, scores) if score != -1])
+            return scores
+
+        try:
+            results = await asyncio.gather(*[score_batch(batch) for batch in batches])
+        finally:
+            await self.backend.close()
+        return [score for scores in results for score in scores]
+
+    def score(self, pairs: Sequence[Tuple[str, str]]) -> List[int]:
+        """One score per (answer, GT) pair, -1 for invalid samples."""
+        pairs = [tuple(pair) for pair in pairs]
+        keys = [JudgeCache.key(self.backend.cache_id, answer, GT) for answer, GT in pairs]
+        cached = self.cache.get_many(set(keys)) if self.cache is not None else {}
+
+        # identical pairs are only scored once
+        missing = list(dict.fromkeys(pair for pair, key in zip(pairs, keys) if key not in cached))
+        print(f"Judge: {len(pairs) - sum(key not in cached for key in keys)} cached, {len(missing)} to score")
+        if len(missing) > 0:
+            new_scores = dict(zip(missing, asyncio.run(self._score_async(missing))))
+        else:
+            new_scores = {}
+        return [cached[key] if key in cached else new_scores[pair] for pair, key in zip(pairs, keys)]
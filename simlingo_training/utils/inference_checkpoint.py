@@ -0,0 +1,160 @@
+"""
+Inference checkpoint: a single bf16 safetensors file with the LoRA weights merged into the language model and the
+hydra config and tokenizer settings in its metadata.
+
+Loading a training checkpoint builds the model with the pretrained HF weights (random init + from_pretrained),
+torch.load's the full state dict into host memory and copies it into the model, for every route of an evaluation.
+load_inference_checkpoint instead builds the model with empty (meta) parameters and assigns the tensors that
+safetensors reads from the memory mapped file directly to the target device.
+
+Export (once per checkpoint):
+    python -m simlingo_training.utils.inference_checkpoint --checkpoint outputs/simlingo/checkpoints/epoch=013.ckpt/pytorch_model.pt \
+        --output outputs/simlingo/checkpoints/epoch=013.safetensors
+"""
+import argparse
+import json
+import os
+from pathlib import Path
+
+import hydra
+import torch
+from omegaconf import OmegaConf
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
+from transformers import AutoProcessor
+
+FORMAT = 'simlingo-inference-v1'
+
+
+def find_hydra_config(checkpoint_path):
+    # training checkpoints are stored as <run>/checkpoints/<ckpt>[/<file>], the config in <run>/.hydra
+    for parent in Path(checkpoint_path).parents:
+        config_path = parent / '.hydra' / 'config.yaml'
+        if config_path.is_file():
+            return config_path
+    raise FileNotFoundError(f'No .hydra/config.yaml found above {checkpoint_path}')
+
+
+def load_training_state_dict(checkpoint_path):
+    if os.path.isdir(checkpoint_path):
+        from deepspeed.utils.zero_to_fp32 import get_fp32_state_dict_from_zero_checkpoint
+        return get_fp32_state_dict_from_zero_checkpoint(checkpoint_path)
+    state_dict = torch.load(checkpoint_path, map_location='cpu')
+    # lightning checkpoints wrap the weights
+    return state_dict.get('state_dict', state_dict)
+
+
+def get_processor(variant, special_tokens=None, padding_side='left'):
+    processor = AutoProcessor.from_pretrained(variant, trust_remote_code=True)
+    tokenizer = processor.tokenizer if 'tokenizer' in processor.__dict__ else processor
+    if special_tokens:
+        tokenizer.add_special_tokens({'additional_special_tokens': special_tokens})
+    tokenizer.padding_side = padding_side
+    return processor
+
+
+def instantiate_model(cfg, processor):
+    cache_dir = f"pretrained/{(cfg.model.vision_model.variant.split('/')[1])}"
+    return hydra.utils.instantiate(
+        cfg.model,
+        cfg_data_module=cfg.data_module,
+        processor=processor,
+        cache_dir=cache_dir,
+        _recursive_=False
+    )
+
+
+def export_inference_checkpoint(checkpoint_path, output_path, config_path=None):
+    config_path = config_path or find_hydra_config(checkpoint_path)
+    cfg = OmegaConf.load(config_path)
+    cfg.model.vision_model.use_global_img = cfg.data_module.use_global_img
+
+    processor = get_processor(cfg.model.vision_model.variant, ['<WAYPOINTS>','<WAYPOINTS_DIFF>', '<ORG_WAYPOINTS_DIFF>', '<ORG_WAYPOINTS>', '<WAYPOINT_LAST>', '<ROUTE>', '<ROUTE_DIFF>', '<TARGET_POINT>'])
+    tokenizer = processor.tokenizer if 'tokenizer' in processor.__dict__ else processor
+    model = instantiate_model(cfg, processor)
+    model.load_state_dict(load_training_state_dict(checkpoint_path))
+
+    if cfg.model.language_model.get('lora', False):
+        print('Merging the LoRA weights into the language model')
+        model.language_model.model = model.language_model.model.merge_and_unload()
+
+    # the exported model is built without LoRA and without the pretrained HF weights
+    cfg.model.language_model.lora = False
+    cfg.model.language_model.pretrained = False
+    cfg.model.vision_model.pretrained = False
+
+    # modules that are registered more than once (e.g. embed_tokens) share their tensors, they are stored once
+    state_dict, aliases, stored = {}, {}, {}
+    for key, tensor in model.state_dict().items():
+        storage_key = (tensor.data_ptr(), tensor.dtype, tuple(tensor.shape))
+        if tensor.numel() > 0 and storage_key in stored:
+            aliases[key] = stored[storage_key]
+            continue
+        stored[storage_key] = key
+        if tensor.is_floating_point():
+            tensor = tensor.to(torch.bfloat16)
+        state_dict[key] = tensor.detach().clone().contiguous()
+
+    metadata = {
+        'format': FORMAT,
+        'config': json.dumps(OmegaConf.to_container(cfg, resolve=True)),
+        'aliases': json.dumps(aliases),
+        'special_tokens': json.dumps(list(tokenizer.additional_special_tokens)),
+        'padding_side': tokenizer.padding_side,
+        'source_checkpoint': os.path.abspath(checkpoint_path),
+    }
+    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    save_file(state_dict, output_path, metadata=metadata)
+    print(f'Wrote {len(state_dict)} tensors ({len(aliases)} aliases) to {output_path}')
+
+
+def read_metadata(path):
+    with safe_open(path, framework='pt', device='cpu') as f:
+        metadata = f.metadata()
+    if metadata is None or metadata.get('format') != FORMAT:
+        raise ValueError(f'{path} is not a {FORMAT} checkpoint, export it with simlingo_training/utils/inference_checkpoint.py')
+    return metadata
+
+
+def is_inference_checkpoint(path):
+    return str(path).endswith('.safetensors')
+
+
+def load_inference_checkpoint(path, processor=None, device='cuda'):
+    """Returns (model, processor, cfg) of an exported inference checkpoint, the model is in eval mode on device."""
+    from accelerate import init_empty_weights
+
+    metadata = read_metadata(path)
+    cfg = OmegaConf.create(json.loads(metadata['config']))
+    if processor is None:
+        processor = get_processor(cfg.model.vision_model.variant, json.loads(metadata['special_tokens']), metadata['padding_side'])
+
+    # buffers that are not in the state dict (e.g. rotary embeddings) are created in bf16 like the stored weights
+    default_dtype = torch.get_default_dtype()
+    torch.set_default_dtype(torch.bfloat16)
+    try:
+        with init_empty_weights():
+            model = instantiate_model(cfg, processor)
+    finally:
+        torch.set_default_dtype(default_dtype)
+
+    # tensors are read from the memory mapped file straight to the device
+    state_dict = load_file(path, device=str(device))
+    for alias, key in json.loads(metadata['aliases']).items():
+        state_dict[alias] = state_dict[key]
+    model.load_state_dict(state_dict, strict=True, assign=True)
+    # the buffers were created on the cpu
+    model = model.to(device).eval()
+    for p in model.parameters():
+        p.requires_grad = False
+    return model, processor, cfg
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a training checkpoint to a bf16 inference checkpoint (safetensors).')
+    parser.add_argument('--checkpoint', type=str, required=True, help='state dict file, lightning checkpoint or deepspeed checkpoint folder')
+    parser.add_argument('--output', type=str, required=True, help='.safetensors file')
+    parser.add_argument('--config', type=str, default=None, help='hydra config.yaml, default: .hydra/config.yaml of the run')
+    args = parser.parse_args()
+
+    export_inference_checkpoint(args.checkpoint, args.output, args.config)
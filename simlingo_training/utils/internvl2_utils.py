@@ -4,6 +4,7 @@
 import importlib.util
 import os
 import sys
+from functools import lru_cache
 from typing import Dict, List, Optional
 
 import numpy as np
@@ -91,6 +92,25 @@ def get_chat_tokens(tokenizer, prompts: List[str], user_start_token_str: str, as
     }
 
 
+@lru_cache(maxsize=4)
+def get_conv_module(encoder_variant: str, cache_root_dir: str = 'pretrained'):
+    # conversation.py of the pretrained model, imported once per process
+    cache_dir = f"{cache_root_dir}/{(encoder_variant.split('/')[1])}"
+    # get absolute path from workspace dir not wokring dir
+    cache_dir = to_absolute_path(cache_dir)
+    model_path = f"{cache_dir}/conversation.py"
+    if not os.path.exists(model_path):
+        from huggingface_hub import snapshot_download
+        snapshot_download(repo_id=encoder_variant, local_dir=cache_dir)
+        
+    #import from file from model_path
+    spec = importlib.util.spec_from_file_location('get_conv_template', model_path)
+    conv_module = importlib.util.module_from_spec(spec)
+    sys.modules['get_conv_template'] = conv_module
+    spec.loader.exec_module(conv_module)
+    return conv_module
+
+
 def get_custom_chat_template(conversations: List[Dict], tokenizer, encoder_variant: str, num_image_tokens_total: int, cache_root_dir: str = 'pretrained') -> Optional[Dict]:
     # get the custom chat template
     # for full conversation, question only
@@ -105,19 +125,7 @@ def get_custom_chat_template(conversations: List[Dict], tokenizer, encoder_varia
     IMG_CONTEXT_TOKEN='<IMG_CONTEXT>'
     IMG_TOKEN = '<image>'
 
-    cache_dir = f"{cache_root_dir}/{(encoder_variant.split('/')[1])}"
-    # get absolute path from workspace dir not wokring dir
-    cache_dir = to_absolute_path(cache_dir)
-    model_path = f"{cache_dir}/conversation.py"
-    if not os.path.exists(model_path):
-        from huggingface_hub import snapshot_download
-        snapshot_download(repo_id=encoder_variant, local_dir=cache_dir)
-        
-    #import from file from model_path
-    spec = importlib.util.spec_from_file_location('get_conv_template', model_path)
-    conv_module = importlib.util.module_from_spec(spec)
-    sys.modules['get_conv_template'] = conv_module
-    spec.loader.exec_module(conv_module)
+    conv_module = get_conv_module(encoder_variant, cache_root_dir)
 
     image_tokens_templates = IMG_START_TOKEN + IMG_CONTEXT_TOKEN * num_image_tokens_total + IMG_END_TOKEN
 
@@ -176,6 +184,129 @@ def get_custom_chat_template(conversations: List[Dict], tokenizer, encoder_varia
 
 
 
+class ChatTemplateEngine:
+    """
+    Cached version of get_custom_chat_template for single round (user + assistant) conversations.
+
+    The prompt is always [head][question][sep][assistant role][answer][sep], where the head (user role and the
+    image token span) and the separators do not depend on the sample. Their token ids are computed once, per batch
+    only the question and answer texts are tokenized and the ids are spliced together. The loss mask starts at the
+    assistant role of every row and is built with tensor ops instead of searching the role tokens.
+    On the first call the result is compared with get_custom_chat_template, if the tokenizer merges tokens across
+    the split points the engine falls back to it.
+    """
+
+    QUESTION_MARKER = '<QUESTION_PLACEHOLDER>'
+    ANSWER_MARKER = '<ANSWER_PLACEHOLDER>'
+
+    def __init__(self, tokenizer, encoder_variant: str, num_image_tokens_total: int, cache_root_dir: str = 'pretrained'):
+        IMG_START_TOKEN='<img>'
+        IMG_END_TOKEN='</img>'
+        IMG_CONTEXT_TOKEN='<IMG_CONTEXT>'
+        self.IMG_TOKEN = '<image>'
+
+        self.tokenizer = tokenizer
+        self.encoder_variant = encoder_variant
+        self.num_image_tokens_total = num_image_tokens_total
+        self.cache_root_dir = cache_root_dir
+        self.checked = False
+        self.use_cache = True
+
+        conv_module = get_conv_module(encoder_variant, cache_root_dir)
+        template_conv = conv_module.get_conv_template('internlm2-chat')
+        template_question = conv_module.get_conv_template('internlm2-chat')
+        template_conv.append_message(template_conv.roles[0], f"{self.IMG_TOKEN}\n{self.QUESTION_MARKER}")
+        template_conv.append_message(template_conv.roles[1], self.ANSWER_MARKER)
+        template_question.append_message(template_question.roles[0], f"{self.IMG_TOKEN}\n{self.QUESTION_MARKER}")
+        template_question.append_message(template_question.roles[1], None)
+
+        system_prompt = template_conv.system_template.replace('{system_message}', template_conv.system_message) + template_conv.sep
+        image_tokens_templates = IMG_START_TOKEN + IMG_CONTEXT_TOKEN * num_image_tokens_total + IMG_END_TOKEN
+        prompt_conv = template_conv.get_prompt().replace(system_prompt, '').replace(self.IMG_TOKEN, image_tokens_templates, 1)
+        prompt_question = template_question.get_prompt().replace(system_prompt, '').replace(self.IMG_TOKEN, image_tokens_templates, 1)
+
+        self.head, rest = prompt_conv.split(self.QUESTION_MARKER)
+        middle, self.tail = rest.split(self.ANSWER_MARKER)
+        head_question, middle_question = prompt_question.split(self.QUESTION_MARKER)
+        assert head_question == self.head and middle_question == middle, "Question prompt is not a prefix of the conversation prompt"
+
+        assistant_start = middle.index(template_conv.roles[1])
+        self.separator, self.assistant_role = middle[:assistant_start], middle[assistant_start:]
+
+        def tokenize(text):
+            return torch.tensor(tokenizer(text, add_special_tokens=False)["input_ids"], dtype=torch.long)
+
+        self.head_ids = tokenize(self.head)
+        self.separator_ids = tokenize(self.separator)
+        self.assistant_role_ids = tokenize(self.assistant_role)
+        self.tail_ids = tokenize(self.tail)
+
+    def get_tokens(self, text_ids: List[torch.Tensor], loss_starts: torch.Tensor, prompts: List[str]) -> Dict:
+        # text_ids: per row the ids after the head, loss_starts: per row offset of the assistant role in text_ids
+        text_lengths = torch.tensor([len(ids) for ids in text_ids], dtype=torch.long)
+        head_len = len(self.head_ids)
+        seq_length = head_len + int(text_lengths.max())
+
+        # left padding like the tokenizer
+        prompt_tokenized_ids = torch.full((len(text_ids), seq_length), self.tokenizer.pad_token_id, dtype=torch.long)
+        row_starts = seq_length - head_len - text_lengths
+        for batch_id, ids in enumerate(text_ids):
+            start = int(row_starts[batch_id])
+            prompt_tokenized_ids[batch_id, start:start + head_len] = self.head_ids
+            prompt_tokenized_ids[batch_id, start + head_len:] = ids
+        prompt_tokenized_valid = prompt_tokenized_ids != self.tokenizer.pad_token_id
+
+        loss_start = (row_starts + head_len + loss_starts).unsqueeze(1)
+        loss_mask = torch.arange(seq_length).unsqueeze(0) >= loss_start
+
+        return {
+            'phrase_ids': prompt_tokenized_ids,
+            'phrase_valid': prompt_tokenized_valid,
+            'phrase_mask': prompt_tokenized_valid,
+            'language_string': prompts,
+            'loss_masking': loss_mask
+        }
+
+    def __call__(self, conversations: List[Dict]):
+        """Same output as get_custom_chat_template(conversations, ...)."""
+        # rare layouts of the legacy template: image token in the question or an empty answer (no separator)
+        if not self.use_cache or any(self.IMG_TOKEN in conv[0]['content'][0]['text'] or not conv[-1]['content'][0]['text'] for conv in conversations):
+            return get_custom_chat_template(conversations, self.tokenizer, self.encoder_variant, self.num_image_tokens_total, self.cache_root_dir)
+
+        questions, answers = [], []
+        for conv in conversations:
+            assert len(conv) == 2, "For question and answer templates only two turn conversation (user + assistant) is supported."
+            assert conv[0]['role'] == 'user' and conv[1]['role'] == 'assistant', "Conversation has to be user + assistant"
+            questions.append(conv[0]['content'][0]['text'])
+            answers.append(conv[1]['content'][0]['text'])
+
+        question_ids = self.tokenizer(questions, add_special_tokens=False)["input_ids"]
+        answer_ids = self.tokenizer(answers, add_special_tokens=False)["input_ids"]
+
+        question_text_ids, conv_text_ids = [], []
+        for q_ids, a_ids in zip(question_ids, answer_ids):
+            q_ids = torch.tensor(q_ids, dtype=torch.long)
+            question_text_ids.append(torch.cat((q_ids, self.separator_ids, self.assistant_role_ids)))
+            conv_text_ids.append(torch.cat((q_ids, self.separator_ids, self.assistant_role_ids, torch.tensor(a_ids, dtype=torch.long), self.tail_ids)))
+        loss_starts = torch.tensor([len(ids) for ids in question_ids], dtype=torch.long) + len(self.separator_ids)
+
+        prompts_conv = [self.head + q + self.separator + self.assistant_role + a + self.tail for q, a in zip(questions, answers)]
+        prompts_question = [self.head + q + self.separator + self.assistant_role for q in questions]
+        conv_dict = self.get_tokens(conv_text_ids, loss_starts, prompts_conv)
+        question_dict = self.get_tokens(question_text_ids, loss_starts, prompts_question)
+
+        if not self.checked:
+            self.checked = True
+            conv_dict_ref, question_dict_ref = get_custom_chat_template(conversations, self.tokenizer, self.encoder_variant, self.num_image_tokens_total, self.cache_root_dir)
+            for key in ['phrase_ids', 'loss_masking']:
+                if not (torch.equal(conv_dict[key], conv_dict_ref[key]) and torch.equal(question_dict[key], question_dict_ref[key])):
+                    print(f'ChatTemplateEngine: {key} differs from get_custom_chat_template, using get_custom_chat_template.')
+                    self.use_cache = False
+                    return conv_dict_ref, question_dict_ref
+
+        return conv_dict, question_dict
+
+
 def preprocess_image_batch(
         images_batch_list, 
         input_size=448, 
@@ -203,6 +334,87 @@ def preprocess_image_batch(
     return images_processed
 
 
+def get_target_ratios(min_num, max_num):
+    target_ratios = set(
+        (i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1) if
+        i * j <= max_num and i * j >= min_num)
+    return sorted(target_ratios, key=lambda x: x[0] * x[1])
+
+
+def resize_like_pil(images: torch.Tensor, height: int, width: int) -> torch.Tensor:
+    """
+    Bicubic resize of a [B, C, H, W] batch with values in [0, 255], matching PIL's Image.resize.
+    The antialiased torch kernel uses the same filter as PIL (a=-0.5, support scaled when downsampling)
+    and the result is rounded to uint8 levels like the PIL image.
+    """
+    if images.shape[-2:] == (height, width):
+        return images.float()
+    resized = torch.nn.functional.interpolate(
+        images.float(), size=(height, width), mode='bicubic', align_corners=False, antialias=True
+    )
+    return resized.round_().clamp_(0, 255)
+
+
+def preprocess_image_batch_tensor(
+        images_batch,
+        input_size=448,
+        use_global_img=False,
+        max_num_grid=2,
+        device=None,
+    ):
+    """
+    Batched version of preprocess_image_batch on tensors, runs on CPU or on a CUDA device.
+    images_batch: [B, C, H, W] tensor (uint8 or float) with values in [0, 255], all images have the same size.
+    Returns the same dict as preprocess_image_batch: pixel_values [B, num_tiles, C, input_size, input_size]
+    (normalized float32) and image_sizes [B, 2].
+    """
+    if device is not None:
+        images_batch = images_batch.to(device, non_blocking=True)
+    B, C, H, W = images_batch.shape
+
+    # same tile grid as dynamic_preprocess, identical for the whole batch
+    target_aspect_ratio = find_closest_aspect_ratio(
+        W / H, get_target_ratios(1, max_num_grid), W, H, input_size)
+    cols, rows = target_aspect_ratio
+
+    resized = resize_like_pil(images_batch, input_size * rows, input_size * cols)
+    # [B, C, rows * s, cols * s] -> [B, rows * cols, C, s, s], row-major like the crops of dynamic_preprocess
+    tiles = resized.view(B, C, rows, input_size, cols, input_size).permute(0, 2, 4, 1, 3, 5)
+    tiles = tiles.reshape(B, rows * cols, C, input_size, input_size)
+    if use_global_img and rows * cols != 1:
+        thumbnail = resize_like_pil(images_batch, input_size, input_size)
+        tiles = torch.cat((tiles, thumbnail.unsqueeze(1)), dim=1)
+
+    mean = torch.tensor(IMAGENET_MEAN, dtype=torch.float32, device=tiles.device).view(1, 1, C, 1, 1)
+    std = torch.tensor(IMAGENET_STD, dtype=torch.float32, device=tiles.device).view(1, 1, C, 1, 1)
+    pixel_values = (tiles / 255.0 - mean) / std
+
+    images_processed = {
+        'pixel_values': pixel_values,
+        'image_sizes': torch.tensor([[H, W]] * B),
+        }
+    return images_processed
+
+
+def compare_image_preprocessing(images_batch, input_size=448, use_global_img=False, max_num_grid=2, device=None):
+    """
+    Compares preprocess_image_batch_tensor with the PIL pipeline (see simlingo_training/tests/test_image_preprocessing.py).
+    Returns the max absolute difference of the normalized pixel values and the max and mean difference in uint8 levels.
+    """
+    reference = preprocess_image_batch(list(images_batch.float().cpu()), input_size=input_size, use_global_img=use_global_img, max_num_grid=max_num_grid)
+    result = preprocess_image_batch_tensor(images_batch, input_size=input_size, use_global_img=use_global_img, max_num_grid=max_num_grid, device=device)
+    assert result['pixel_values'].shape == reference['pixel_values'].shape
+    assert torch.equal(result['image_sizes'], reference['image_sizes'])
+
+    diff = (result['pixel_values'].cpu() - reference['pixel_values']).abs()
+    std = torch.tensor(IMAGENET_STD).view(1, 1, -1, 1, 1)
+    return {
+        'max_abs_diff': diff.max().item(),
+        'max_level_diff': (diff * std * 255).round().max().item(),
+        'mean_level_diff': (diff * std * 255).mean().item(),
+    }
+
+
 def build_transform(input_size):
     MEAN, STD = IMAGENET_MEAN, IMAGENET_STD
     transform = T.Compose([
@@ -233,10 +445,7 @@ def dynamic_preprocess(image, min_num=1, max_num=12, image_size=448, use_thumbna
     aspect_ratio = orig_width / orig_height
 
     # calculate the existing image aspect ratio
-    target_ratios = set(
-        (i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1) if
-        i * j <= max_num and i * j >= min_num)
-    target_ratios = sorted(target_ratios, key=lambda x: x[0] * x[1])
+    target_ratios = get_target_ratios(min_num, max_num)
 
     # find the closest aspect ratio to the target
     target_aspect_ratio = find_closest_aspect_ratio(
@@ -272,4 +481,23 @@ def load_image(image_file, input_size=448, max_num=12):
     images = dynamic_preprocess(image, image_size=input_size, use_thumbnail=True, max_num=max_num)
     pixel_values = [transform(image) for image in images]
     pixel_values = torch.stack(pixel_values)
-    return pixel_values
\ No newline at end of file
+    return pixel_values
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compare the tensor image preprocessing with the PIL pipeline.')
+    parser.add_argument('--image', type=str, default=None, help='image file, random images if not given')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--use_global_img', action='store_true')
+    parser.add_argument('--device', type=str, default='cpu')
+    args = parser.parse_args()
+
+    if args.image is not None:
+        image = np.asarray(Image.open(args.image).convert('RGB')).transpose(2, 0, 1)
+        images = torch.from_numpy(np.ascontiguousarray(image)).unsqueeze(0).repeat(args.batch_size, 1, 1, 1)
+    else:
+        # size of the cropped front camera image used by the dataset and the agent
+        images = torch.randint(0, 256, (args.batch_size, 3, 359, 1024), dtype=torch.uint8)
+    print(compare_image_preprocessing(images, use_global_img=args.use_global_img, device=args.device))
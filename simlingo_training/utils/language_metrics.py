@@ -0,0 +1,173 @@
+"""
+Parallel COCO caption metrics (BLEU, METEOR, ROUGE_L, CIDEr, SPICE) with the same result as one evaluation over
+all samples.
+
+The expensive parts (PTB tokenization, METEOR statistics and SPICE, all in java) run per chunk in a process pool.
+The chunks do not return scores but what is needed to compute the corpus level score exactly:
+- BLEU: the cooked n-gram counts, the corpus score is computed once from the counts of all chunks
+- CIDEr: the cooked n-grams, the document frequencies are computed once over the references of all chunks
+- METEOR: the sufficient statistics per sample, the final score is one EVAL call with the statistics of all chunks
+- ROUGE_L and SPICE: the sum of the per sample scores (both are means over the samples)
+Chunk results are cached on disk (keyed by the content of the chunk), an interrupted run only evaluates the
+missing chunks.
+"""
+import hashlib
+import json
+import os
+import pickle
+from multiprocessing import Pool
+
+from tqdm import tqdm
+
+METRICS = ("BLEU", "METEOR", "ROUGE_L", "CIDEr", "SPICE")
+
+# scorers of the current process, java scorers are started once per worker
+_SCORERS = {}
+
+
+def _coco_modules():
+    try:
+        from language_evaluation.coco_caption_py3.pycocoevalcap.tokenizer.ptbtokenizer import PTBTokenizer
+        from language_evaluation.coco_caption_py3.pycocoevalcap.bleu.bleu_scorer import BleuScorer
+        from language_evaluation.coco_caption_py3.pycocoevalcap.cider.cider_scorer import CiderScorer
+        from language_evaluation.coco_caption_py3.pycocoevalcap.meteor.meteor import Meteor
+        from language_evaluation.coco_caption_py3.pycocoevalcap.rouge.rouge import Rouge
+        from language_evaluation.coco_caption_py3.pycocoevalcap.spice.spice import Spice
+    except ImportError:
+        from pycocoevalcap.tokenizer.ptbtokenizer import PTBTokenizer
+        from pycocoevalcap.bleu.bleu_scorer import BleuScorer
+        from pycocoevalcap.cider.cider_scorer import CiderScorer
+        from pycocoevalcap.meteor.meteor import Meteor
+        from pycocoevalcap.rouge.rouge import Rouge
+        from pycocoevalcap.spice.spice import Spice
+    return {
+        'PTBTokenizer': PTBTokenizer, 'BleuScorer': BleuScorer, 'CiderScorer': CiderScorer,
+        'Meteor': Meteor, 'Rouge': Rouge, 'Spice': Spice,
+    }
+
+
+def _scorer(name):
+    if name not in _SCORERS:
+        _SCORERS[name] = _coco_modules()[name]()
+    return _SCORERS[name]
+
+
+def meteor_score_from_stats(meteor, stats):
+    """Final METEOR score of the statistics of all samples (same protocol as Meteor.compute_score)."""
+    eval_line = 'EVAL' + ''.join(f' ||| {stat}' for stat in stats)
+    with meteor.lock:
+        meteor.meteor_p.stdin.write(f'{eval_line}\n'.encode())
+        meteor.meteor_p.stdin.flush()
+        for _ in range(len(stats)):
+            meteor.meteor_p.stdout.readline()  # per sample scores
+        return float(meteor.meteor_p.stdout.readline().strip())
+
+
+def evaluate_chunk(args):
+    """Mergeable statistics of one chunk of (answers, GTs)."""
+    answers, GTs, metrics = args
+    modules = _coco_modules()
+    gts = {i: [{'caption': gt}] for i, gt in enumerate(GTs)}
+    res = {i: [{'caption': answer}] for i, answer in enumerate(answers)}
+    tokenizer = _scorer('PTBTokenizer')
+    gts = tokenizer.tokenize(gts)
+    res = tokenizer.tokenize(res)
+    ids = list(range(len(answers)))
+
+    result = {'num_samples': len(answers)}
+    if 'BLEU' in metrics:
+        bleu = modules['BleuScorer'](n=4)
+        for i in ids:
+            bleu += (res[i][0], gts[i])
+        result['bleu'] = (bleu.crefs, bleu.ctest)
+    if 'CIDEr' in metrics:
+        cider = modules['CiderScorer'](n=4, sigma=6.0)
+        for i in ids:
+            cider += (res[i][0], gts[i])
+        result['cider'] = (cider.crefs, cider.ctest)
+    if 'METEOR' in metrics:
+        meteor = _scorer('Meteor')
+        with meteor.lock:
+            result['meteor'] = [meteor._stat(res[i][0], gts[i]) for i in ids]
+    if 'ROUGE_L' in metrics:
+        rouge = _scorer('Rouge')
+        result['rouge_sum'] = float(sum(rouge.calc_score(res[i], gts[i]) for i in ids))
+    if 'SPICE' in metrics:
+        spice_score, _ = _scorer('Spice').compute_score(gts, res)
+        result['spice_sum'] = float(spice_score) * len(ids)
+    return result
+
+
+def merge_chunks(chunk_results, metrics):
+    """Corpus level scores from the statistics of all chunks (in chunk order)."""
+    modules = _coco_modules()
+    num_samples = sum(chunk['num_samples'] for chunk in chunk_results)
+    scores = {}
+    if 'BLEU' in metrics:
+        bleu = modules['BleuScorer'](n=4)
+        for chunk in chunk_results:
+            bleu.crefs.extend(chunk['bleu'][0])
+            bleu.ctest.extend(chunk['bleu'][1])
+        bleu_scores, _ = bleu.compute_score(option='closest', verbose=0)
+        for n, score in enumerate(bleu_scores):
+            scores[f'Bleu_{n + 1}'] = score
+    if 'METEOR' in metrics:
+        stats = [stat for chunk in chunk_results for stat in chunk['meteor']]
+        scores['METEOR'] = meteor_score_from_stats(_scorer('Meteor'), stats)
+    if 'ROUGE_L' in metrics:
+        scores['ROUGE_L'] = sum(chunk['rouge_sum'] for chunk in chunk_results) / num_samples
+    if 'CIDEr' in metrics:
+        # the document frequencies are computed once over the references of all samples
+        cider = modules['CiderScorer'](n=4, sigma=6.0)
+        for chunk in chunk_results:
+            cider.crefs.extend(chunk['cider'][0])
+            cider.ctest.extend(chunk['cider'][1])
+        scores['CIDEr'], _ = cider.compute_score()
+    if 'SPICE' in metrics:
+        scores['SPICE'] = sum(chunk['spice_sum'] for chunk in chunk_results) / num_samples
+    return {key: float(value) for key, value in scores.items()}
+
+
+def chunk_key(answers, GTs, metrics):
+    content = json.dumps([sorted(metrics), answers, GTs])
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def evaluate_language(answers, GTs, metrics=METRICS, chunk_size=500, num_workers=4, cache_dir=None):
+    """
+    Corpus level caption metrics of answers against GTs (one reference each), chunks are evaluated in num_workers
+    processes. The result does not depend on chunk_size or num_workers.
+    """
+    assert len(answers) == len(GTs), "One GT per answer needed"
+    if len(answers) == 0:
+        return {}
+    chunks = [(answers[i:i + chunk_size], GTs[i:i + chunk_size], tuple(metrics)) for i in range(0, len(answers), chunk_size)]
+
+    chunk_results = [None] * len(chunks)
+    cache_paths = [None] * len(chunks)
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        for i, chunk in enumerate(chunks):
+            cache_paths[i] = os.path.join(cache_dir, f'chunk_{chunk_key(*chunk)}.pkl')
+            if os.path.isfile(cache_paths[i]):
+                with open(cache_paths[i], 'rb') as f:
+                    chunk_results[i] = pickle.load(f)
+    missing = [i for i in range(len(chunks)) if chunk_results[i] is None]
+    print(f"Language evaluation: {len(chunks)} chunks, {len(chunks) - len(missing)} cached")
+
+    def store(i, result):
+        chunk_results[i] = result
+        if cache_paths[i] is not None:
+            with open(cache_paths[i] + '.tmp', 'wb') as f:
+                pickle.dump(result, f)
+            os.replace(cache_paths[i] + '.tmp', cache_paths[i])
+
+    if num_workers > 1 and len(missing) > 1:
+        with Pool(min(num_workers, len(missing))) as pool:
+            for i, result in zip(missing, tqdm(pool.imap(evaluate_chunk, [chunks[i] for i in missing]), total=len(missing))):
+                store(i, result)
+    else:
+        for i in tqdm(missing):
+            store(i, evaluate_chunk(chunks[i]))
+
+    return merge_chunks(chunk_results, metrics)
@@ -0,0 +1,212 @@
+"""
+Columnar metrics of the collected predictions of DrivingModel.predict_step.
+
+The predictions are held as stacked arrays plus one boolean mask per prompt category, subsets are selected with
+the masks and all waypoint and route metrics are computed for all samples of a subset at once. The results are the
+same as the former per sample loops in DrivingModel.on_predict_epoch_end.
+"""
+from typing import Dict, List
+
+import numpy as np
+import torch
+
+WP_FREQ = 5
+CARLA_FPS = 20
+# one waypoint every 0.25 seconds
+ONE_SECOND = int(CARLA_FPS // WP_FREQ)
+HALF_SECOND = ONE_SECOND // 2
+
+
+def stack_rows(fn, arrays):
+    """fn applied to the stacked arrays, row by row if they do not have the same shape."""
+    try:
+        stacked = np.stack(arrays)
+    except ValueError:
+        return np.concatenate([fn(np.asarray(array)[None]) for array in arrays])
+    return fn(stacked)
+
+
+def desired_end_speed(wps):
+    # speed over the last half second, wps: [N, T, 2]
+    return np.linalg.norm(wps[:, -1 - HALF_SECOND] - wps[:, -1], axis=-1) * 2.0
+
+
+def wps_1d(wps):
+    """Distance along the waypoints from the first one, [N, T]."""
+    distances = np.cumsum(np.linalg.norm(wps[:, 1:] - wps[:, :-1], axis=-1), axis=1)
+    return np.concatenate((np.zeros_like(distances[:, :1]), distances), axis=1)
+
+
+def wps_speeds(wps):
+    """Speed between consecutive waypoints, [N, T - 1]."""
+    return np.diff(wps_1d(wps), axis=1) / (WP_FREQ / CARLA_FPS)
+
+
+def speed_slopes(speeds):
+    # slope of a linear fit of the speeds over time, per row
+    x = np.arange(speeds.shape[1]) * 0.25
+    return np.polyfit(x, speeds.T, 1)[0]
+
+
+def ade(pred, gt):
+    return np.mean(np.linalg.norm(pred - gt, axis=-1), axis=-1)
+
+
+def ade_rows(pred, gt):
+    """ade of lists of arrays, row by row if they do not have the same shape."""
+    try:
+        return ade(np.stack(pred), np.stack(gt))
+    except ValueError:
+        return np.array([np.mean(np.linalg.norm(np.asarray(p) - np.asarray(g), axis=-1)) for p, g in zip(pred, gt)])
+
+
+def parse_current_speed(prompt):
+    return float(prompt.split("Current speed: ")[-1].split(" ")[0])
+
+
+def parse_target_speed(prompt):
+    command = prompt.split("Target waypoint: ")[-1].split("Command")[-1].split(".<|im_end|>")[0].split(" ")
+    try:
+        return float(command[-2])
+    except (ValueError, IndexError):
+        return float(command[-3])
+
+
+class PredictionTable:
+    """Stacked predictions of an epoch and the category masks of the prompts."""
+
+    def __init__(self, prediction: Dict):
+        self.prompts = prediction["prompt"]
+        self.language = prediction["language"]
+        self.language_gt = prediction["language_gt"]
+        self.paths = prediction["path"]
+        self.eval_infos = prediction["eval_infos"]
+
+        self.route = torch.cat(prediction["route"], dim=0).cpu().numpy()
+        self.route_gt = torch.cat(prediction["route_gt"], dim=0).cpu().numpy()
+        self.waypoints = torch.cat(prediction["waypoints"], dim=0).cpu().numpy()
+        self.waypoints_gt = torch.cat(prediction["waypoints_gt"], dim=0).cpu().numpy()
+
+        self.masks = {
+            'cot': self.prompt_mask(lambda p: "What should the ego do next?" in p),
+            'qa': self.prompt_mask(lambda p: "Q:" in p),
+            'all': np.ones(len(self.prompts), dtype=bool),
+            'safety': self.prompt_mask(lambda p: "<SAFETY>" in p),
+            'instruction': self.prompt_mask(lambda p: "<INSTRUCTION_FOLLOWING>" in p),
+        }
+        self.masks['neither'] = ~self.masks['safety'] & ~self.masks['instruction']
+
+    def prompt_mask(self, condition):
+        return np.fromiter((condition(prompt) for prompt in self.prompts), dtype=bool, count=len(self.prompts))
+
+    @staticmethod
+    def select(values: List, mask: np.ndarray) -> List:
+        return [values[i] for i in np.flatnonzero(mask)]
+
+    def language_samples(self, mask):
+        return [(self.language[i], self.language_gt[i], self.paths[i]) for i in np.flatnonzero(mask)]
+
+    def instruction_metrics(self, mask, name):
+        """
+        Success rates of the instruction following eval for the samples in mask.
+        Returns (per sample results, metrics) in the layout of the former on_predict_epoch_end json files.
+        """
+        indices = np.flatnonzero(mask)
+        eval_infos = [self.eval_infos[i] for i in indices]
+        modes = np.array([info["mode"] for info in eval_infos], dtype=object)
+        paths = [self.paths[i] for i in indices]
+        pred_wps = self.waypoints[indices]
+        pred_route = self.route[indices]
+        pred_speeds = wps_speeds(pred_wps)
+        # the success is only counted for these categories
+        count_success = name == 'instruction' or name == 'neither'
+
+        success = np.zeros(len(indices), dtype=bool)
+        known = np.zeros(len(indices), dtype=bool)
+
+        def rows(mode):
+            return np.flatnonzero(modes == mode)
+
+        def prompts(rows_mode):
+            return [self.prompts[indices[i]].replace("<IMG_CONTEXT>", "") for i in rows_mode]
+
+        def infos(rows_mode, key):
+            return [eval_infos[i][key] for i in rows_mode]
+
+        rows_mode = rows('stop')
+        if len(rows_mode) > 0:
+            # route does not matter
+            success[rows_mode] = np.min(pred_speeds[rows_mode], axis=1) < 0.1
+        known[rows_mode] = True
+
+        for mode, sign in [('slower', -1), ('faster', 1)]:
+            rows_mode = rows(mode)
+            if len(rows_mode) > 0:
+                slopes = speed_slopes(pred_speeds[rows_mode])
+                current_speed = np.array([parse_current_speed(p) for p in prompts(rows_mode)])
+                success[rows_mode] = slopes < (-0.05 * current_speed) if sign < 0 else slopes > (0.05 * current_speed)
+            known[rows_mode] = True
+
+        rows_mode = rows('target_speed')
+        if len(rows_mode) > 0:
+            end_speed_pred = desired_end_speed(pred_wps[rows_mode])
+            end_speed_instruction = stack_rows(desired_end_speed, infos(rows_mode, "new_wps"))
+            target_speed = np.array([parse_target_speed(p) for p in prompts(rows_mode)])
+            success[rows_mode] = (((end_speed_pred > 0.8 * end_speed_instruction) & (end_speed_pred < 1.2 * end_speed_instruction))
+                                  | ((end_speed_pred > 0.8 * target_speed) & (end_speed_pred < 1.2 * target_speed)))
+        known[rows_mode] = True
+
+        rows_mode = rows('lane_change')
+        if len(rows_mode) > 0:
+            route_org_end = np.stack([np.asarray(route)[-1] for route in infos(rows_mode, "org_path")])
+            route_instruction_end = np.stack([np.asarray(route)[-1] for route in infos(rows_mode, "new_path")])
+            fde_pred_org = np.linalg.norm(pred_route[rows_mode][:, -1] - route_org_end, axis=-1)
+            fde_pred_instruction = np.linalg.norm(pred_route[rows_mode][:, -1] - route_instruction_end, axis=-1)
+            success[rows_mode] = fde_pred_instruction < fde_pred_org
+        known[rows_mode] = True
+
+        rows_mode = rows('crash')
+        if len(rows_mode) > 0:
+            route_org = infos(rows_mode, "org_path")
+            route_instruction = infos(rows_mode, "new_path")
+            ade_path_org_instruction = ade_rows(route_org, route_instruction)
+            ade_path_pred_org = ade_rows(pred_route[rows_mode], route_org)
+            ade_path_pred_instruction = ade_rows(pred_route[rows_mode], route_instruction)
+            mean_speed_pred = np.mean(pred_speeds[rows_mode], axis=1)
+            mean_speed_instruction = stack_rows(lambda wps: np.mean(wps_speeds(wps), axis=1), infos(rows_mode, "new_wps"))
+            success[rows_mode] = np.where(
+                ade_path_org_instruction > 1.0,
+                ade_path_pred_instruction < ade_path_pred_org,
+                (ade_path_pred_instruction < 1.0) & ((mean_speed_pred < 1.3 * mean_speed_instruction) | (mean_speed_pred > 0.7 * mean_speed_instruction)),
+            )
+        known[rows_mode] = True
+
+        for i in np.flatnonzero(~known):
+            print(f"Unknown mode: {modes[i]} in sample {i} with path {paths[i]}")
+
+        counted = known & count_success
+        paths_by_mode = {}
+        success_rate_by_mode = {}
+        # modes in the order of their first sample
+        for mode in dict.fromkeys(modes.tolist()):
+            in_mode = modes == mode
+            paths_by_mode[mode] = self.select(paths, in_mode & known)
+            success_rate_by_mode[mode] = success[in_mode & counted].astype(int).tolist()
+
+        metrics = {}
+        if counted.any():
+            metrics[f"success_rate_total_{name}"] = int(success[counted].sum()) / int(counted.sum())
+        else:
+            metrics[f"success_rate_total_{name}"] = 0
+        for mode, mode_success in success_rate_by_mode.items():
+            if len(mode_success) > 0:
+                metrics[f"success_rate_{name}_{mode}"] = sum(mode_success) / len(mode_success)
+            else:
+                metrics[f"success_rate_{name}_{mode}"] = 0
+        metrics[f"num_samples_{name}"] = len(ade(self.route[indices], self.route_gt[indices]))
+
+        per_sample_results = {
+            'paths_by_mode': paths_by_mode,
+            'success_rate_by_mode': success_rate_by_mode,
+        }
+        return per_sample_results, metrics
@@ -0,0 +1,105 @@
+"""
+Low overhead timers for the stages of the data pipeline (dataset __getitem__ and collate).
+
+Every process that records timings (main process and each data loader worker) owns one slot of a ring buffer in
+shared memory, so the workers write without locks and the training process reads all of them. The buffers are
+torch tensors in shared memory: workers started with fork see the same pages and workers started with spawn receive
+a handle when the dataset is pickled. StageTimingCallback (callbacks/stage_timing.py) turns the new timings into
+percentiles per stage every N steps and sends them to the lightning loggers.
+
+Usage:
+    with dataset.timed('image_decode'):
+        image = cv2.imread(path)
+"""
+import contextlib
+import os
+import time
+
+import torch
+
+# stages of Data_Driving.__getitem__ / BaseDataset and DataModule.dl_collate_fn
+DATASET_STAGES = ['measurements', 'route_waypoints', 'commentary_qa', 'image_decode', 'augmentation', 'conversation', 'getitem']
+COLLATE_STAGES = ['collate_augmentation', 'image_tiling', 'tokenization', 'collate']
+# recorded by StageTimingCallback in the training process
+TRAINER_STAGES = ['data_wait', 'train_step']
+STAGES = DATASET_STAGES + COLLATE_STAGES + TRAINER_STAGES
+
+
+class StageTimer:
+    """
+    Shared ring buffers of durations (seconds) per (slot, stage).
+    Slot 0 is the main process, slot i + 1 the data loader worker i. Workers of different data loaders
+    (train and val) with the same id share a slot, concurrent writes then only drop single timings.
+    """
+
+    def __init__(self, num_workers=0, window=1024, stages=None):
+        self.stages = list(stages) if stages is not None else STAGES
+        self.stage_ids = {stage: i for i, stage in enumerate(self.stages)}
+        self.num_slots = num_workers + 1
+        self.window = window
+        self.durations = torch.zeros((self.num_slots, len(self.stages), window), dtype=torch.float64).share_memory_()
+        self.counts = torch.zeros((self.num_slots, len(self.stages)), dtype=torch.int64).share_memory_()
+        # per reading process: counts at the last read
+        self.read_counts = torch.zeros((self.num_slots, len(self.stages)), dtype=torch.int64)
+        self._slot = None
+        self._slot_pid = None
+
+    def slot(self):
+        # cached per process, the worker info is only available inside a data loader worker
+        if self._slot_pid != os.getpid():
+            worker_info = torch.utils.data.get_worker_info()
+            worker_id = worker_info.id if worker_info is not None else -1
+            self._slot = min(worker_id + 1, self.num_slots - 1)
+            self._slot_pid = os.getpid()
+        return self._slot
+
+    def record(self, stage, duration):
+        slot = self.slot()
+        stage_id = self.stage_ids[stage]
+        count = int(self.counts[slot, stage_id])
+        self.durations[slot, stage_id, count % self.window] = duration
+        self.counts[slot, stage_id] = count + 1
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def read_new(self):
+        """Returns {stage: 1D tensor} with the durations recorded since the last call (at most window per slot)."""
+        counts = self.counts.clone()
+        new = {}
+        for stage, stage_id in self.stage_ids.items():
+            values = []
+            for slot in range(self.num_slots):
+                num_new = min(int(counts[slot, stage_id] - self.read_counts[slot, stage_id]), self.window)
+                if num_new <= 0:
+                    continue
+                end = int(counts[slot, stage_id])
+                positions = torch.arange(end - num_new, end) % self.window
+                values.append(self.durations[slot, stage_id, positions])
+            if len(values) > 0:
+                new[stage] = torch.cat(values)
+        self.read_counts = counts
+        return new
+
+    def summary(self, percentiles=(0.5, 0.9, 0.99)):
+        """{f'{stage}_p50': milliseconds, ..., f'{stage}_mean': ...} of the durations since the last call."""
+        metrics = {}
+        q = torch.tensor(percentiles, dtype=torch.float64)
+        for stage, values in self.read_new().items():
+            for p, value in zip(percentiles, torch.quantile(values, q).tolist()):
+                metrics[f'{stage}_p{int(round(p * 100))}'] = value * 1000
+            metrics[f'{stage}_mean'] = values.mean().item() * 1000
+            metrics[f'{stage}_count'] = float(len(values))
+        return metrics
+
+
+def timed(stage_timer, stage):
+    """Context manager that times stage if stage_timer is set, no-op otherwise."""
+    if stage_timer is None:
+        return contextlib.nullcontext()
+    return stage_timer.time(stage)
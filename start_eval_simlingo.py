@@ -1,13 +1,17 @@
 # %%
+import math
 import os
 import subprocess
+import threading
 import time
 import ujson
 import shutil
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
 from tqdm.autonotebook import tqdm
 
 # %%
-def run_bench2drive_evaluation(job, port, tm_port):
+def run_bench2drive_evaluation(job, port, tm_port, gpu=0):
     """Bench2Driveの評価を実行する関数"""
     cfg = job["cfg"]
     route = job["route"]
@@ -47,6 +51,7 @@ def run_bench2drive_evaluation(job, port, tm_port):
         'LEADERBOARD_ROOT': f"{cfg['repo_root']}/Bench2Drive/leaderboard",
         'SAVE_PATH': viz_path,
         'TEAM_CODE_ROOT': f"{cfg['repo_root']}/team_code",
+        'CUDA_VISIBLE_DEVICES': str(gpu),
     })
     
     # デバッグ用：環境変数をログに出力
@@ -58,6 +63,7 @@ def run_bench2drive_evaluation(job, port, tm_port):
         f.write(f"Agent: {cfg['agent']}\n")
         f.write(f"Checkpoint: {cfg['checkpoint']}\n")
         f.write(f"Route: {route}\n")
+        f.write(f"GPU: {gpu}, Port: {port}, TM Port: {tm_port}\n")
         f.write("-"*70 + "\n")
         f.write("ENVIRONMENT VARIABLES:\n")
         f.write("-"*70 + "\n")
@@ -90,7 +96,9 @@ def run_bench2drive_evaluation(job, port, tm_port):
         f"--agent-config={cfg['checkpoint']}",
         f'--traffic-manager-seed={seed}',
         f'--port={port}',
-        f'--traffic-manager-port={tm_port}'
+        f'--traffic-manager-port={tm_port}',
+        f'--gpu-rank={gpu}',
+        f"--startup-metrics={os.path.join(os.path.dirname(result_file), 'startup_metrics.jsonl')}"
     ]
 
     print(f"\n{'='*60}")
@@ -184,37 +192,216 @@ def run_bench2drive_evaluation(job, port, tm_port):
         return False
 
 # %%
-def filter_completed(jobs):
-    """完了したジョブをフィルタリング"""
-    filtered_jobs = []
+FAILED_STATUSES = ['Failed - Agent couldn\'t be set up', 'Failed', 'Failed - Simulation crashed', 'Failed - Agent crashed']
 
-    for job in jobs:
-        result_file = job["result_file"]
-        if os.path.exists(result_file):
+
+def is_result_complete(result_file):
+    """結果ファイルが完了済み（全ルート終了・失敗なし）かどうか"""
+    try:
+        with open(result_file, "r") as f:
+            evaluation_data = ujson.load(f)
+        progress = evaluation_data['_checkpoint']['progress']
+        records = evaluation_data['_checkpoint']['records']
+    except Exception:
+        return False
+
+    if len(progress) < 2 or progress[0] < progress[1]:
+        return False
+    return all(record['status'] not in FAILED_STATUSES for record in records)
+
+
+class CompletionIndex:
+    """
+    結果ファイルの完了状態のインデックス（out_root/completion_index.json）。
+    結果ファイルは (mtime, size) が変わったときだけ再度読み込むので、再開時に全ファイルを読み直さない。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
             try:
-                with open(result_file, "r") as f:
-                    evaluation_data = ujson.load(f)
-            except:
-                if job["tries"] > 0:
-                    filtered_jobs.append(job)
-                    continue
-
-            progress = evaluation_data['_checkpoint']['progress']
-
-            need_to_resubmit = False
-            if len(progress) < 2 or progress[0] < progress[1]:
-                need_to_resubmit = True
+                with open(path, "r") as f:
+                    self.entries = ujson.load(f)
+            except Exception:
+                self.entries = {}
+        self.lock = threading.Lock()
+
+    def is_complete(self, result_file):
+        try:
+            stat = os.stat(result_file)
+        except FileNotFoundError:
+            return False
+        key = os.path.abspath(result_file)
+        signature = [stat.st_mtime_ns, stat.st_size]
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry["signature"] == signature:
+                return entry["complete"]
+        complete = is_result_complete(result_file)
+        with self.lock:
+            self.entries[key] = {"signature": signature, "complete": complete}
+        return complete
+
+    def save(self):
+        with self.lock:
+            entries = dict(self.entries)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path + ".tmp", "w") as f:
+            ujson.dump(entries, f)
+        os.replace(self.path + ".tmp", self.path)
+
+
+def filter_completed(jobs, completion_index):
+    """完了したジョブと試行回数を使い切ったジョブをフィルタリング"""
+    return [job for job in jobs if job["tries"] > 0 and not completion_index.is_complete(job["result_file"])]
+
+
+# %%
+def route_length(route_file):
+    """ルートXMLのウェイポイント間の距離の合計 [m]"""
+    try:
+        root = ET.parse(route_file).getroot()
+    except Exception:
+        return 0.0
+    length = 0.0
+    for route in root.iter("route"):
+        positions = [(float(p.get("x")), float(p.get("y"))) for p in route.iter("position")]
+        for (x0, y0), (x1, y1) in zip(positions[:-1], positions[1:]):
+            length += math.hypot(x1 - x0, y1 - y0)
+    return length
+
+
+def read_max_num_jobs(path, default=1):
+    """max_num_jobs.txt を毎回読み込む（実行中に変更可能）"""
+    try:
+        with open(path, "r") as f:
+            return max(1, int(f.read().strip()))
+    except Exception:
+        return default
+
+
+def get_gpus():
+    """使用するGPUのリスト（CUDA_VISIBLE_DEVICES または nvidia-smi から）"""
+    visible = os.environ.get("CUDA_VISIBLE_DEVICES")
+    if visible:
+        return [gpu.strip() for gpu in visible.split(",") if gpu.strip()]
+    try:
+        output = subprocess.run(["nvidia-smi", "-L"], capture_output=True, text=True, check=True).stdout
+        num_gpus = len([line for line in output.splitlines() if line.startswith("GPU")])
+    except Exception:
+        num_gpus = 0
+    return [str(gpu) for gpu in range(max(1, num_gpus))]
+
+
+# 同時実行スロット数の上限（max_num_jobs.txt の値もこれで制限、さらにポート範囲の間隔で制限）
+MAX_SLOTS = 64
+
+
+class SlotScheduler:
+    """
+    N個のスロットでジョブを並列に実行するスケジューラ。
+    - スロット数は max_num_jobs.txt で制限（実行中に変更可能、減らした場合は実行中のジョブは最後まで実行）
+    - スロットごとに重ならないポート範囲とGPUを割り当て（CARLAは port, port+1, port+2 を使用）
+    - ルートの長い順に実行
+    - 失敗したジョブは指数的なバックオフの後に再実行
+    """
+
+    def __init__(self, jobs, completion_index, max_num_jobs_file, gpus, world_port=10000, tm_port=8000,
+                 port_stride=50, retry_backoff=30, max_retry_backoff=600):
+        self.jobs = sorted(jobs, key=lambda job: job["route_length"], reverse=True)
+        self.completion_index = completion_index
+        self.max_num_jobs_file = max_num_jobs_file
+        self.gpus = gpus
+        self.world_port = world_port
+        self.tm_port = tm_port
+        self.port_stride = port_stride
+        self.retry_backoff = retry_backoff
+        self.max_retry_backoff = max_retry_backoff
+        self.running = {}  # slot -> (job, future)
+
+        # world ポート範囲と TM ポート範囲が重ならないスロット数まで（例: 8000..9999 と 10000..）
+        low, high = sorted([world_port, tm_port])
+        self.max_slots = min(MAX_SLOTS, (high - low) // port_stride)
+        if self.max_slots < 1:
+            raise ValueError(f"world_port {world_port} と tm_port {tm_port} の間隔が port_stride {port_stride} より小さい")
+
+    def slot_resources(self, slot):
+        return (self.world_port + slot * self.port_stride,
+                self.tm_port + slot * self.port_stride,
+                self.gpus[slot % len(self.gpus)])
+
+    def next_job(self, now):
+        running_jobs = [id(job) for job, _ in self.running.values()]
+        for job in self.jobs:
+            if id(job) not in running_jobs and job["not_before"] <= now:
+                return job
+        return None
+
+    def start(self, executor, slot, job):
+        port, tm_port, gpu = self.slot_resources(slot)
+
+        # vizディレクトリをクリーンアップ
+        if os.path.exists(job["viz_path"]):
+            shutil.rmtree(job["viz_path"])
+        os.makedirs(job["viz_path"], exist_ok=True)
+
+        # Bench2Drive評価の実行
+        if job["cfg"]["benchmark"].lower() == "bench2drive":
+            future = executor.submit(run_bench2drive_evaluation, job, port, tm_port, gpu)
+        else:
+            raise NotImplementedError(f"Benchmark {job['cfg']['benchmark']} not implemented.")
+        print(f'開始: {job["route_id"]} (seed {job["seed"]}, slot {slot}, GPU {gpu}, port {port}, tm_port {tm_port})')
+        self.running[slot] = (job, future)
+
+    def collect(self):
+        for slot, (job, future) in list(self.running.items()):
+            if not future.done():
+                continue
+            del self.running[slot]
+            try:
+                success = future.result()
+            except Exception as e:
+                print(f"⚠ 予期しないエラー: {e}")
+                success = False
+
+            job["tries"] -= 1
+            if success and self.completion_index.is_complete(job["result_file"]):
+                print(f'完了: {job["route_id"]}')
             else:
-                for record in evaluation_data['_checkpoint']['records']:
-                    if record['status'] in ['Failed - Agent couldn\'t be set up', 'Failed', 'Failed - Simulation crashed', 'Failed - Agent crashed']:
-                        need_to_resubmit = True
-
-            if need_to_resubmit and job["tries"] > 0:
-                filtered_jobs.append(job)
-        elif job["tries"] > 0:
-            filtered_jobs.append(job)
-            
-    return filtered_jobs
+                attempt = job["cfg"]["tries"] - job["tries"]
+                backoff = min(self.retry_backoff * 2 ** (attempt - 1), self.max_retry_backoff)
+                job["not_before"] = time.time() + backoff
+                print(f'失敗: {job["route_id"]} (残り試行回数: {job["tries"]}, {backoff}秒後に再試行)')
+
+    def run(self):
+        total = len(self.jobs)
+        progress = tqdm(total=total)
+        with ThreadPoolExecutor(max_workers=self.max_slots) as executor:
+            while True:
+                self.collect()
+                self.jobs = filter_completed(self.jobs, self.completion_index)
+                self.completion_index.save()
+                progress.update(total - len(self.jobs) - progress.n)
+
+                if not self.jobs and not self.running:
+                    break
+
+                num_slots = min(read_max_num_jobs(self.max_num_jobs_file), self.max_slots)
+                now = time.time()
+                for slot in range(num_slots):
+                    if slot in self.running:
+                        continue
+                    job = self.next_job(now)
+                    if job is None:
+                        break
+                    self.start(executor, slot, job)
+                    # CARLAの同時起動を避ける
+                    time.sleep(2)
+
+                time.sleep(1)
+
+        progress.close()
 
 # %%
 def load_config():
@@ -254,6 +441,7 @@ if __name__ == "__main__":
     for cfg_idx, cfg in enumerate(configs):
         route_path = cfg["route_path"]
         routes = [x for x in os.listdir(route_path) if x[-4:] == ".xml"]
+        route_lengths = {os.path.join(route_path, route): route_length(os.path.join(route_path, route)) for route in routes}
 
         if cfg["benchmark"] == "bench2drive":
             fill_zeros = 3
@@ -289,52 +477,19 @@ if __name__ == "__main__":
                     "result_file": result_file,
                     "log_file": log_file,
                     "err_file": err_file,
-                    "tries": cfg["tries"]
+                    "tries": cfg["tries"],
+                    "route_length": route_lengths[route],
+                    "not_before": 0.0,
                 }
 
                 job_queue.append(job)
 
-    # ポート設定
-    carla_world_port = 10000
-    carla_tm_port = 8000
+    # 完了状態のインデックス（最初の設定の out_root に保存）
+    completion_index = CompletionIndex(os.path.join(configs[0]["out_root"], "completion_index.json"))
+    max_num_jobs_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "max_num_jobs.txt")
 
     # ジョブの実行
-    jobs = len(job_queue)
-    progress = tqdm(total=jobs)
-
-    while job_queue:
-        job_queue = filter_completed(job_queue)
-        progress.update(jobs - len(job_queue) - progress.n)
-        
-        if not job_queue:
-            break
-
-        for job in job_queue:
-            if job["tries"] <= 0:
-                continue
-
-            # vizディレクトリをクリーンアップ
-            if os.path.exists(job["viz_path"]):
-                shutil.rmtree(job["viz_path"])
-            os.makedirs(job["viz_path"], exist_ok=True)
-
-            # Bench2Drive評価の実行
-            if job["cfg"]["benchmark"].lower() == "bench2drive":
-                success = run_bench2drive_evaluation(job, carla_world_port, carla_tm_port)
-            else:
-                raise NotImplementedError(f"Benchmark {job['cfg']['benchmark']} not implemented.")
-
-            job["tries"] -= 1
-            
-            if success:
-                print(f'完了: {job["route_id"]}')
-            else:
-                print(f'失敗: {job["route_id"]} (残り試行回数: {job["tries"]})')
-            
-            time.sleep(2)
-            break
-
-        time.sleep(1)
-
-    progress.close()
-    print("すべてのジョブが完了しました。")
\ No newline at end of file
+    scheduler = SlotScheduler(job_queue, completion_index, max_num_jobs_file, get_gpus(),
+                              world_port=10000, tm_port=8000)
+    scheduler.run()
+    print("すべてのジョブが完了しました。")
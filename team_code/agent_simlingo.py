@@ -36,8 +36,11 @@ import scenario_logger
 import team_code.transfuser_utils as t_u    #制御タスク
 from scenario_logger import ScenarioLogger  #logger 成功率などを判定するため
 from simlingo_training.utils.custom_types import DrivingInput, LanguageLabel    #モデルへの入力、言語モデル
-from simlingo_training.utils.internvl2_utils import build_transform, dynamic_preprocess #画像の前処理
+from simlingo_training.utils.inference_checkpoint import is_inference_checkpoint, load_inference_checkpoint, read_metadata
+from simlingo_training.utils.internvl2_utils import build_transform, dynamic_preprocess, preprocess_image_batch_tensor #画像の前処理
+from team_code import model_registry
 from team_code.config_simlingo import GlobalConfig
+from team_code.metric_info_writer import MetricInfoWriter, build_metric_info_json
 from team_code.nav_planner import LateralPIDController, RoutePlanner #経路計画 #制御タスク
 from team_code.simlingo_utils import (
     get_camera_extrinsics,
@@ -83,11 +86,35 @@ class LingoAgent(autonomous_agent.AutonomousAgent):
             print(f"Config path: {self.config_path}")
             self.save_path_root = route_index
             print(f"Save path root: {self.save_path_root}")
+        self.device = torch.device('cuda')
+
+        # the model is loaded once per evaluator process and shared by the agents of all routes
+        loaded = model_registry.get_model(self.config_path, torch.bfloat16, self.load_model)
+        self.model = loaded.model
+        self.processor = loaded.processor
+        self.tokenizer = loaded.tokenizer
+        self.cfg = loaded.cfg
+        self.init_prompt_cache()
+        # iteration and session of the training run, for an inference checkpoint from the checkpoint it was exported from
+        checkpoint_path = self.config_path
+        if is_inference_checkpoint(checkpoint_path):
+            checkpoint_path = read_metadata(checkpoint_path)['source_checkpoint']
+        self.iter = checkpoint_path.split("epoch=")[-1].split("/")[0]
+        self.session = checkpoint_path.split("/")[-4]
+
+        self.reset_route_state(route_index)
+
+    def reset_route_state(self, route_index=None):
+        """
+        Creates all state that changes while driving a route: planners, filters, controllers, buffers and logging
+        paths. Nothing of it may be stored on the shared model, processor or tokenizer (see team_code/model_registry.py),
+        so a route never sees state of the previous one.
+        """
         self.step = -1
         self.initialized = False
-        self.device = torch.device('cuda')
         self.DrivingInput = {}
         self.config = GlobalConfig()
+        self.metric_info_writer = None
 
         if self.config.eval_route_as == -1:
             self.config.eval_route_as = self.model.route_as
@@ -144,38 +171,6 @@ class LingoAgent(autonomous_agent.AutonomousAgent):
         self.route_planner_max_distance = 50.0
         self.route_planner_min_distance = 7.5
 
-        #load config from .hydra folder
-        self.config_load_path = Path(self.config_path).parent.parent.parent / '.hydra' / 'config.yaml'
-        with open(self.config_load_path, 'r') as file:
-            cfg = OmegaConf.load(file)
-        self.cfg = cfg
-        self.cfg.model.vision_model.use_global_img = cfg.data_module.use_global_img
-    
-        processor = AutoProcessor.from_pretrained(cfg.model.vision_model.variant, trust_remote_code=True)
-        if 'tokenizer' in processor.__dict__:
-                self.tokenizer = processor.tokenizer
-        else:
-                self.tokenizer = processor
-        self.tokenizer.add_special_tokens({'additional_special_tokens': ['<WAYPOINTS>','<WAYPOINTS_DIFF>', '<ORG_WAYPOINTS_DIFF>', '<ORG_WAYPOINTS>', '<WAYPOINT_LAST>', '<ROUTE>', '<ROUTE_DIFF>', '<TARGET_POINT>']})
-        self.tokenizer.padding_side = "left"
-        # llm_tokenizer = AutoTokenizer.from_pretrained(cfg.model.language_model.variant)
-        cache_dir = f"pretrained/{(cfg.model.vision_model.variant.split('/')[1])}"
-        default_dtype = torch.get_default_dtype()
-        torch.set_default_dtype(torch.bfloat16)
-
-        #ここをhydraを使わずに直書きで解決したい-------------------------------------------------------------------------------------------------------------------------------
-        self.model = hydra.utils.instantiate(
-                cfg.model,
-                cfg_data_module=cfg.data_module,
-                processor=processor,
-                cache_dir=cache_dir,
-                _recursive_=False
-            ).to(self.device)
-        torch.set_default_dtype(default_dtype)
-        self.model.load_state_dict(torch.load(self.config_path))
-        self.iter = self.config_path.split("epoch=")[-1].split("/")[0]
-        self.session = self.config_path.split("/")[-4]
-        
         self.T = 1
         self.stuck_detector = 0
         self.force_move = 0
@@ -237,6 +232,117 @@ class LingoAgent(autonomous_agent.AutonomousAgent):
             self.save_path_img = self.debug_save_path + '/images'
             Path(self.save_path_img).mkdir(parents=True, exist_ok=True)
             
+    def load_model(self):
+        """Loads the model of self.config_path, called by the model registry if it is not loaded yet."""
+        if is_inference_checkpoint(self.config_path):
+            # exported bf16 checkpoint (simlingo_training/utils/inference_checkpoint.py), config and tokenizer
+            # settings are stored in the file, the weights are memory mapped to the device
+            model, processor, cfg = load_inference_checkpoint(self.config_path, device=self.device)
+            if 'tokenizer' in processor.__dict__:
+                    tokenizer = processor.tokenizer
+            else:
+                    tokenizer = processor
+            return model_registry.LoadedModel(model, processor, tokenizer, cfg)
+        return self.load_training_checkpoint()
+
+    def load_training_checkpoint(self):
+        #load config from .hydra folder
+        self.config_load_path = Path(self.config_path).parent.parent.parent / '.hydra' / 'config.yaml'
+        with open(self.config_load_path, 'r') as file:
+            cfg = OmegaConf.load(file)
+        cfg.model.vision_model.use_global_img = cfg.data_module.use_global_img
+    
+        processor = AutoProcessor.from_pretrained(cfg.model.vision_model.variant, trust_remote_code=True)
+        if 'tokenizer' in processor.__dict__:
+                tokenizer = processor.tokenizer
+        else:
+                tokenizer = processor
+        tokenizer.add_special_tokens({'additional_special_tokens': ['<WAYPOINTS>','<WAYPOINTS_DIFF>', '<ORG_WAYPOINTS_DIFF>', '<ORG_WAYPOINTS>', '<WAYPOINT_LAST>', '<ROUTE>', '<ROUTE_DIFF>', '<TARGET_POINT>']})
+        tokenizer.padding_side = "left"
+        # llm_tokenizer = AutoTokenizer.from_pretrained(cfg.model.language_model.variant)
+        cache_dir = f"pretrained/{(cfg.model.vision_model.variant.split('/')[1])}"
+        default_dtype = torch.get_default_dtype()
+        torch.set_default_dtype(torch.bfloat16)
+
+        #ここをhydraを使わずに直書きで解決したい-------------------------------------------------------------------------------------------------------------------------------
+        model = hydra.utils.instantiate(
+                cfg.model,
+                cfg_data_module=cfg.data_module,
+                processor=processor,
+                cache_dir=cache_dir,
+                _recursive_=False
+            ).to(self.device)
+        torch.set_default_dtype(default_dtype)
+        model.load_state_dict(torch.load(self.config_path))
+        return model_registry.LoadedModel(model, processor, tokenizer, cfg)
+
+    def init_prompt_cache(self):
+        """
+        Loads the conversation template once and pre-tokenizes the fixed parts of the inference prompt
+        (chat tokens and the image token span), so tick only has to tokenize the text that changes every step.
+        """
+        cache_dir = f"pretrained/{(self.cfg.model.vision_model.variant.split('/')[1])}"
+        # get absolute path from workspace dir not wokring dir
+        cache_dir = to_absolute_path(cache_dir)
+        model_path = f"{cache_dir}/conversation.py"
+        if not os.path.exists(model_path):
+                from huggingface_hub import snapshot_download
+                snapshot_download(repo_id=self.cfg.model.vision_model.variant, local_dir=cache_dir)
+
+        #import from file from model_path
+        spec = importlib.util.spec_from_file_location('get_conv_template', model_path)
+        conv_module = importlib.util.module_from_spec(spec)
+        sys.modules['get_conv_template'] = conv_module
+        spec.loader.exec_module(conv_module)
+        self.conv_module = conv_module
+
+        self.tmp_config = AutoConfig.from_pretrained(self.cfg.model.vision_model.variant, trust_remote_code=True)
+        image_size = self.tmp_config.force_image_size or self.tmp_config.vision_config.image_size
+        patch_size = self.tmp_config.vision_config.patch_size
+        self.num_image_token = int((image_size // patch_size) ** 2 * (self.tmp_config.downsample_ratio ** 2))
+
+        template = conv_module.get_conv_template('internlm2-chat')
+        prompt_marker = '<PROMPT>'
+        template.append_message(template.roles[0], '<image>\n' + prompt_marker)
+        template.append_message(template.roles[1], None)
+        query = template.get_prompt()
+        # remove system prompt
+        system_prompt = template.system_template.replace('{system_message}', template.system_message) + template.sep
+        query = query.replace(system_prompt, '')
+
+        IMG_START_TOKEN='<img>'
+        IMG_END_TOKEN='</img>'
+        IMG_CONTEXT_TOKEN='<IMG_CONTEXT>'
+        num_patches_all = 2 # sum(grid_nums)
+
+        image_tokens = IMG_START_TOKEN + IMG_CONTEXT_TOKEN * self.num_image_token * num_patches_all + IMG_END_TOKEN
+        query = query.replace('<image>', image_tokens, 1)
+
+        self.prompt_prefix, self.prompt_suffix = query.split(prompt_marker)
+        self.prompt_prefix_ids = self.tokenizer(self.prompt_prefix, add_special_tokens=False, return_tensors="pt")["input_ids"][0]
+        self.prompt_suffix_ids = self.tokenizer(self.prompt_suffix, add_special_tokens=False, return_tensors="pt")["input_ids"][0]
+        # splicing is checked against tokenizing the whole query on the first step
+        self.prompt_cache_checked = False
+        self.use_prompt_cache = True
+
+    def tokenize_prompt(self, prompt, query):
+        """Returns the [1, N] input ids of query, which is prompt_prefix + prompt + prompt_suffix."""
+        if not self.use_prompt_cache:
+            return self.tokenizer([query], add_special_tokens=False, return_tensors="pt")["input_ids"]
+
+        prompt_ids = self.tokenizer(prompt, add_special_tokens=False, return_tensors="pt")["input_ids"][0]
+        input_ids = torch.cat((self.prompt_prefix_ids, prompt_ids, self.prompt_suffix_ids)).unsqueeze(0)
+
+        if not self.prompt_cache_checked:
+            self.prompt_cache_checked = True
+            full_input_ids = self.tokenizer([query], add_special_tokens=False, return_tensors="pt")["input_ids"]
+            if not torch.equal(full_input_ids, input_ids):
+                # the tokenizer merges tokens across the split points, fall back to tokenizing the whole query
+                print('Prompt cache: spliced tokens differ from the full prompt, tokenizing the whole prompt every step.')
+                self.use_prompt_cache = False
+                return full_input_ids
+        return input_ids
+
     def input_thread(self):
         while self.running:
             user_input = input("Enter a command for the vehicle. 1: turn left, 2: turn right, 3: lane change left, 4: lane change right, 5: stop, 6: accelerate: ")
@@ -293,7 +399,9 @@ class LingoAgent(autonomous_agent.AutonomousAgent):
                                                                              self.lat_ref, self.lon_ref)
         self._route_planner.set_route(self._global_plan, True)
         self.initialized = True
-        self.metric_info = {}
+        self.metric_info_writer = None
+        if self.save_path_metric is not None:
+            self.metric_info_writer = MetricInfoWriter(self.save_path_metric)
 
     def sensors(self):
         sensors = []
@@ -388,21 +496,30 @@ class LingoAgent(autonomous_agent.AutonomousAgent):
         
         if 'internvl2' in self.cfg.model.vision_model.variant.lower():
             T, C, H, W = rgbs.shape
-            transform = build_transform(input_size=448)
-            images_processed_tmp = []
-            images_sizes_tmp = []
-            
-            image = Image.fromarray(rgbs.squeeze(0).transpose(1, 2, 0))
-            images = dynamic_preprocess(image, image_size=448, use_thumbnail=self.cfg.model.vision_model.use_global_img, max_num=2)
-            pixel_values = [transform(image) for image in images]
-            pixel_values = torch.stack(pixel_values)
-            images_processed_tmp.append(pixel_values)
-            images_sizes_tmp.append([image.size[1], image.size[0]])
-            
-            images_processed = {
-                    'pixel_values': torch.stack(images_processed_tmp), 
-                    'image_sizes': torch.tensor(images_sizes_tmp)
-                    }  
+            if self.config.image_preprocessing == 'tensor':
+                images_processed = preprocess_image_batch_tensor(
+                        torch.from_numpy(rgbs), 
+                        input_size=448, 
+                        use_global_img=self.cfg.model.vision_model.use_global_img, 
+                        max_num_grid=2, 
+                        device=self.device,
+                        )
+            else:
+                transform = build_transform(input_size=448)
+                images_processed_tmp = []
+                images_sizes_tmp = []
+                
+                image = Image.fromarray(rgbs.squeeze(0).transpose(1, 2, 0))
+                images = dynamic_preprocess(image, image_size=448, use_thumbnail=self.cfg.model.vision_model.use_global_img, max_num=2)
+                pixel_values = [transform(image) for image in images]
+                pixel_values = torch.stack(pixel_values)
+                images_processed_tmp.append(pixel_values)
+                images_sizes_tmp.append([image.size[1], image.size[0]])
+                
+                images_processed = {
+                        'pixel_values': torch.stack(images_processed_tmp), 
+                        'image_sizes': torch.tensor(images_sizes_tmp)
+                        }  
             processed_image = images_processed['pixel_values']
             num_patches = processed_image.shape[1]
             new_height = processed_image.shape[3]
@@ -563,88 +680,10 @@ class LingoAgent(autonomous_agent.AutonomousAgent):
         self.prompt_tp = prompt_tp
         self.prompt = prompt
         
-        conversation_all = [
-                {
-                "role": "user",
-                "content": [
-                        {"type": "text", "text": prompt},
-                        {"type": "image"},
-                        ],
-                },
-                {
-                "role": "assistant",
-                "content": [
-                        {"type": "text", "text": "Waypoints:"},
-                        ],
-                },
-        ]
-        conv_batch_list = [conversation_all]
-        questions = []
-        for conv in conv_batch_list:
-                for i in range(len(conv)):
-                        questions.append(conv[i]['content'][0]['text'])
-                        conv[i]['content'] = conv[i]['content'][0]['text']
-                        
-        cache_dir = f"pretrained/{(self.cfg.model.vision_model.variant.split('/')[1])}"
-        # get absolute path from workspace dir not wokring dir
-        cache_dir = to_absolute_path(cache_dir)
-        model_path = f"{cache_dir}/conversation.py"
-        if not os.path.exists(model_path):
-                from huggingface_hub import snapshot_download
-                snapshot_download(repo_id=self.cfg.model.vision_model.variant, local_dir=cache_dir)
-                
-        #import from file from model_path
-        spec = importlib.util.spec_from_file_location('get_conv_template', model_path)
-        conv_module = importlib.util.module_from_spec(spec)
-        sys.modules['get_conv_template'] = conv_module
-        spec.loader.exec_module(conv_module)
-        
-        if not hasattr(self, 'tmp_config'):
-                self.tmp_config = AutoConfig.from_pretrained(self.cfg.model.vision_model.variant, trust_remote_code=True)
-                image_size = self.tmp_config.force_image_size or self.tmp_config.vision_config.image_size
-                patch_size = self.tmp_config.vision_config.patch_size
-                
-                self.num_image_token = int((image_size // patch_size) ** 2 * (self.tmp_config.downsample_ratio ** 2))
-                
-        prompt_batch_list = []
-        for idx, conv in enumerate(conv_batch_list):
-                question = questions[idx]
-                if '<image>' not in question:
-                        question = '<image>\n' + question
-                template = conv_module.get_conv_template('internlm2-chat')
-                template_inference = None
-                
-                template_inference = conv_module.get_conv_template('internlm2-chat')
-                for conv_part_idx, conv_part in enumerate(conv):
-                        if conv_part['role'] == 'assistant':
-                                # template.append_message(template.roles[1], conv_part['content'])
-                                template.append_message(template.roles[1], None)
-                        elif conv_part['role'] == 'user':
-                                if conv_part_idx == 0 and '<image>' not in conv_part['content']:
-                                        # add image token
-                                        conv_part['content'] = '<image>\n' + conv_part['content']
-                                template.append_message(template.roles[0], conv_part['content'])
-                        else:
-                                raise ValueError(f"Role {conv_part['role']} not supported")
-                            
-                query = template.get_prompt()
-                # remove system prompt
-                system_prompt = template.system_template.replace('{system_message}', template.system_message) + template.sep
-                query = query.replace(system_prompt, '')
-                
-                IMG_START_TOKEN='<img>'
-                IMG_END_TOKEN='</img>'
-                IMG_CONTEXT_TOKEN='<IMG_CONTEXT>'
-                num_patches_all = 2 # sum(grid_nums)
-
-                image_tokens = IMG_START_TOKEN + IMG_CONTEXT_TOKEN * self.num_image_token * num_patches_all + IMG_END_TOKEN
-                query = query.replace('<image>', image_tokens, 1)
-                prompt_batch_list.append(query)
-                
-        prompt_tokenized = self.tokenizer(prompt_batch_list, padding=True, return_tensors="pt", return_offsets_mapping=True, add_special_tokens=False)
-        prompt_tokenized_ids = prompt_tokenized["input_ids"]
-        prompt_tokenized_char_offsets = prompt_tokenized["offset_mapping"].view(1, -1, 2)
-        prompt_tokenized_valid = prompt_tokenized["input_ids"] != self.tokenizer.pad_token_id
+        query = self.prompt_prefix + prompt + self.prompt_suffix
+        prompt_batch_list = [query]
+        prompt_tokenized_ids = self.tokenize_prompt(prompt, query)
+        prompt_tokenized_valid = prompt_tokenized_ids != self.tokenizer.pad_token_id
         prompt_tokenized_mask = prompt_tokenized_valid
         
         ll = LanguageLabel(
@@ -792,12 +831,9 @@ class LingoAgent(autonomous_agent.AutonomousAgent):
             self.control = control
             
         metric_info = self.get_metric_info()
-        self.metric_info[self.step] = metric_info
-        if self.save_path_metric is not None and self.step % 1 == 0:
-                # metric info
-                outfile = open(f"{self.save_path_metric}/metric_info.json", 'w')
-                json.dump(self.metric_info, outfile, indent=4)
-                outfile.close()
+        if self.metric_info_writer is not None:
+                # appended on a background thread, metric_info.json is built in destroy
+                self.metric_info_writer.write(self.step, metric_info)
 
         return control
 
@@ -863,11 +899,18 @@ class LingoAgent(autonomous_agent.AutonomousAgent):
         The leaderboard client doesn't properly clear up the agent after the route finishes so we need to do it here.
         Also writes logging files to disk.
         """
-
-        del self.model
+        if getattr(self, 'metric_info_writer', None) is not None:
+            self.metric_info_writer.close()
+            build_metric_info_json(self.save_path_metric)
+            self.metric_info_writer = None
+
+        # the model stays in the registry for the next route, the agent only drops its references
+        self.model = None
+        self.processor = None
+        self.tokenizer = None
         del self.config
-        if self.cfg.data_module.encoder == 'llavanext':
-            del self.processor
+        if not model_registry.keep_resident():
+            torch.cuda.empty_cache()
 
 
 # Filter Functions
@@ -7,6 +7,9 @@ class GlobalConfig:
         self.eval_route_as = 'target_point' # "target_point" or "target_point_command" "command", -1 -> use from model config
         # if target_point_command (trained on both we eval with targetpoint)
         self.use_cot = True
+        # "pil": PIL dynamic_preprocess, "tensor": batched torch resize/tiling/normalization on the model device
+        # (within one uint8 level of "pil", see simlingo_training/tests/test_image_preprocessing.py)
+        self.image_preprocessing = 'pil'
 
         self.carla_frame_rate = 1.0 / 20.0  # CARLA frame rate in milliseconds
         self.carla_fps = 20  # Simulator Frames per second
@@ -0,0 +1,125 @@
+"""
+Append-only writer for the per-step metric info of the agent.
+
+The agent used to rewrite the whole metric_info.json on every step, which makes the I/O of a route quadratic in
+its length and blocks the control loop. MetricInfoWriter appends one json line per step (metric_info.jsonl) on a
+background thread. When the route is finished the aggregated metric_info.json, in the format read by
+Bench2Drive/tools/efficiency_smoothness_benchmark.py, is built once from the lines.
+
+Rebuild metric_info.json of all routes below a folder (e.g. after a crash) with:
+    python team_code/metric_info_writer.py --path eval_results
+"""
+import argparse
+import atexit
+import json
+import os
+import queue
+import threading
+
+METRIC_INFO_JSONL = 'metric_info.jsonl'
+METRIC_INFO_JSON = 'metric_info.json'
+
+
+class MetricInfoWriter:
+    """
+    Writes {"step": step, **metric_info} lines to save_dir/metric_info.jsonl on a background thread.
+    At most max_buffered records are queued, write() blocks if the writer falls behind that far.
+    close() writes all queued records, it is also called at interpreter exit if the writer was not closed before.
+    """
+
+    def __init__(self, save_dir, max_buffered=1000, flush_every=20):
+        self.save_dir = save_dir
+        self.file_path = os.path.join(save_dir, METRIC_INFO_JSONL)
+        self.flush_every = flush_every
+        self.queue = queue.Queue(maxsize=max_buffered)
+        self.closed = False
+        self.error = None
+
+        # a new route starts a new file
+        self.file = open(self.file_path, 'w', encoding='utf-8')
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        num_unflushed = 0
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            try:
+                self.file.write(json.dumps(record) + '\n')
+                num_unflushed += 1
+                if num_unflushed >= self.flush_every or self.queue.empty():
+                    self.file.flush()
+                    num_unflushed = 0
+            except (OSError, TypeError, ValueError) as e:
+                # keep draining the queue so the agent never blocks on a broken writer
+                self.error = e
+        self.file.flush()
+        self.file.close()
+
+    def write(self, step, metric_info):
+        if self.closed:
+            raise RuntimeError(f'MetricInfoWriter for {self.file_path} is already closed')
+        record = {'step': step}
+        record.update(metric_info)
+        self.queue.put(record)
+
+    def close(self):
+        """Writes all queued records and closes the file. Safe to call more than once."""
+        if self.closed:
+            return
+        self.closed = True
+        # the agent creates one writer per route, a closed writer must not stay registered until exit
+        atexit.unregister(self.close)
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            print(f'Error while writing {self.file_path}: {self.error}', flush=True)
+
+
+def read_metric_info_jsonl(jsonl_path):
+    """Returns {step: metric_info} of a metric_info.jsonl file. A truncated last line (crash) is skipped."""
+    metric_info = {}
+    with open(jsonl_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                print(f'Skipping incomplete line in {jsonl_path}', flush=True)
+                continue
+            step = record.pop('step')
+            metric_info[step] = record
+    return metric_info
+
+
+def build_metric_info_json(save_dir):
+    """Aggregates save_dir/metric_info.jsonl into save_dir/metric_info.json (same layout as the former per-step dump)."""
+    metric_info = read_metric_info_jsonl(os.path.join(save_dir, METRIC_INFO_JSONL))
+    json_path = os.path.join(save_dir, METRIC_INFO_JSON)
+    with open(json_path + '.tmp', 'w', encoding='utf-8') as outfile:
+        json.dump(metric_info, outfile, indent=4)
+    os.replace(json_path + '.tmp', json_path)
+    return json_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build metric_info.json from metric_info.jsonl for all routes below a folder.')
+    parser.add_argument('--path', type=str, required=True, help='folder that is searched recursively for metric_info.jsonl')
+    parser.add_argument('--overwrite', action='store_true', help='also rebuild existing metric_info.json files')
+    args = parser.parse_args()
+
+    num_built = 0
+    for root, _, files in os.walk(args.path):
+        if METRIC_INFO_JSONL not in files:
+            continue
+        if METRIC_INFO_JSON in files and not args.overwrite:
+            continue
+        build_metric_info_json(root)
+        num_built += 1
+    print(f'Built {num_built} {METRIC_INFO_JSON} files.')
+
+
+if __name__ == '__main__':
+    main()
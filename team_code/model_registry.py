@@ -0,0 +1,65 @@
+"""
+Process level registry of the loaded driving models.
+
+The leaderboard evaluator creates a new agent for every route and calls its setup, which used to load the model and
+the checkpoint again for each route. The agent gets its model from this registry instead, so a model is loaded once
+per (checkpoint, dtype) and stays on the GPU for all routes of the evaluator process.
+
+Contract: the registry only holds objects that do not change while driving (model in eval mode, processor,
+tokenizer, training config). Everything that does change during a route lives on the agent and is created in
+LingoAgent.reset_route_state.
+
+Set KEEP_MODEL_RESIDENT=0 to load the model for every route (the model is freed when the agent is destroyed).
+"""
+import os
+import time
+from typing import Any, Callable, Dict, NamedTuple, Tuple
+
+
+class LoadedModel(NamedTuple):
+    model: Any
+    processor: Any
+    tokenizer: Any
+    cfg: Any
+
+
+_MODELS: Dict[Tuple[str, str], LoadedModel] = {}
+
+
+def keep_resident():
+    return os.environ.get('KEEP_MODEL_RESIDENT', '1') != '0'
+
+
+def registry_key(checkpoint_path, dtype):
+    return (os.path.realpath(checkpoint_path), str(dtype))
+
+
+def get_model(checkpoint_path, dtype, load_fn: Callable[[], LoadedModel]) -> LoadedModel:
+    """The registered model of (checkpoint_path, dtype), load_fn is only called if it is not loaded yet."""
+    key = registry_key(checkpoint_path, dtype)
+    if key in _MODELS:
+        print(f"Reusing the loaded model of {checkpoint_path} ({dtype})", flush=True)
+        return _MODELS[key]
+
+    start = time.time()
+    loaded = load_fn()
+    loaded.model.eval()
+    for p in loaded.model.parameters():
+        p.requires_grad = False
+    print(f"Loaded the model of {checkpoint_path} ({dtype}) in {time.time() - start:.1f}s", flush=True)
+
+    if keep_resident():
+        _MODELS[key] = loaded
+    return loaded
+
+
+def release(checkpoint_path=None, dtype=None):
+    """Removes one model (or all models) from the registry, the memory is freed once the agents drop it too."""
+    if checkpoint_path is None:
+        _MODELS.clear()
+    else:
+        _MODELS.pop(registry_key(checkpoint_path, dtype), None)
+
+    import torch
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()